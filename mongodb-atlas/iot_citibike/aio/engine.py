@@ -0,0 +1,166 @@
+import asyncio
+from datetime import datetime
+
+from iot_citibike import config
+from iot_citibike.citibike.scheduler import next_poll_delay
+from iot_citibike.mongodb.coalescer import OpenBucketCache, BucketPolicy
+from iot_citibike.mongodb.station_cache import StationHashCache
+from iot_citibike.mongodb.recent_cache import RecentStatusCache
+from iot_citibike.mongodb.utilization import UtilizationCache
+from iot_citibike.aio.load_data import stream_station_information, stream_station_status
+from iot_citibike.aio.operations import AsyncBulkWriter, update_station_information, write_station_status, \
+    get_station_last_updated, set_station_last_updated, load_station_hashes, save_station_hashes, load_open_buckets, refresh_latest_status, \
+    repair_utilization, load_recent_status, load_utilization
+
+class IngestionEngine:
+    '''
+    Ingests the station_information and station_status feeds of several GBFS systems from one event loop.
+    Every feed is polled by its own task, so downloading, transforming and writing of all feeds overlap.
+    Each system is stored in its own database, named after the system, with the same collections as the
+    synchronous scripts (stations, status, metadata).
+    '''
+
+    def __init__(self, mongo_client, feed_client, systems, batch_size=100, min_interval=5, max_interval=60, information_interval=3600):
+        '''
+        :param mongo_client: Motor client, shared by all systems
+        :param feed_client: AsyncFeedClient, shared by all systems
+        :param systems: list of { name: ..., station_information: URL, station_status: URL }
+        :param min_interval: minimum seconds between two polls of a status feed
+        :param max_interval: maximum seconds between two polls of a status feed
+        :param information_interval: seconds between two polls of a station_information feed
+        '''
+        self.mongo_client = mongo_client
+        self.feed_client = feed_client
+        self.systems = systems
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.information_interval = information_interval
+        self.station_caches = {}
+        self.bucket_caches = {}
+        self.recent_caches = {}
+        self.utilization_caches = {}
+        self.stopped = asyncio.Event()
+
+    def stop(self):
+        '''
+        Stops polling, the current imports are finished first.
+        '''
+        self.stopped.set()
+
+    async def run(self, once=False):
+        '''
+        Polls all feeds until stop() is called, or imports each feed exactly once.
+        '''
+        tasks = []
+        for system in self.systems:
+            if system.get('station_information') != None:
+                tasks.append(self.poll(system, system['station_information'], self.import_information, once))
+            if system.get('station_status') != None:
+                tasks.append(self.poll(system, system['station_status'], self.import_status, once))
+
+        await asyncio.gather(*tasks)
+
+    async def poll(self, system, feed, import_feed, once):
+        db = self.mongo_client[system['name']]
+        last_updated = await get_station_last_updated(collection=db.metadata, feed=feed)
+        if last_updated == None:
+            last_updated = { '_id': feed, 'last_updated': 0, 'ttl': 0 }
+        self.feed_client.remember(feed, etag=last_updated.get('etag'), last_modified=last_updated.get('last_modified'))
+
+        while not self.stopped.is_set():
+            try:
+                delay = await import_feed(db, feed, last_updated)
+
+            except Exception as e:
+                # Keep the other feeds running, e.g. on network errors, and try again with the next poll
+                print(str(datetime.today()) + ' ERROR Importing ' + feed + ' failed: ' + str(e))
+                delay = self.min_interval
+
+            if once:
+                return
+
+            try:
+                await asyncio.wait_for(self.stopped.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def import_status(self, db, feed, last_updated):
+        '''
+        Imports the status feed if it is more current than the last import. Returns the seconds until the next poll.
+        '''
+        # The status is pushed into the open buckets by _id, the cache is loaded once per system
+        bucket_cache = self.bucket_caches.get(db.name)
+        if bucket_cache == None:
+            bucket_cache = OpenBucketCache(policy=BucketPolicy.for_collection(db.status.name))
+            if config.STATUS_STORAGE == 'buckets':
+                await load_open_buckets(bucket_cache, db.status)
+            self.bucket_caches[db.name] = bucket_cache
+
+        # Measurements that were already written are skipped, e.g. when the feed was not updated in time
+        recent_cache = self.recent_caches.get(db.name)
+        if recent_cache == None:
+            recent_cache = RecentStatusCache()
+            if config.STATUS_STORAGE == 'buckets':
+                await load_recent_status(recent_cache, db.status)
+            self.recent_caches[db.name] = recent_cache
+
+        # The last measurement per station, for the first delta of each hour of the running utilization sums
+        utilization_cache = self.utilization_caches.get(db.name)
+        if utilization_cache == None:
+            utilization_cache = UtilizationCache()
+            if config.STATUS_STORAGE == 'buckets':
+                await load_utilization(utilization_cache, db.utilization)
+            self.utilization_caches[db.name] = utilization_cache
+
+        station_status = stream_station_status(feed, self.feed_client, last_updated=last_updated)
+
+        writer = AsyncBulkWriter(db.status)
+        await write_station_status(stations=station_status, collection=db.status, batch_size=self.batch_size, writer=writer, max_pending=self.batch_size,
+                                   bucket_cache=bucket_cache, utilization_collection=db.utilization, recent_cache=recent_cache,
+                                   utilization_cache=utilization_cache)
+        await writer.flush()
+
+        if station_status.ttl != None:
+            last_updated['ttl'] = station_status.ttl
+
+        if station_status.count > 0:
+            # Materialize the latest status per station for v_bike_availability
+            await refresh_latest_status(db.status)
+            await repair_utilization(db.status)
+
+            last_updated['last_updated'] = station_status.last_updated
+            await set_station_last_updated(collection=db.metadata, feed=feed, last_updated=station_status.last_updated,
+                                           validators=self.feed_client.get_validators(feed), ttl=station_status.ttl)
+
+        # Only send the validators of this download once it is imported, a failed import is downloaded again with the next poll
+        self.feed_client.commit(feed)
+
+        return next_poll_delay(last_updated.get('last_updated'), last_updated.get('ttl'), min_interval=self.min_interval, max_interval=self.max_interval)
+
+    async def import_information(self, db, feed, last_updated):
+        '''
+        Imports new or modified stations if the feed is more current than the last import. Returns the seconds until the next poll.
+        '''
+        # Only new or modified stations are written, the cache is loaded once per system
+        station_cache = self.station_caches.get(db.name)
+        if station_cache == None:
+            station_cache = StationHashCache()
+            await load_station_hashes(station_cache, db.metadata)
+            self.station_caches[db.name] = station_cache
+
+        stations = stream_station_information(feed, self.feed_client, last_updated=last_updated)
+
+        writer = AsyncBulkWriter(db.stations)
+        await update_station_information(stations=stations, collection=db.stations, batch_size=self.batch_size, writer=writer, hash_cache=station_cache)
+        await writer.flush()
+        await save_station_hashes(station_cache, db.metadata)
+
+        if stations.count > 0:
+            last_updated['last_updated'] = stations.last_updated
+            await set_station_last_updated(collection=db.metadata, feed=feed, last_updated=stations.last_updated,
+                                           validators=self.feed_client.get_validators(feed), ttl=stations.ttl)
+
+        self.feed_client.commit(feed)
+
+        return self.information_interval
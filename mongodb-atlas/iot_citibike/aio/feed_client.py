@@ -0,0 +1,97 @@
+import aiohttp
+from datetime import datetime
+
+class AsyncFeedClient:
+    '''
+    Asynchronous variant of FeedClient based on aiohttp: a pooled keep-alive session with conditional requests
+    (If-None-Match/If-Modified-Since), shared by all feeds that are polled from one event loop.
+    '''
+
+    def __init__(self, timeout=20, pool_size=100):
+        '''
+        :param timeout: when does a call time out?
+        :param pool_size: number of concurrent connections across all hosts
+        '''
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session = None
+        self.validators = {}
+        # Validators of the last responses, they are sent once the import of the feed is committed
+        self.received = {}
+
+    async def open(self):
+        '''
+        Creates the session, this needs to happen within the running event loop.
+        '''
+        if self.session == None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                headers={ 'Accept-Encoding': 'gzip, deflate' })
+
+    def remember(self, url, etag=None, last_modified=None):
+        '''
+        Sets the validators for the url, e.g. from the metadata collection of a previous run.
+        '''
+        if etag != None or last_modified != None:
+            self.validators[url] = { 'etag': etag, 'last_modified': last_modified }
+
+    def get_validators(self, url):
+        '''
+        Returns the validators of the last response for the url: { etag: ..., last_modified: ... }, e.g. to store them
+        with the import. If the feed was not downloaded again, the ones that are sent with the requests.
+        '''
+        if url in self.received:
+            return self.received[url]
+        return self.validators.get(url, { 'etag': None, 'last_modified': None })
+
+    def commit(self, url):
+        '''
+        Sends the validators of the last response with the next requests, once the caller imported its feed. Until then
+        the previous validators are sent, so the feed of a failed import is downloaded again instead of answered with 304.
+        If the last response had no validators, none are sent anymore.
+        '''
+        validators = self.received.pop(url, None)
+        if validators == None:
+            return
+        if validators['etag'] == None and validators['last_modified'] == None:
+            self.validators.pop(url, None)
+        else:
+            self.validators[url] = validators
+
+    async def get(self, url, timeout=None):
+        '''
+        Conditional GET of the feed. The body is not read yet, it can be streamed from response.content.
+        The caller has to release the response.
+
+        :param url: url to the feed
+        :return: the response, None if the feed was not modified since the last request
+        '''
+        await self.open()
+
+        headers = {}
+        validators = self.validators.get(url, { 'etag': None, 'last_modified': None })
+        if validators['etag'] != None:
+            headers['If-None-Match'] = validators['etag']
+        if validators['last_modified'] != None:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        response = await self.session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout or self.timeout))
+
+        if response.status == 304:
+            response.release()
+            print(str(datetime.today()) + ' INFO Feed ' + url + ' not modified.')
+            return None
+
+        try:
+            response.raise_for_status()
+        except aiohttp.ClientResponseError:
+            response.release()
+            raise
+
+        self.received[url] = { 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified') }
+        return response
+
+    async def close(self):
+        if self.session != None:
+            await self.session.close()
+            self.session = None
@@ -0,0 +1,82 @@
+from iot_citibike.citibike.load_data import FeedStream, transform_station, ijson
+
+class AsyncFeedStream(FeedStream):
+    '''
+    Asynchronous variant of FeedStream, use it with "async for station in stream".
+    While the stations are processed, the rest of the feed is still downloaded and other feeds can be read concurrently.
+    '''
+
+    def __init__(self, url, client, timeout=20, last_updated=None, transform=None, add_last_updated=True):
+        '''
+        :param client: AsyncFeedClient, the session is shared by all feeds of the event loop
+        '''
+        super().__init__(url, timeout=timeout, last_updated=last_updated, transform=transform, add_last_updated=add_last_updated, client=client)
+
+    def __iter__(self):
+        raise TypeError('AsyncFeedStream can only be iterated with "async for".')
+
+    async def __aiter__(self):
+        response = await self.client.get(self.url, timeout=self.timeout)
+        # 304 Not Modified, nothing to do
+        if response == None:
+            self.not_modified = True
+            return
+
+        try:
+            buffered = []
+            async for kind, value in self.parse_async(response):
+                if kind == 'last_updated':
+                    self.last_updated = value
+                    if not self.is_current():
+                        return
+                    for station in buffered:
+                        yield self.prepare(station)
+                    buffered = []
+                elif kind == 'ttl':
+                    self.ttl = value
+                elif self.last_updated == None:
+                    buffered.append(value)
+                else:
+                    yield self.prepare(value)
+
+            if self.last_updated == None and len(buffered) > 0:
+                raise ValueError('Incorrect Format of feed ' + self.url + ': Missing "last_updated".')
+
+        finally:
+            response.release()
+
+    async def parse_async(self, response):
+        '''
+        Yields ('last_updated', value), ('ttl', value) and ('station', station) in the order they appear in the feed.
+        '''
+        if ijson == None:
+            for item in self.parse_data(await response.json(content_type=None)):
+                yield item
+            return
+
+        # aiohttp already decompresses the content
+        builder = None
+        async for prefix, event, value in ijson.parse_async(response.content, use_float=True):
+            if prefix == 'last_updated' or prefix == 'ttl':
+                yield prefix, value
+            elif prefix.startswith('data.stations.item'):
+                if builder == None:
+                    builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                # The station object is complete
+                if prefix == 'data.stations.item' and event == 'end_map':
+                    yield 'station', builder.value
+                    builder = None
+
+
+def stream_station_information(url, client, last_updated=None, timeout=20):
+    '''
+    Asynchronous variant of iot_citibike.citibike.load_data.stream_station_information.
+    '''
+    return AsyncFeedStream(url, client, timeout=timeout, last_updated=last_updated, transform=transform_station, add_last_updated=False)
+
+def stream_station_status(url, client, last_updated=None, timeout=20):
+    '''
+    Asynchronous variant of iot_citibike.citibike.load_data.stream_station_status.
+    '''
+    return AsyncFeedStream(url, client, timeout=timeout, last_updated=last_updated)
@@ -0,0 +1,283 @@
+import asyncio
+import functools
+import pymongo
+from datetime import datetime
+
+from iot_citibike import config
+from iot_citibike.mongodb.bulk_writer import BulkWriteStats, UnorderedWrite, batch_due, log_failure, log_stats
+from iot_citibike.mongodb.coalescer import StationStatusCoalescer, BucketPolicy, StatusWrites
+from iot_citibike.mongodb.operations import status_measurement, timeseries_operation, last_updated_result, last_updated_update
+from iot_citibike.mongodb.latest_status import LATEST_STATUS_COLLECTION, REFRESH_OVERLAP, latest_status_pipeline, watermark_field, refresh_key, refresh_since
+from iot_citibike.mongodb.utilization import UTILIZATION_COLLECTION, UtilizationCache, repair_pipeline
+from iot_citibike.mongodb.station_cache import StationWrites
+
+async def write_unordered(collection, batch, max_retries=3, stats=None, tracker=None):
+    '''
+    Asynchronous variant of iot_citibike.mongodb.bulk_writer.write_unordered for Motor collections.
+
+    :return: list of operations that could not be written
+    '''
+    write = UnorderedWrite(collection, batch, max_retries=max_retries, stats=stats, tracker=tracker)
+    while len(write.pending) > 0:
+        try:
+            await collection.bulk_write(write.pending, ordered=False)
+            write.succeeded()
+        except pymongo.errors.PyMongoError as err:
+            await asyncio.sleep(write.error(err))
+    return write.finish()
+
+
+class AsyncBulkWriter:
+    '''
+    Asynchronous variant of BulkWriter: each batch is written by its own task, so the writes overlap with
+    downloading and transforming the feeds. submit() waits once max_pending batches are in flight.
+    '''
+
+    def __init__(self, collection, max_pending=8, max_retries=3):
+        '''
+        :param collection: target Motor collection
+        :param max_pending: number of batches in flight before submit() waits
+        :param max_retries: how often failed operations are retried before they are dropped
+        '''
+        self.collection = collection
+        self.max_retries = max_retries
+        self.stats = BulkWriteStats()
+        self.slots = asyncio.Semaphore(max_pending)
+        self.tasks = set()
+
+    async def submit(self, batch, collection=None, tracker=None):
+        '''
+        Schedules the batch for writing. The batch is copied, so the caller can reuse the list.
+        '''
+        if collection == None:
+            collection = self.collection
+        await self.slots.acquire()
+        task = asyncio.ensure_future(write_unordered(collection, list(batch), max_retries=self.max_retries, stats=self.stats, tracker=tracker))
+        self.tasks.add(task)
+        task.add_done_callback(functools.partial(self.done, collection))
+        return task
+
+    def done(self, collection, task):
+        self.tasks.discard(task)
+        self.slots.release()
+
+        if not task.cancelled() and task.exception() != None:
+            log_failure(collection, task.exception())
+
+    async def flush(self):
+        '''
+        Waits until all submitted batches are written.
+        '''
+        if len(self.tasks) > 0:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+    async def close(self):
+        await self.flush()
+        log_stats(self.collection, self.stats)
+
+
+async def write_batch(batch, collection, batch_size=100, full_batch_required=False, writer=None, tracker=None):
+    '''
+    Asynchronous variant of iot_citibike.mongodb.operations.write_batch.
+    '''
+    if batch_due(batch, batch_size=batch_size, full_batch_required=full_batch_required):
+        if writer != None:
+            await writer.submit(batch, collection=collection, tracker=tracker)
+        else:
+            await write_unordered(collection, batch, tracker=tracker)
+        batch.clear()
+
+
+async def update_station_information(stations, collection, batch_size=100, writer=None, hash_cache=None):
+    '''
+    Asynchronous variant of iot_citibike.mongodb.operations.update_station_information, stations is an async iterable.
+    '''
+    batched_operations = []
+    tracker = StationWrites(hash_cache) if hash_cache != None else None
+    async for station in stations:
+        operation = pymongo.ReplaceOne(
+            { '_id': station['_id'] },
+            station,
+            upsert=True)
+
+        if tracker != None:
+            content_hash = hash_cache.changed(station)
+            if content_hash == None:
+                continue
+            tracker.track(operation, (station['_id'], content_hash))
+
+        batched_operations.append(operation)
+        await write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True, writer=writer, tracker=tracker)
+
+    await write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=False, writer=writer, tracker=tracker)
+
+
+async def write_station_status(stations, collection, batch_size=100, writer=None, max_pending=None, storage=None, bucket_cache=None, utilization_collection=None,
+                               recent_cache=None, utilization_cache=None):
+    '''
+    Asynchronous variant of iot_citibike.mongodb.operations.write_station_status, stations is an async iterable.
+    The updates of the running utilization sums are collected by the tracker while the buckets are written, and written
+    once the buckets are.
+    '''
+    if utilization_collection == None:
+        utilization_cache = None
+    elif utilization_cache == None:
+        utilization_cache = UtilizationCache()
+
+    coalescer = StationStatusCoalescer(expire_after=config.STATUS_EXPIRE_AFTER, bucket_cache=bucket_cache, policy=BucketPolicy.for_collection(collection.name),
+                                       recent_cache=recent_cache, utilization_cache=utilization_cache)
+    batched_operations = []
+    utilization = []
+    timeseries = (storage or config.STATUS_STORAGE) == 'timeseries'
+    tracker = StatusWrites(recent_cache=recent_cache) if timeseries else coalescer.tracker
+
+    async for station in stations:
+        station_id, measurement = status_measurement(station)
+        if recent_cache != None and recent_cache.seen(station_id, measurement['last_reported']):
+            continue
+
+        if timeseries:
+            batched_operations.append(tracker.track(timeseries_operation(station_id, measurement), { 'station_id': station_id, 'chunk': [ measurement ] }))
+            await write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True, writer=writer, tracker=tracker)
+            continue
+
+        coalescer.add(station_id, measurement)
+
+        if max_pending != None and len(coalescer) >= max_pending:
+            batched_operations.extend(coalescer.drain())
+            await write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True, writer=writer, tracker=tracker)
+            if utilization_cache != None:
+                utilization.extend(coalescer.tracker.drain_utilization())
+                await write_batch(batch=utilization, collection=utilization_collection, batch_size=batch_size, full_batch_required=True)
+
+    for operation in coalescer.drain():
+        batched_operations.append(operation)
+        await write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True, writer=writer, tracker=tracker)
+
+    await write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=False, writer=writer, tracker=tracker)
+    if utilization_cache != None:
+        # Only the measurements of written buckets
+        if writer != None:
+            await writer.flush()
+        utilization.extend(coalescer.tracker.drain_utilization())
+        await write_batch(batch=utilization, collection=utilization_collection, batch_size=batch_size, full_batch_required=False)
+
+
+async def get_station_last_updated(collection, feed):
+    '''
+    Asynchronous variant of iot_citibike.mongodb.operations.get_station_last_updated.
+    '''
+    try:
+        return last_updated_result(feed, await collection.find_one({'_id': feed}))
+
+    except pymongo.errors.PyMongoError as e:
+        print(str(datetime.today()) + ' ERROR Fetching last updated for feed ' + feed + ' failed: ' + str(e))
+        return None
+
+
+async def set_station_last_updated(collection, feed, last_updated, validators=None, ttl=None):
+    '''
+    Asynchronous variant of iot_citibike.mongodb.operations.set_station_last_updated.
+    '''
+    try:
+        await collection.update_one({'_id': feed}, last_updated_update(last_updated, validators=validators, ttl=ttl), upsert=True)
+        print(str(datetime.today()) + ' INFO Updated last_updated for feed ' + feed + '.')
+
+    except pymongo.errors.PyMongoError as e:
+        print(str(datetime.today()) + ' ERROR Setting last updated for feed ' + feed + ' failed: ' + str(e))
+
+
+async def load_station_hashes(hash_cache, collection, key='station_hashes'):
+    '''
+    Asynchronous variant of StationHashCache.load_metadata.
+    '''
+    try:
+        return hash_cache.load_result(await collection.find_one({'_id': key}))
+
+    except pymongo.errors.PyMongoError as e:
+        print(str(datetime.today()) + ' ERROR Loading station hashes failed: ' + str(e))
+        return False
+
+
+async def save_station_hashes(hash_cache, collection, key='station_hashes'):
+    '''
+    Asynchronous variant of StationHashCache.save_metadata.
+    '''
+    with hash_cache.lock:
+        dirty = list(hash_cache.dirty)
+    if len(dirty) == 0:
+        return
+
+    try:
+        await collection.update_one({'_id': key}, hash_cache.metadata_update(dirty), upsert=True)
+        hash_cache.saved(dirty)
+
+    except pymongo.errors.PyMongoError as e:
+        print(str(datetime.today()) + ' ERROR Saving station hashes failed: ' + str(e))
+
+
+async def load_recent_status(recent_cache, collection):
+    '''
+    Asynchronous variant of RecentStatusCache.load.
+    '''
+    recent_cache.load_results(await collection.aggregate(recent_cache.pipeline(), allowDiskUse=True).to_list(None), collection)
+
+
+async def load_utilization(utilization_cache, collection):
+    '''
+    Asynchronous variant of UtilizationCache.load.
+    '''
+    try:
+        utilization_cache.load_results(await collection.aggregate(utilization_cache.pipeline(), allowDiskUse=True).to_list(None), collection)
+
+    except pymongo.errors.PyMongoError as e:
+        print(str(datetime.today()) + ' ERROR Loading the last measurements failed: ' + str(e))
+
+
+async def load_open_buckets(bucket_cache, collection):
+    '''
+    Asynchronous variant of OpenBucketCache.load.
+    '''
+    bucket_cache.load_results(await collection.aggregate(bucket_cache.pipeline(), allowDiskUse=True).to_list(None), collection)
+
+
+async def refresh_latest_status(status_collection, latest_collection=None, storage=None, metadata_collection=None, overlap=REFRESH_OVERLAP):
+    '''
+    Asynchronous variant of iot_citibike.mongodb.latest_status.refresh_latest_status.
+    '''
+    if latest_collection == None:
+        latest_collection = status_collection.database[LATEST_STATUS_COLLECTION]
+    if metadata_collection == None:
+        metadata_collection = status_collection.database['metadata']
+    field = watermark_field(storage)
+
+    try:
+        since = refresh_since(await metadata_collection.find_one({ '_id': refresh_key(latest_collection) }), overlap=overlap)
+        newest = await status_collection.find_one({}, projection={ field: 1 }, sort=[ (field, pymongo.DESCENDING) ])
+        await status_collection.aggregate(latest_status_pipeline(since=since, storage=storage, into=latest_collection.name), allowDiskUse=True).to_list(None)
+
+        if newest != None:
+            await metadata_collection.update_one({ '_id': refresh_key(latest_collection) }, { '$set': { 'watermark': newest[field] } }, upsert=True)
+        print(str(datetime.today()) + ' INFO Refreshed ' + str(latest_collection.name) + ' since ' + str(since) + '.')
+
+    except pymongo.errors.PyMongoError as e:
+        print(str(datetime.today()) + ' ERROR Refreshing ' + str(latest_collection.name) + ' failed: ' + str(e))
+
+
+async def repair_utilization(status_collection, utilization_collection=None, limit=1000):
+    '''
+    Asynchronous variant of iot_citibike.mongodb.utilization.repair_utilization.
+    '''
+    if utilization_collection == None:
+        utilization_collection = status_collection.database[UTILIZATION_COLLECTION]
+
+    try:
+        stale = await utilization_collection.find({ 'stale': True }, projection={ 'station_id': 1, 'hour': 1 }, limit=limit).to_list(None)
+        if len(stale) == 0:
+            return
+
+        await status_collection.aggregate(repair_pipeline(stale, into=utilization_collection.name), allowDiskUse=True).to_list(None)
+        print(str(datetime.today()) + ' INFO Repaired ' + str(len(stale)) + ' station-hours of ' + str(utilization_collection.name) + '.')
+
+    except pymongo.errors.PyMongoError as e:
+        print(str(datetime.today()) + ' ERROR Repairing ' + str(utilization_collection.name) + ' failed: ' + str(e))
@@ -0,0 +1,77 @@
+import asyncio
+import multiprocessing
+import signal
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from iot_citibike.citibike.registry import shard
+from iot_citibike.aio.feed_client import AsyncFeedClient
+from iot_citibike.aio.engine import IngestionEngine
+
+def run_worker(mongo_uri, systems, once=False, pool_size=10, **options):
+    '''
+    Ingests the systems on its own event loop, with its own MongoDB connection pool and HTTP session.
+    Each feed keeps its watermark in the metadata collection of its system, so workers never share state.
+
+    :param mongo_uri: connection string, the client is created in the worker
+    :param systems: the systems of this worker, see iot_citibike.citibike.registry.build_registry
+    :param once: import each feed once instead of polling
+    :param pool_size: maximum number of MongoDB connections of this worker
+    :param options: passed on to IngestionEngine, e.g. min_interval
+    '''
+
+    async def main():
+        mongo_client = AsyncIOMotorClient(mongo_uri, maxPoolSize=pool_size)
+        feed_client = AsyncFeedClient()
+        engine = IngestionEngine(mongo_client, feed_client, systems, **options)
+
+        # Stop gracefully, the current imports are finished first
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, engine.stop)
+        loop.add_signal_handler(signal.SIGINT, engine.stop)
+
+        try:
+            await engine.run(once=once)
+        finally:
+            await feed_client.close()
+            mongo_client.close()
+
+    asyncio.run(main())
+
+
+class WorkerPool:
+    '''
+    Distributes the systems across worker processes, each worker runs run_worker() for its shard.
+    '''
+
+    def __init__(self, mongo_uri, systems, workers=4, once=False, pool_size=10, **options):
+        '''
+        :param workers: number of worker processes, workers without systems are not started
+        '''
+        self.processes = []
+        for number, systems_of_worker in enumerate(shard(systems, workers)):
+            if len(systems_of_worker) == 0:
+                continue
+            self.processes.append(multiprocessing.Process(
+                target=run_worker,
+                args=(mongo_uri, systems_of_worker, once, pool_size),
+                kwargs=options,
+                name='ingest-' + str(number)))
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+            print(str(datetime.today()) + ' INFO Started worker ' + process.name + ' (pid ' + str(process.pid) + ').')
+
+    def stop(self):
+        '''
+        Asks the workers to stop after their current imports.
+        '''
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+    def join(self):
+        for process in self.processes:
+            process.join()
+            print(str(datetime.today()) + ' INFO Worker ' + process.name + ' exited with ' + str(process.exitcode) + '.')
@@ -0,0 +1,113 @@
+import csv
+import re
+import zlib
+import requests
+from datetime import datetime
+
+def discover_feeds(url, language='en', timeout=20):
+    '''
+    Reads the GBFS auto-discovery file (gbfs.json) of a system.
+
+    :param url: url to gbfs.json
+    :param language: preferred language of the feeds (GBFS before 3.0 groups the feeds by language)
+    :return: { feed name: url }, e.g. { 'station_status': 'https://.../station_status.json', ... }
+    '''
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    if not 'data' in data:
+        raise ValueError('Incorrect Format of feed ' + url + ': Missing "data".')
+
+    feeds = data['data'].get('feeds')
+    if feeds == None:
+        languages = data['data']
+        if len(languages) == 0:
+            raise ValueError('Incorrect Format of feed ' + url + ': No feeds available.')
+        feeds = (languages.get(language) or next(iter(languages.values())))['feeds']
+
+    return { feed['name']: feed['url'] for feed in feeds }
+
+
+def database_name(name):
+    '''
+    MongoDB database name for a system, e.g. for the system ids of the GBFS systems.csv.
+    '''
+    return re.sub('[^A-Za-z0-9_-]', '_', name)[:63]
+
+
+def parse_systems(value):
+    '''
+    Parses comma separated NAME=URL pairs. The url is either the auto-discovery file (gbfs.json)
+    or the base url of the feeds.
+    '''
+    systems = []
+    for entry in value.split(','):
+        if entry.strip() == '':
+            continue
+        name, url = entry.strip().split('=', 1)
+        systems.append({ 'name': name.strip(), 'url': url.strip() })
+    return systems
+
+
+def load_systems_csv(path):
+    '''
+    Reads the systems from a file in the format of the systems.csv of the GBFS repository,
+    i.e. with the columns "System ID" and "Auto-Discovery URL".
+    '''
+    with open(path, newline='', encoding='utf-8') as systems_file:
+        return [ { 'name': row['System ID'].strip(), 'url': row['Auto-Discovery URL'].strip() } for row in csv.DictReader(systems_file) ]
+
+
+def resolve_system(system, language='en', timeout=20):
+    '''
+    Resolves the urls of the station_information and station_status feeds of a system.
+
+    :param system: { name: ..., url: gbfs.json or base url of the feeds }
+    :return: { name: database name, station_information: URL, station_status: URL }
+    '''
+    url = system['url']
+    if url.endswith('.json'):
+        feeds = discover_feeds(url, language=language, timeout=timeout)
+    else:
+        base_url = url.rstrip('/') + '/'
+        feeds = { feed: base_url + feed + '.json' for feed in ['station_information', 'station_status'] }
+
+    return {
+        'name': database_name(system['name']),
+        'station_information': feeds.get('station_information'),
+        'station_status': feeds.get('station_status')
+    }
+
+
+def build_registry(systems, language='en', timeout=20):
+    '''
+    Resolves the feeds of all systems. Systems that cannot be resolved or provide neither
+    station_information nor station_status are skipped.
+    '''
+    registry = []
+    for system in systems:
+        try:
+            resolved = resolve_system(system, language=language, timeout=timeout)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(str(datetime.today()) + ' ERROR Discovering feeds of ' + system['name'] + ' failed: ' + str(e))
+            continue
+
+        if resolved['station_information'] == None and resolved['station_status'] == None:
+            print(str(datetime.today()) + ' ERROR System ' + system['name'] + ' provides no station feeds.')
+            continue
+
+        registry.append(resolved)
+
+    print(str(datetime.today()) + ' INFO Registered ' + str(len(registry)) + ' of ' + str(len(systems)) + ' systems.')
+    return registry
+
+
+def shard(systems, workers):
+    '''
+    Assigns the systems to the workers. The assignment only depends on the system name,
+    so a system stays with the same worker when other systems are added or removed.
+    '''
+    shards = [ [] for i in range(workers) ]
+    for system in systems:
+        shards[zlib.crc32(system['name'].encode('utf-8')) % workers].append(system)
+    return shards
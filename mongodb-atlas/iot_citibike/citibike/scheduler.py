@@ -0,0 +1,23 @@
+import time
+
+def next_poll_delay(last_updated, ttl, min_interval=5, max_interval=60, now=None):
+    '''
+    Seconds to wait before the feed should be polled again.
+    GBFS feeds announce via ttl how many seconds after last_updated the data will be refreshed,
+    so the next poll is scheduled right after that point in time. If the feed is late already
+    or does not provide a ttl, we poll again after min_interval.
+
+    :param last_updated: last_updated of the feed in seconds since 1970
+    :param ttl: ttl of the feed in seconds, 0 or None if unknown
+    :param min_interval: never poll more often than this
+    :param max_interval: never wait longer than this, e.g. if the feed announces a large ttl
+    :param now: current time in seconds since 1970, defaults to time.time()
+    '''
+    if now == None:
+        now = time.time()
+
+    if not last_updated or not ttl:
+        return min_interval
+
+    delay = last_updated + ttl - now
+    return min(max(delay, min_interval), max_interval)
@@ -0,0 +1,452 @@
+import bson
+import pymongo
+import threading
+from bson import ObjectId
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from iot_citibike import config
+from iot_citibike.mongodb.bucket_layout import is_columnar, columns_push, columns_insert, rows_insert
+from iot_citibike.mongodb.bulk_writer import WriteTracker, write_unordered
+
+# We expect to execute the loader every 30 seconds, so roughly one hour will be stored in one bucket
+BUCKET_SIZE = 120
+
+class BucketPolicy:
+    '''
+    Decides how the measurements of a station are grouped into buckets:
+      - count: up to limit measurements per bucket (bucket_size)
+      - time: one bucket per station and time window of limit seconds (bucket_start)
+      - bytes: up to limit bytes of BSON encoded measurements per bucket (bucket_bytes)
+    Count buckets of quiet stations stay open for a long time, time buckets cover a predictable time range
+    and byte buckets keep the documents close to a target size, no matter how often a station reports.
+    '''
+
+    def __init__(self, kind='count', limit=BUCKET_SIZE):
+        if kind not in ['count', 'time', 'bytes']:
+            raise ValueError('Unknown bucket policy ' + str(kind) + ', expected count, time or bytes.')
+        self.kind = kind
+        self.limit = int(limit)
+
+    def __repr__(self):
+        return self.kind + ':' + str(self.limit)
+
+    @classmethod
+    def parse(cls, value):
+        '''
+        Creates a policy from its configuration, e.g. 'count:120', 'time:3600' or 'bytes:16384'.
+        '''
+        kind, limit = value.split(':', 1)
+        return cls(kind.strip(), limit.strip())
+
+    @classmethod
+    def for_collection(cls, collection_name):
+        '''
+        The policy configured for the collection, see config.STATUS_BUCKETING.
+        '''
+        return cls.parse(config.bucketing(collection_name))
+
+    @property
+    def size_field(self):
+        '''
+        The attribute of a bucket that is compared to the limit, None for time windows.
+        '''
+        return { 'count': 'bucket_size', 'bytes': 'bucket_bytes' }.get(self.kind)
+
+    def weight(self, measurement):
+        '''
+        How much of the limit the measurement uses up.
+        '''
+        if self.kind == 'bytes':
+            return len(bson.encode(measurement))
+        return 1
+
+    def window_start(self, ts):
+        '''
+        Start of the time window of a timestamp, e.g. the full hour for time:3600.
+        '''
+        seconds = int((ts - datetime(1970, 1, 1, tzinfo=ts.tzinfo)).total_seconds())
+        return ts - timedelta(seconds=seconds % self.limit, microseconds=ts.microsecond)
+
+
+class OpenBucketCache:
+    '''
+    Remembers the _id and the fill level of the open bucket per station, so that measurements are pushed by _id,
+    i.e. a point update on the _id index instead of searching for a bucket of the station with space left.
+    When a bucket is full, the writer allocates the _id of the next bucket right away. The rollover is decided
+    here and never leaves two open buckets for a station behind.
+    The newest timestamp of each open bucket is kept as well, so that only late measurements need an ordered insert.
+    Works with count and bytes policies, time windows address their bucket directly anyway.
+    The space of measurements that were not written is released again (see StatusWrites), from the threads of a BulkWriter.
+    '''
+
+    def __init__(self, policy=None):
+        '''
+        :param policy: BucketPolicy of the status collection, count:120 by default
+        '''
+        self.policy = policy or BucketPolicy()
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def pipeline(self):
+        '''
+        Aggregation that returns the latest bucket with space left per station.
+        '''
+        return [
+            { '$match': { self.policy.size_field: { '$lt': self.policy.limit } } },
+            { '$sort': { 'station_id': 1, 'max_ts': 1 } },
+            { '$group': {
+                '_id': '$station_id',
+                'bucket_id': { '$last': '$_id' },
+                'bucket_size': { '$last': '$' + self.policy.size_field },
+                'max_ts': { '$last': '$max_ts' }
+            } }
+        ]
+
+    def load(self, collection):
+        '''
+        Rebuilds the cache from the status collection with a single aggregation, e.g. at startup.
+        '''
+        if self.policy.kind == 'time':
+            return
+        self.load_results(collection.aggregate(self.pipeline(), allowDiskUse=True), collection)
+
+    def load_results(self, results, collection):
+        for result in results:
+            self.buckets[result['_id']] = { '_id': result['bucket_id'], 'size': result['bucket_size'], 'max_ts': result.get('max_ts') }
+        print(str(datetime.today()) + ' INFO Loaded ' + str(len(self.buckets)) + ' open buckets from ' + str(collection.name) + '.')
+
+    def allocate(self, station_id, weights):
+        '''
+        Reserves space for the leading measurements (given by their weights) in the open bucket of the station,
+        a new bucket is started if it is full. A new bucket always takes at least one measurement.
+        Returns the _id of the bucket and the number of measurements that fit into it.
+        '''
+        with self.lock:
+            bucket = self.buckets.get(station_id)
+            if bucket == None or (bucket['size'] > 0 and bucket['size'] + weights[0] > self.policy.limit):
+                bucket = { '_id': ObjectId(), 'size': 0, 'max_ts': None }
+                self.buckets[station_id] = bucket
+
+            count = 0
+            for weight in weights:
+                if count > 0 and bucket['size'] + weight > self.policy.limit:
+                    break
+                bucket['size'] += weight
+                count += 1
+            return bucket['_id'], count
+
+    def advance(self, station_id, min_ts, max_ts):
+        '''
+        Remembers the newest timestamp of the measurements that were just allocated in the open bucket of the station.
+        Returns True if they can be appended, i.e. the bucket has no measurement after min_ts.
+        '''
+        with self.lock:
+            bucket = self.buckets[station_id]
+            in_order = bucket.get('max_ts') == None or bucket['max_ts'] <= min_ts
+            if in_order or bucket['max_ts'] < max_ts:
+                bucket['max_ts'] = max_ts
+            return in_order
+
+    def release(self, station_id, bucket_id, weight):
+        '''
+        Gives back the space of measurements that were allocated but not written, if the bucket is still open.
+        The newest timestamp is kept, at worst the next measurements are inserted in order instead of appended.
+        '''
+        with self.lock:
+            bucket = self.buckets.get(station_id)
+            if bucket != None and bucket['_id'] == bucket_id:
+                bucket['size'] = max(bucket['size'] - weight, 0)
+
+
+class StatusWrites(WriteTracker):
+    '''
+    Follows the status writes of a StationStatusCoalescer, or the inserts into a time series collection, through the
+    bulk writes. The context of each operation is { station_id, chunk, weights, bucket_id, filter }:
+      - the keys of the written measurements are remembered by the RecentStatusCache
+      - the running utilization sums are only updated for the written measurements, see UtilizationCache.
+        With a utilization collection, the updates are written right away, otherwise they are collected (drain_utilization)
+      - the space of measurements that were skipped or dropped is released in the OpenBucketCache
+      - a chunk that is rejected by the duplicate guard is split up, so that only the measurements which are stored
+        already are skipped, the others are written on their own
+    '''
+
+    def __init__(self, coalescer=None, recent_cache=None, utilization_cache=None, utilization_collection=None):
+        '''
+        :param coalescer: StationStatusCoalescer that creates the operations, None for time series inserts
+        :param recent_cache: optional RecentStatusCache
+        :param utilization_cache: optional UtilizationCache, to update the running utilization sums
+        :param utilization_collection: optional collection for the updates of the running utilization sums
+        '''
+        super().__init__()
+        self.coalescer = coalescer
+        self.recent_cache = recent_cache
+        self.utilization_cache = utilization_cache
+        self.utilization_collection = utilization_collection
+        self.utilization = []
+
+    def split(self, operation):
+        with self.lock:
+            entry = self.contexts.get(id(operation))
+        if self.coalescer == None or entry == None or entry[1].get('filter') == None or len(entry[1]['chunk']) < 2:
+            return None
+
+        self.pop([ operation ])
+        return self.coalescer.split_operations(entry[1])
+
+    def written(self, contexts):
+        if self.recent_cache != None:
+            for context in contexts:
+                for measurement in context['chunk']:
+                    if 'last_reported' in measurement:
+                        self.recent_cache.remember(context['station_id'], measurement['last_reported'])
+
+        if self.utilization_cache != None and len(contexts) > 0:
+            operations = []
+            for context in contexts:
+                operations.extend(self.utilization_cache.operations(context['station_id'], context['chunk'], expire_after=self.coalescer.expire_after))
+
+            if self.utilization_collection != None:
+                write_unordered(self.utilization_collection, operations)
+            else:
+                with self.lock:
+                    self.utilization.extend(operations)
+
+    def drain_utilization(self):
+        '''
+        The collected updates of the running utilization sums, if there is no utilization collection.
+        '''
+        with self.lock:
+            operations = self.utilization
+            self.utilization = []
+        return operations
+
+    def skipped(self, contexts):
+        self.release(contexts)
+
+    def dropped(self, contexts):
+        self.release(contexts)
+
+    def release(self, contexts):
+        if self.coalescer == None or self.coalescer.bucket_cache == None:
+            return
+        for context in contexts:
+            if context.get('bucket_id') != None:
+                self.coalescer.bucket_cache.release(context['station_id'], context['bucket_id'], sum(context['weights']))
+
+
+class StationStatusCoalescer:
+    '''
+    Groups pending measurements per station so that they can be pushed into the buckets with
+    a single $push/$each per bucket instead of one upsert per measurement.
+    This pays off whenever more than one measurement per station is pending, e.g. when a subscriber
+    drains a burst of messages or a backlog is replayed.
+    '''
+
+    def __init__(self, bucket_size=BUCKET_SIZE, expire_after=timedelta(hours=12), bucket_cache=None, policy=None, layout=None, recent_cache=None,
+                 utilization_cache=None, utilization_collection=None):
+        '''
+        :param bucket_size: maximum number of measurements per bucket, if no policy is provided
+        :param expire_after: time after the latest measurement when a bucket is removed by the TTL index
+        :param bucket_cache: optional OpenBucketCache to push the measurements into the buckets by _id
+        :param policy: BucketPolicy, e.g. BucketPolicy.for_collection(collection.name). The policy of the bucket_cache wins.
+        :param layout: 'rows' or 'columns', defaults to config.STATUS_LAYOUT
+        :param recent_cache: optional RecentStatusCache, the keys of the measurements are remembered once they are written
+        :param utilization_cache: optional UtilizationCache, the running utilization sums are updated for the written measurements
+        :param utilization_collection: collection for the running utilization sums, see StatusWrites
+        '''
+        if bucket_cache != None:
+            policy = bucket_cache.policy
+        self.policy = policy or BucketPolicy('count', bucket_size)
+        self.bucket_size = self.policy.limit
+        self.expire_after = expire_after
+        self.columnar = is_columnar(layout)
+        self.bucket_cache = bucket_cache if self.policy.kind != 'time' else None
+        self.pending = OrderedDict()
+        self.pending_keys = {}
+        self.pending_count = 0
+        # Pass it to write_batch along with the operations
+        self.tracker = StatusWrites(self, recent_cache, utilization_cache=utilization_cache, utilization_collection=utilization_collection)
+
+    def __len__(self):
+        '''
+        Number of pending measurements across all stations.
+        '''
+        return self.pending_count
+
+    def add(self, station_id, measurement):
+        '''
+        Remember a measurement for the station. The measurement needs a 'ts' attribute.
+        Returns False if a measurement with the same last_reported is already pending for the station.
+        '''
+        if 'last_reported' in measurement:
+            keys = self.pending_keys.setdefault(station_id, set())
+            if measurement['last_reported'] in keys:
+                return False
+            keys.add(measurement['last_reported'])
+
+        self.pending.setdefault(station_id, []).append(measurement)
+        self.pending_count += 1
+        return True
+
+    def drain(self):
+        '''
+        Returns the pymongo operations for all pending measurements and forgets about them.
+        Write them with the tracker, it updates the running utilization sums once the buckets are written.
+        '''
+        operations = []
+        for station_id, measurements in self.pending.items():
+            operations.extend(self.station_operations(station_id, measurements))
+
+        self.pending.clear()
+        self.pending_keys.clear()
+        self.pending_count = 0
+        return operations
+
+    def station_operations(self, station_id, measurements):
+        '''
+        Splits the measurements of one station into chunks that fit into one bucket each.
+        '''
+        measurements.sort(key=lambda measurement: measurement['ts'])
+
+        operations = []
+        if self.policy.kind == 'time':
+            # One bucket per time window, addressed by station and start of the window
+            chunks = OrderedDict()
+            for measurement in measurements:
+                chunks.setdefault(self.policy.window_start(measurement['ts']), []).append(measurement)
+            for window_start, chunk in chunks.items():
+                operations.append(self.chunk_operation(station_id, chunk, [ self.policy.weight(measurement) for measurement in chunk ],
+                                                       { 'station_id': station_id, 'bucket_start': window_start }))
+            return operations
+
+        weights = [ self.policy.weight(measurement) for measurement in measurements ]
+
+        if self.bucket_cache != None:
+            start = 0
+            while start < len(measurements):
+                bucket_id, count = self.bucket_cache.allocate(station_id, weights[start:])
+                chunk = measurements[start:start + count]
+                in_order = self.bucket_cache.advance(station_id, chunk[0]['ts'], chunk[-1]['ts'])
+                operations.append(self.chunk_operation(station_id, chunk, weights[start:start + count], { '_id': bucket_id, 'station_id': station_id },
+                                                       bucket_id=bucket_id, in_order=in_order))
+                start += count
+            return operations
+
+        start = 0
+        while start < len(measurements):
+            # As many measurements as fit into one bucket, but at least one
+            end = start + 1
+            weight = weights[start]
+            while end < len(measurements) and weight + weights[end] <= self.policy.limit:
+                weight += weights[end]
+                end += 1
+
+            operation = self.bucket_operation(measurements[start:end], {
+                # The station for which we add data
+                'station_id': station_id,
+
+                # The bucket must be able to take all measurements of the chunk
+                self.policy.size_field: { '$lte': max(self.policy.limit - weight, 0) }
+            }, weight=weight)
+            operations.append(self.tracker.track(operation, { 'station_id': station_id, 'chunk': measurements[start:end], 'weights': weights[start:end] }))
+            start = end
+        return operations
+
+    def chunk_operation(self, station_id, chunk, weights, bucket_filter, bucket_id=None, in_order=False):
+        '''
+        The guarded bucket operation for a chunk of measurements that addresses exactly one bucket, tracked by the tracker.
+        '''
+        operation = self.bucket_operation(chunk, self.guard(chunk, dict(bucket_filter)), weight=sum(weights), in_order=in_order)
+        return self.tracker.track(operation, {
+            'station_id': station_id,
+            'chunk': chunk,
+            'weights': weights,
+            'bucket_id': bucket_id,
+            'filter': bucket_filter
+        })
+
+    def split_operations(self, context):
+        '''
+        One operation per measurement of a chunk that was rejected by the duplicate guard, see StatusWrites.
+        The measurements are sorted in, the bucket may already have newer ones.
+        '''
+        return [ self.chunk_operation(context['station_id'], [ measurement ], [ weight ], context['filter'], bucket_id=context.get('bucket_id'))
+                 for measurement, weight in zip(context['chunk'], context['weights']) ]
+
+    def guard(self, chunk, bucket_filter):
+        '''
+        Adds the server side guard against duplicates to a filter that addresses exactly one bucket (_id or time window):
+        the bucket must not contain any of the chunk's measurements yet (same last_reported).
+        If it does, the upsert does not match and inserting a second bucket with the same _id (or station and window)
+        fails with a duplicate key error, so the chunk is rejected within the same round-trip instead of being pushed twice.
+        The tracker then splits the chunk: each measurement is written on its own, only the ones that are stored already
+        are skipped (see StatusWrites and UnorderedWrite). Filters on the fill level are not guarded, the upsert would just
+        start a new bucket.
+        '''
+        keys = [ measurement['last_reported'] for measurement in chunk if 'last_reported' in measurement ]
+        if len(keys) > 0:
+            bucket_filter[('columns' if self.columnar else 'status') + '.last_reported'] = { '$nin': keys }
+        return bucket_filter
+
+    def bucket_operation(self, chunk, bucket_filter, weight=None, in_order=False):
+        '''
+        A single upsert that pushes the whole chunk into the bucket that matches the filter:
+          - a bucket of the station with enough space left for the whole chunk, otherwise a new bucket is created.
+            This way, a bucket never exceeds the limit, no matter how many measurements are pushed at once.
+          - the bucket with the _id from the OpenBucketCache, it is created with this _id if needed
+          - the bucket of the station and time window
+        The measurements of a bucket are always ordered by ts. The chunk is only appended if it is known to be in order
+        (in_order, from the OpenBucketCache), otherwise it is inserted at the position of its timestamps. In the rows
+        layout, the update itself checks the max_ts of the bucket and only inserts late measurements at their position.
+        '''
+        min_ts = chunk[0]['ts']
+        max_ts = chunk[-1]['ts']
+
+        # Increase the bucket size counter by the number of measurements
+        increments = { 'bucket_size': len(chunk) }
+        if self.policy.kind == 'bytes':
+            increments['bucket_bytes'] = weight
+
+        if not in_order:
+            # Pipeline update, the same as below plus the ordered insert into the columns or the status array
+            update = {
+                'max_ts': { '$max': [ '$max_ts', max_ts ] },
+                'expire_on': { '$max': [ '$expire_on', max_ts + self.expire_after ] },
+                'min_ts': { '$min': [ '$min_ts', min_ts ] }
+            }
+            if self.columnar:
+                update['columns'] = columns_insert(chunk)
+            else:
+                update['status'] = rows_insert(chunk)
+            for field, increment in increments.items():
+                update[field] = { '$add': [ { '$ifNull': [ '$' + field, 0 ] }, increment ] }
+            return pymongo.UpdateOne(bucket_filter, [ { '$set': update } ], upsert=True)
+
+        # Append the new measurements to the bucket, either as array of documents or to the array per attribute
+        if self.columnar:
+            push = columns_push(chunk)
+        else:
+            push = { 'status': { '$each': chunk } }
+
+        return pymongo.UpdateOne(
+            bucket_filter,
+            {
+                '$push': push,
+
+                # Set the max value for the max timestamp of the document
+                # Set the max value for the TTL index
+                '$max': {
+                    'max_ts': max_ts,
+                    'expire_on': max_ts + self.expire_after
+                },
+
+                # Set the min value for the min timestamp of the document
+                '$min': { 'min_ts': min_ts },
+
+                '$inc': increments
+            },
+            upsert=True)
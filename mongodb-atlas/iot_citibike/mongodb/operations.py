@@ -1,103 +1,196 @@
 from pymongo import InsertOne, DeleteOne, ReplaceOne
 import pymongo
 from datetime import datetime, timedelta
+from collections import OrderedDict
 
-def update_station_information(stations, collection, batch_size=100):
+from iot_citibike import config
+from iot_citibike.mongodb.bulk_writer import write_unordered, batch_due
+from iot_citibike.mongodb.coalescer import StationStatusCoalescer, BucketPolicy, StatusWrites
+from iot_citibike.mongodb.utilization import UtilizationCache
+from iot_citibike.mongodb.station_cache import StationWrites
+
+def update_station_information(stations, collection, batch_size=100, writer=None, hash_cache=None):
     '''
     Bulk replace citi bike stations in MongoDB. New stations will be added automatically, changes in stations will be replaced.
+    If a StationHashCache is provided, stations that did not change since the last stored version are skipped.
+    The hashes of the stations are remembered once they are written.
     '''
 
     batched_operations = []
+    tracker = StationWrites(hash_cache) if hash_cache != None else None
     for station in stations:
-        batched_operations.append(pymongo.ReplaceOne(
+        operation = pymongo.ReplaceOne(
             { '_id': station['_id'] },
             station,
-            upsert=True))
-        write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True)
+            upsert=True)
+
+        if tracker != None:
+            content_hash = hash_cache.changed(station)
+            if content_hash == None:
+                continue
+            tracker.track(operation, (station['_id'], content_hash))
+
+        batched_operations.append(operation)
+        write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True, writer=writer, tracker=tracker)
 
     # Don't forget the last batch that might not fill up the whole batch_size ;)
-    write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=False)
+    write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=False, writer=writer, tracker=tracker)
 
 
-def update_station_status(station_status, collection, metadata_collection, feed, batch_size=100):
+def update_station_status(station_status, collection, metadata_collection, feed, batch_size=100, writer=None, bucket_cache=None, recent_cache=None):
     '''
     Iterate over the stations and push the values into buckets.
     '''
 
-    batched_operations = []
-
+    # Each measurement gets the timestamp of the feed
     for station in station_status['data']['stations']:
+        station['last_updated'] = station_status['last_updated']
 
-        # Prepare the current measurement for pushing into the bucket
-        # Remove, but remember the station id, we need it for updating later on
-        station_id = station.pop('station_id')
-
-        # Add the timestamp when the data arrived, we want a date format for better readability
-        station['ts'] = datetime.fromtimestamp(station_status['last_updated'])
-        station['last_reported'] = datetime.fromtimestamp(station['last_reported'])
-
-        # Add to the batch
-        batched_operations.append(pymongo.UpdateOne(
-            {
-                # The station for which we add data
-                'station_id': station_id,
-
-                # We expect to execute the loader every 30 seconds, so roughly one hour will be stored in one bucket
-                'bucket_size': { '$lt': 120 }
-            },
-            {
-                # Add the new measurement to the bucket
-                '$push': { 
-                    'status': station
-                },
-
-                # Set the max value for the max timestamp of the document
-                # Set the max value for the TTL index
-                '$max': { 
-                    'max_ts': station['ts'], 
-                    'expire_on': station['ts'] + timedelta(hours=12) 
-                },
-
-                # Set the min value for the min timestamp of the docuemnt
-                '$min': { 'min_ts': station['ts'] },
-
-                # Increase the bucket size counter by one
-                '$inc': { 'bucket_size': 1 }
-            },
-            upsert=True))
-
-        write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True)
+    write_station_status(stations=station_status['data']['stations'], collection=collection, batch_size=batch_size, writer=writer, bucket_cache=bucket_cache,
+                         recent_cache=recent_cache)
 
-    # Don't forget the last batch that might not fill up the whole batch_size ;)
-    write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=False)
+    # Only move the watermark once everything is written
+    if writer != None:
+        writer.flush()
 
     # Write metadata about the import
     set_station_last_updated(collection=metadata_collection, feed=feed, last_updated=station_status['last_updated'])
 
 
+def write_station_status(stations, collection, batch_size=100, writer=None, max_pending=None, storage=None, bucket_cache=None, utilization_collection=None,
+                         recent_cache=None, partitions=None, utilization_cache=None):
+    '''
+    Push the status of the stations into buckets. Each station needs the last_updated timestamp of its feed.
+    Stations can be any iterable, e.g. a FeedStream that is still downloaded.
+
+    :param max_pending: write as soon as this many measurements are pending, by default all measurements of a station are
+                        coalesced before writing. Useful for streams that contain only one measurement per station.
+    :param storage: 'buckets' or 'timeseries', defaults to config.STATUS_STORAGE
+    :param bucket_cache: optional OpenBucketCache, the buckets are updated by _id instead of searching one with space left.
+                         With partitions, each partition uses its own cache instead (StatusPartitions.bucket_cache).
+    :param utilization_collection: optional collection for the running utilization sums per station-hour (buckets only),
+                                   they are updated once the measurements are written into the buckets
+    :param recent_cache: optional RecentStatusCache, measurements that were already written recently are skipped
+    :param partitions: optional StatusPartitions, the buckets are written into the time partition of each measurement
+                       instead of the collection (buckets only)
+    :param utilization_cache: optional UtilizationCache with the last measurement per station, for the first delta of each hour.
+                              By default, only the measurements of this call are carried into the next hour.
+    '''
+
+    # Group the measurements per station first, per target collection if the buckets are partitioned by time
+    policy = BucketPolicy.for_collection(collection.name)
+    targets = OrderedDict()
+    pending = 0
+    batched_operations = []
+    # The running utilization sums are only maintained with a utilization collection
+    if utilization_collection == None:
+        utilization_cache = None
+    elif utilization_cache == None:
+        utilization_cache = UtilizationCache()
+    timeseries = (storage or config.STATUS_STORAGE) == 'timeseries'
+    inserts = StatusWrites(recent_cache=recent_cache)
+
+    for station in stations:
+        station_id, measurement = status_measurement(station)
+
+        # Skip duplicates, e.g. the same status delivered twice
+        if recent_cache != None and recent_cache.seen(station_id, measurement['last_reported']):
+            continue
+
+        if timeseries:
+            batched_operations.append(inserts.track(timeseries_operation(station_id, measurement), { 'station_id': station_id, 'chunk': [ measurement ] }))
+            write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True, writer=writer, tracker=inserts)
+            continue
+
+        target = collection
+        if partitions != None:
+            target = partitions.collection(measurement['ts'])
+            # Older than the retention, its partition is already dropped
+            if target == None:
+                continue
+
+        if target.name not in targets:
+            # The open buckets are cached per partition
+            target_cache = bucket_cache
+            if partitions != None and bucket_cache != None:
+                target_cache = partitions.bucket_cache(target)
+            targets[target.name] = (target, StationStatusCoalescer(expire_after=config.STATUS_EXPIRE_AFTER, bucket_cache=target_cache, policy=policy,
+                                                                   recent_cache=recent_cache, utilization_cache=utilization_cache,
+                                                                   utilization_collection=utilization_collection), [])
+
+        # Add to the pending measurements of the station, unless the same measurement is pending already
+        if targets[target.name][1].add(station_id, measurement):
+            pending += 1
+
+        if max_pending != None and pending >= max_pending:
+            for target, coalescer, batch in targets.values():
+                batch.extend(coalescer.drain())
+                write_batch(batch=batch, collection=target, batch_size=batch_size, full_batch_required=True, writer=writer, tracker=coalescer.tracker)
+            pending = 0
+
+    # One operation per station and bucket, no matter how many measurements arrived for the station
+    for target, coalescer, batch in targets.values():
+        for operation in coalescer.drain():
+            batch.append(operation)
+            write_batch(batch=batch, collection=target, batch_size=batch_size, full_batch_required=True, writer=writer, tracker=coalescer.tracker)
+
+        # Don't forget the last batch that might not fill up the whole batch_size ;)
+        write_batch(batch=batch, collection=target, batch_size=batch_size, full_batch_required=False, writer=writer, tracker=coalescer.tracker)
+
+    write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=False, writer=writer, tracker=inserts)
+
+
+def status_measurement(station):
+    '''
+    Prepares the status of a station for pushing into the bucket.
+    Returns the station id and the measurement.
+    '''
+
+    # Remove, but remember the station id, we need it for updating later on
+    station_id = station.pop('station_id')
+
+    # Add the timestamp when the data arrived, we want a date format for better readability
+    station['ts'] = datetime.fromtimestamp(station.pop('last_updated'))
+    station['last_reported'] = datetime.fromtimestamp(station['last_reported'])
+    return station_id, station
+
+
+def timeseries_operation(station_id, measurement):
+    '''
+    A plain insert of the measurement into a time series collection, the server takes care of the buckets.
+    '''
+    measurement['station_id'] = station_id
+    return pymongo.InsertOne(measurement)
+
+
 def get_station_last_updated(collection, feed):
     '''
     Gets the last updated timestamp and ttl for the provided feed.
 
     Returns: 
-      - If feed found: { _id: "FEED", last_updated: SECONDS_SINCE_1970, ttl: TTL_IN_SECONDS }
+      - If feed found: { _id: "FEED", last_updated: SECONDS_SINCE_1970, ttl: TTL_IN_SECONDS, etag: ..., last_modified: ... }
       - If feed not found yet: { _id: "FEED", last_updated: 0, ttl: 0 }
       - None in case of errors.
     '''
 
     try:
-        result = collection.find_one({'_id': feed})
-        if result != None:
-            return result
-        else: 
-            return { '_id': feed, 'last_updated': 0, 'ttl': 0 }
+        return last_updated_result(feed, collection.find_one({'_id': feed}))
 
     except pymongo.errors.PyMongoError as e:
-        print(str(datetime.today()) + ' ERROR Fetching last updated for feed ' + feed + ' failed: ' + e)
+        print(str(datetime.today()) + ' ERROR Fetching last updated for feed ' + feed + ' failed: ' + str(e))
         return None
 
 
-def set_station_last_updated(collection, feed, last_updated):
+def last_updated_result(feed, result):
+    '''
+    The metadata of the feed as returned by get_station_last_updated, with the defaults for a feed that was never imported.
+    '''
+    if result != None:
+        return result
+    return { '_id': feed, 'last_updated': 0, 'ttl': 0 }
+
+
+def set_station_last_updated(collection, feed, last_updated, validators=None, ttl=None):
     '''
     Sets the last_updated value for the feed in the metadata collection
 
@@ -105,26 +198,52 @@ def set_station_last_updated(collection, feed, last_updated):
       - collection: Should be the metadata collection
       - feed: Feed name to be updated
       - last_updated: Last updated value in seconds since 1970
+      - validators: HTTP validators of the feed for conditional requests with the next import, see FeedClient.get_validators (optional)
+      - ttl: Seconds until the feed is expected to be updated again (optional)
     '''
 
     try:
-        result = collection.update_one({'_id': feed}, { '$set': { 'last_updated': last_updated } }, upsert=True )
+        result = collection.update_one({'_id': feed}, last_updated_update(last_updated, validators=validators, ttl=ttl), upsert=True )
         print(str(datetime.today()) + ' INFO Updated last_updated for feed ' + feed + '.')
 
     except pymongo.errors.PyMongoError as e:
-        print(str(datetime.today()) + ' ERROR Setting last updated for feed ' + feed + ' failed: ' + e)
+        print(str(datetime.today()) + ' ERROR Setting last updated for feed ' + feed + ' failed: ' + str(e))
 
 
-def write_batch(batch, collection, batch_size=100, full_batch_required=False):
+def last_updated_update(last_updated, validators=None, ttl=None):
+    '''
+    The update of the feed's metadata for set_station_last_updated, optional values are only set if they are provided.
+    The validators replace the stored ones, a validator that the feed did not send anymore is removed.
+    '''
+    values = { 'last_updated': last_updated }
+    removed = {}
+    if validators != None:
+        for name in ('etag', 'last_modified'):
+            if validators.get(name) != None:
+                values[name] = validators[name]
+            else:
+                removed[name] = ''
+    if ttl != None:
+        values['ttl'] = ttl
+
+    update = { '$set': values }
+    if len(removed) > 0:
+        update['$unset'] = removed
+    return update
+
+
+def write_batch(batch, collection, batch_size=100, full_batch_required=False, writer=None, tracker=None):
     '''
     Writes batch of pymongo Bulk operations into the provided collection.
     Full_batch_required can be used to write smaller amounts of data, e.g. the last batch that does not fill the batch_size
+    If a BulkWriter is provided, the batch is handed over to its thread pool instead of being written synchronously.
+    The writes are unordered, failed operations are retried and dropped afterwards, so they are not re-sent with the next batch.
+    A WriteTracker learns which of the operations were written, also when they are written by the BulkWriter.
     '''
 
-    if len(batch) > 0 and ((full_batch_required and len(batch) >= batch_size) or not full_batch_required):
-        try:
-            result = collection.bulk_write(batch)
-            print(str(datetime.today()) + ' Wrote ' + str(len(batch)) + ' to MongoDB (' + str(collection.name) + ').')
-            batch.clear()
-        except pymongo.errors.BulkWriteError as err:
-            print(str(datetime.today()) + ' ERROR Writing to MongoDB: ' + str(err.details))
+    if batch_due(batch, batch_size=batch_size, full_batch_required=full_batch_required):
+        if writer != None:
+            writer.submit(batch, collection=collection, tracker=tracker)
+        else:
+            write_unordered(collection, batch, tracker=tracker)
+        batch.clear()
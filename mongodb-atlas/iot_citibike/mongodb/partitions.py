@@ -0,0 +1,185 @@
+import re
+from datetime import datetime, timedelta
+
+from iot_citibike import config
+from iot_citibike.mongodb.indexes_views import ensure_indexes, ensure_views
+from iot_citibike.mongodb.coalescer import OpenBucketCache, BucketPolicy
+
+class StatusPartitions:
+    '''
+    Routes the status buckets into one collection per day or week, named after the start of the partition,
+    e.g. status_2026_10_18. Retention drops whole partitions once all of their measurements are expired,
+    instead of the TTL monitor deleting the buckets one by one while the writers insert new ones.
+    Reads fan out with $unionWith across the partitions that overlap the requested time range.
+
+    A partition is prepared (indexes, views and retention) when it is written for the first time.
+    The expired partitions are dropped every drop_interval while the measurements are routed, not only when a new
+    partition is prepared, so that a writer that runs for a long time does not keep them.
+    '''
+
+    def __init__(self, status_collection, period=None, expire_after=None, drop_interval=timedelta(minutes=10)):
+        '''
+        :param status_collection: the partitions are stored next to it, the bucket policy of the collection applies to all of them
+        :param period: 'day' or 'week', defaults to config.STATUS_PARTITIONING
+        :param expire_after: a partition is dropped once its end is this long ago, defaults to config.STATUS_EXPIRE_AFTER
+        :param drop_interval: how often collection() checks for expired partitions
+        '''
+        period = period or config.STATUS_PARTITIONING
+        if period not in [ 'day', 'week' ]:
+            raise ValueError('Unknown partitioning ' + str(period) + ', expected day or week.')
+
+        self.status_collection = status_collection
+        self.database = status_collection.database
+        self.period = period
+        self.length = timedelta(days=1 if period == 'day' else 7)
+        self.expire_after = expire_after or config.STATUS_EXPIRE_AFTER
+        self.pattern = re.compile('^' + re.escape(status_collection.name) + r'_(\d{4})_(\d{2})_(\d{2})$')
+        self.prepared = set()
+        self.bucket_caches = {}
+        self.drop_interval = drop_interval
+        self.next_drop = datetime.now()
+
+    def start(self, ts):
+        '''
+        Start of the partition of a timestamp, midnight of the day or of the monday of the week.
+        '''
+        start = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.period == 'week':
+            start -= timedelta(days=start.weekday())
+        return start
+
+    def name(self, start):
+        return self.status_collection.name + '_' + start.strftime('%Y_%m_%d')
+
+    def parse(self, name):
+        '''
+        Start of the partition with the name, None if the name is no partition of the status collection.
+        '''
+        match = self.pattern.match(name)
+        if match == None:
+            return None
+        return datetime(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+
+    def existing(self):
+        '''
+        Start and name of the existing partitions, the oldest first.
+        '''
+        partitions = []
+        for name in self.database.list_collection_names(filter={ 'name': { '$regex': self.pattern.pattern } }):
+            start = self.parse(name)
+            if start != None:
+                partitions.append((start, name))
+        return sorted(partitions)
+
+    def expired(self, start, now=None):
+        '''
+        True if all measurements of the partition are older than the retention.
+        '''
+        return start + self.length + self.expire_after <= (now or datetime.now())
+
+    def collection(self, ts):
+        '''
+        The partition for a measurement, it is prepared if it is new. None if the partition is already expired,
+        a late measurement must not recreate a dropped partition.
+        '''
+        if datetime.now() >= self.next_drop:
+            self.drop_expired()
+
+        start = self.start(ts)
+        name = self.name(start)
+        if name in self.prepared:
+            return self.database[name]
+        if self.expired(start):
+            return None
+
+        if name not in [ existing for _, existing in self.existing() ]:
+            self.prepare(self.database[name])
+        self.prepared.add(name)
+        return self.database[name]
+
+    def bucket_cache(self, partition):
+        '''
+        The OpenBucketCache of a partition, it is loaded from the partition when it is needed for the first time.
+        Each partition has its own buckets, so the open bucket of a station is kept per partition.
+        '''
+        cache = self.bucket_caches.get(partition.name)
+        if cache == None:
+            cache = OpenBucketCache(policy=BucketPolicy.for_collection(self.status_collection.name))
+            cache.load(partition)
+            self.bucket_caches[partition.name] = cache
+        return cache
+
+    def latest(self):
+        '''
+        The newest partition, e.g. to load the caches of the writers at startup. The current one if there is none yet.
+        '''
+        partitions = self.existing()
+        if len(partitions) > 0:
+            return self.database[partitions[-1][1]]
+        return self.database[self.name(self.start(datetime.now()))]
+
+    def prepare(self, partition):
+        '''
+        Creates the indexes of a new partition, points the views to the newest partitions and drops the expired ones.
+        '''
+        ensure_indexes(status_collection=partition, partitions=self)
+        ensure_views(db=self.database, partitions=self)
+        self.drop_expired()
+        print(str(datetime.today()) + ' INFO Prepared partition ' + partition.name + '.')
+
+    def drop_expired(self, now=None):
+        '''
+        Drops the partitions whose measurements are all expired. Returns the names of the dropped partitions.
+        '''
+        self.next_drop = (now or datetime.now()) + self.drop_interval
+        dropped = []
+        for start, name in self.existing():
+            if self.expired(start, now=now):
+                self.database.drop_collection(name)
+                self.prepared.discard(name)
+                self.bucket_caches.pop(name, None)
+                dropped.append(name)
+                print(str(datetime.today()) + ' INFO Dropped expired partition ' + name + '.')
+        return dropped
+
+    def overlapping(self, start=None, end=None):
+        '''
+        Names of the existing partitions with measurements between start (inclusive) and end (exclusive), the newest first.
+        The measurements are routed by their own timestamp, so a partition never has measurements outside of its time range.
+        '''
+        names = []
+        for partition_start, name in self.existing():
+            if start != None and partition_start + self.length <= start:
+                continue
+            if end != None and partition_start >= end:
+                continue
+            names.append(name)
+        names.reverse()
+        return names
+
+    def fan_out(self, pipeline, names):
+        '''
+        Extends a pipeline on one partition to the given other partitions. A leading $match is applied
+        to every partition before they are combined with $unionWith, so that each one is read through its indexes.
+        '''
+        head = pipeline[:1] if len(pipeline) > 0 and '$match' in pipeline[0] else []
+        return head + [ { '$unionWith': { 'coll': name, 'pipeline': head } } for name in names ] + pipeline[len(head):]
+
+    def view(self, pipeline):
+        '''
+        Source collection and pipeline of a view on the last hour: the newest partition and the one before it.
+        '''
+        names = [ name for _, name in self.existing() ][-2:]
+        if len(names) == 0:
+            return self.latest().name, pipeline
+        names.reverse()
+        return names[0], self.fan_out(pipeline, names[1:])
+
+    def aggregate(self, pipeline, start=None, end=None, **kwargs):
+        '''
+        Runs the pipeline across the partitions that overlap the time range, returns the cursor.
+        '''
+        names = self.overlapping(start=start, end=end)
+        if len(names) == 0:
+            return self.latest().aggregate(pipeline, **kwargs)
+        return self.database[names[0]].aggregate(self.fan_out(pipeline, names[1:]), **kwargs)
@@ -0,0 +1,201 @@
+import pymongo
+from datetime import datetime, timedelta
+
+from iot_citibike import config
+from iot_citibike.mongodb.coalescer import BucketPolicy
+from iot_citibike.mongodb.bucket_layout import decode_stage
+
+# Pre-aggregation tiers, each one is rolled up from the one before, the first one from the status collection.
+# Each tier is stored in its own collection, e.g. status_PT1M, with one document per station and window.
+TIERS = [ ('PT1M', 60), ('PT5M', 300), ('PT1H', 3600), ('PT1D', 86400) ]
+
+# Attributes of the station status that are aggregated
+FIELDS = [ 'num_bikes_available', 'num_ebikes_available', 'num_docks_available' ]
+
+def window_expression(ts, seconds):
+    '''
+    Aggregation expression with the start of the window of a timestamp, e.g. the full minute for 60 seconds.
+    '''
+    return { '$subtract': [ ts, { '$mod': [ { '$toLong': ts }, seconds * 1000 ] } ] }
+
+
+def rollup_group(seconds, prefix=None):
+    '''
+    The $group stage of a tier. Measurements are grouped by their prefix (e.g. '$status.'), windows of a lower tier
+    are grouped by their sums, counts, minimums, maximums, first and last values, so that averages stay exact.
+    '''
+    if prefix != None:
+        group = { '_id': { 'station_id': '$station_id', 'ts': window_expression(prefix + 'ts', seconds) }, 'count': { '$sum': 1 } }
+        for field in FIELDS:
+            group[field + '_sum'] = { '$sum': prefix + field }
+            group[field + '_min'] = { '$min': prefix + field }
+            group[field + '_max'] = { '$max': prefix + field }
+            group[field + '_first'] = { '$first': prefix + field }
+            group[field + '_last'] = { '$last': prefix + field }
+        return { '$group': group }
+
+    group = { '_id': { 'station_id': '$station_id', 'ts': window_expression('$ts', seconds) }, 'count': { '$sum': '$count' } }
+    for field in FIELDS:
+        group[field + '_sum'] = { '$sum': '$' + field + '_sum' }
+        group[field + '_min'] = { '$min': '$' + field + '_min' }
+        group[field + '_max'] = { '$max': '$' + field + '_max' }
+        group[field + '_first'] = { '$first': '$' + field + '_first' }
+        group[field + '_last'] = { '$last': '$' + field + '_last' }
+    return { '$group': group }
+
+
+def rollup_pipeline(seconds, into, start=None, end=None, raw=False, storage=None):
+    '''
+    Aggregation that folds the closed windows between start (inclusive) and end (exclusive) into the collection of a tier.
+    Each window is recomputed completely and replaces an existing one, so folding the same range again is harmless.
+
+    :param raw: the source is the status collection, otherwise the collection of the tier below
+    :param storage: 'buckets' or 'timeseries', defaults to config.STATUS_STORAGE
+    '''
+    time_range = {}
+    if start != None:
+        time_range['$gte'] = start
+    if end != None:
+        time_range['$lt'] = end
+
+    if raw and (storage or config.STATUS_STORAGE) == 'buckets':
+        # Only the buckets that overlap the range
+        bucket_range = {}
+        if start != None:
+            bucket_range['max_ts'] = { '$gte': start }
+        if end != None:
+            bucket_range['min_ts'] = { '$lt': end }
+        pipeline = [
+            { '$match': bucket_range },
+            # Columnar buckets are decoded into the status array
+            decode_stage(),
+            { '$unwind': '$status' },
+            { '$match': { 'status.ts': time_range } if len(time_range) > 0 else {} },
+            # first and last need the measurements in order
+            { '$sort': { 'station_id': 1, 'status.ts': 1 } },
+            rollup_group(seconds, prefix='$status.')
+        ]
+    else:
+        pipeline = [
+            { '$match': { 'ts': time_range } if len(time_range) > 0 else {} },
+            # Ensure Index Usage via this sort stage
+            { '$sort': { 'station_id': 1, 'ts': 1 } },
+            rollup_group(seconds, prefix='$' if raw else None)
+        ]
+
+    averages = { 'station_id': '$_id.station_id', 'ts': '$_id.ts' }
+    for field in FIELDS:
+        averages[field + '_avg'] = { '$divide': [ '$' + field + '_sum', '$count' ] }
+
+    pipeline += [
+        { '$addFields': averages },
+        { '$project': { '_id': 0 } },
+        { '$merge': {
+            'into': into,
+            'on': [ 'station_id', 'ts' ],
+            'whenMatched': 'replace',
+            'whenNotMatched': 'insert'
+        } }
+    ]
+    return pipeline
+
+
+class RollupEngine:
+    '''
+    Incrementally rolls the station status up into the tiers PT1M, PT5M, PT1H and PT1D.
+    Only windows that are closed are folded: a minute is closed once the newest measurement is more than grace
+    seconds after its end, a window of a higher tier once the tier below is folded up to its end.
+    How far each tier is folded is kept as watermark in the metadata collection, the watermark only moves after
+    the $merge succeeded. Reruns, e.g. after a crash between both, fold the same windows again with the same result.
+    Measurements that arrive after their window was folded are not considered anymore.
+    '''
+
+    def __init__(self, status_collection, metadata_collection, tiers=TIERS, grace=60, storage=None, partitions=None):
+        '''
+        :param status_collection: the raw measurements, the tiers are stored next to it, e.g. status_PT1M
+        :param grace: seconds the measurements of a minute may arrive late
+        :param storage: 'buckets' or 'timeseries', defaults to config.STATUS_STORAGE
+        :param partitions: optional StatusPartitions, the raw measurements are read from the partitions of the folded range
+        '''
+        self.status_collection = status_collection
+        self.metadata_collection = metadata_collection
+        self.tiers = tiers
+        self.grace = timedelta(seconds=grace)
+        self.storage = storage or config.STATUS_STORAGE
+        self.partitions = partitions
+
+    def collection(self, tier):
+        return self.status_collection.database[self.status_collection.name + '_' + tier]
+
+    def ensure_indexes(self):
+        '''
+        $merge needs a unique index on the fields that identify a window. It also serves range queries per station.
+        '''
+        for tier, seconds in self.tiers:
+            self.collection(tier).create_index([ ('station_id', pymongo.ASCENDING), ('ts', pymongo.ASCENDING) ], unique=True)
+
+    def watermark_key(self, tier):
+        return 'rollup_' + self.collection(tier).name
+
+    def get_watermark(self, tier):
+        '''
+        The end of the last folded window of the tier, None if nothing was folded yet.
+        '''
+        result = self.metadata_collection.find_one({ '_id': self.watermark_key(tier) })
+        return result['watermark'] if result != None else None
+
+    def set_watermark(self, tier, watermark):
+        self.metadata_collection.update_one({ '_id': self.watermark_key(tier) }, { '$set': { 'watermark': watermark } }, upsert=True)
+
+    def newest_measurement(self):
+        '''
+        Timestamp of the newest measurement in the status collection, None if it is empty.
+        '''
+        if self.storage == 'timeseries':
+            result = self.status_collection.find_one({}, projection={ 'ts': 1 }, sort=[ ('ts', pymongo.DESCENDING) ])
+            return result['ts'] if result != None else None
+
+        status_collection = self.partitions.latest() if self.partitions != None else self.status_collection
+        result = status_collection.find_one({}, projection={ 'max_ts': 1 }, sort=[ ('max_ts', pymongo.DESCENDING) ])
+        return result['max_ts'] if result != None else None
+
+    def run(self):
+        '''
+        Folds the closed windows of all tiers, from the lowest to the highest tier.
+        '''
+        closed_until = self.newest_measurement()
+        if closed_until == None:
+            return
+        closed_until = closed_until - self.grace
+
+        source = None
+        for tier, seconds in self.tiers:
+            # A window is closed when the source is complete up to its end
+            end = BucketPolicy('time', seconds).window_start(closed_until)
+            closed_until = self.fold(tier, seconds, source, end)
+            if closed_until == None:
+                return
+            source = tier
+
+    def fold(self, tier, seconds, source, end):
+        '''
+        Folds the windows of the tier between its watermark and end. Returns the new watermark.
+        '''
+        start = self.get_watermark(tier)
+        if start != None and start >= end:
+            return start
+
+        collection = self.status_collection if source == None else self.collection(source)
+        try:
+            pipeline = rollup_pipeline(seconds, self.collection(tier).name, start=start, end=end, raw=source == None, storage=self.storage)
+            if source == None and self.partitions != None:
+                self.partitions.aggregate(pipeline, start=start, end=end, allowDiskUse=True)
+            else:
+                collection.aggregate(pipeline, allowDiskUse=True)
+            self.set_watermark(tier, end)
+            print(str(datetime.today()) + ' INFO Rolled up ' + str(collection.name) + ' into ' + self.collection(tier).name + ' until ' + str(end) + '.')
+            return end
+
+        except pymongo.errors.PyMongoError as e:
+            print(str(datetime.today()) + ' ERROR Rolling up ' + self.collection(tier).name + ' failed: ' + str(e))
+            return None
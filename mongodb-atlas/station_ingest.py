@@ -0,0 +1,69 @@
+import os
+import sys
+import signal
+from pymongo import MongoClient
+
+from iot_citibike import config
+from iot_citibike.mongodb.indexes_views import prepare_mongodb
+from iot_citibike.citibike.registry import parse_systems, load_systems_csv, build_registry
+from iot_citibike.aio.workers import run_worker, WorkerPool
+
+### Connect to Database
+MONGO_URI = os.environ["MONGO_URI"]
+
+if MONGO_URI == None:
+	raise ValueError('No MongoDB Cluster provided. Will exit.')
+	exit(-1)
+
+### Time partitions of the status are written by station_status.py only
+if config.STATUS_PARTITIONING != 'none':
+	raise ValueError('STATUS_PARTITIONING is not supported by the asyncio ingestion. Will exit.')
+	exit(-1)
+
+### The GBFS systems to ingest, either comma separated NAME=URL pairs or a file in the format of the GBFS systems.csv.
+### The url is the auto-discovery file (gbfs.json) or the base url of the feeds. Each system is stored in the database NAME.
+GBFS_SYSTEMS = os.environ.get('GBFS_SYSTEMS', 'citibike=https://gbfs.citibikenyc.com/gbfs/gbfs.json')
+GBFS_SYSTEMS_FILE = os.environ.get('GBFS_SYSTEMS_FILE')
+GBFS_LANGUAGE = os.environ.get('GBFS_LANGUAGE', 'en')
+
+### Number of worker processes and MongoDB connections per worker
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 1))
+MONGO_POOL_SIZE = int(os.environ.get('MONGO_POOL_SIZE', 10))
+
+MIN_POLL_INTERVAL = float(os.environ.get('STATUS_MIN_POLL_INTERVAL', 5))
+MAX_POLL_INTERVAL = float(os.environ.get('STATUS_MAX_POLL_INTERVAL', 60))
+INFORMATION_POLL_INTERVAL = float(os.environ.get('INFORMATION_POLL_INTERVAL', 3600))
+
+### Import each feed once (e.g. from cron) or keep polling
+ONCE = '--once' in sys.argv
+
+### Discover the feeds of all systems
+if GBFS_SYSTEMS_FILE != None:
+    systems = load_systems_csv(GBFS_SYSTEMS_FILE)
+else:
+    systems = parse_systems(GBFS_SYSTEMS)
+registry = build_registry(systems, language=GBFS_LANGUAGE)
+
+### Ensure proper status of MongoDB, only once at startup and before the workers are forked
+sync_client = MongoClient(MONGO_URI)
+for system in registry:
+    db = sync_client[system['name']]
+    prepare_mongodb(db=db, stations_collection=db.stations, status_collection=db.status, metadata_collection=db.metadata)
+sync_client.close()
+
+options = {
+    'min_interval': MIN_POLL_INTERVAL,
+    'max_interval': MAX_POLL_INTERVAL,
+    'information_interval': INFORMATION_POLL_INTERVAL
+}
+
+if INGEST_WORKERS <= 1:
+    run_worker(MONGO_URI, registry, once=ONCE, pool_size=MONGO_POOL_SIZE, **options)
+else:
+    pool = WorkerPool(MONGO_URI, registry, workers=INGEST_WORKERS, once=ONCE, pool_size=MONGO_POOL_SIZE, **options)
+    pool.start()
+
+    ### The workers stop gracefully on SIGTERM, Ctrl+C reaches them directly
+    signal.signal(signal.SIGTERM, lambda signum, frame: pool.stop())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pool.join()
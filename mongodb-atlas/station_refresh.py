@@ -1,8 +1,12 @@
 import os
 from pymongo import MongoClient
 
-from iot_citibike.citibike.load_data import get_station_information
-from iot_citibike.mongodb.operations import prepare_mongodb, update_station_information
+from iot_citibike.citibike.load_data import stream_station_information
+from iot_citibike.citibike.feed_client import FeedClient
+from iot_citibike.mongodb.bulk_writer import BulkWriter
+from iot_citibike.mongodb.station_cache import StationHashCache
+from iot_citibike.mongodb.indexes_views import prepare_mongodb
+from iot_citibike.mongodb.operations import update_station_information, get_station_last_updated, set_station_last_updated
 
 ### Connect to Database
 MONGO_URI = os.environ["MONGO_URI"]
@@ -15,6 +19,7 @@ if MONGO_URI == None:
 mongo_client = MongoClient(MONGO_URI)
 db = mongo_client.citibike
 stations_collection = db.stations
+metadata_collection = db.metadata
 
 ### The feed to get the data
 STATION_URL = "https://gbfs.citibikenyc.com/gbfs/en/station_information.json"
@@ -22,8 +27,26 @@ STATION_URL = "https://gbfs.citibikenyc.com/gbfs/en/station_information.json"
 ### Ensure proper status of MongoDB
 prepare_mongodb(stations_collection=stations_collection)
 
-### Load station data from Citibikes
-stations = get_station_information(url=STATION_URL)
+### Only download the feed if it changed since the last import
+stations_last_updated = get_station_last_updated(collection=metadata_collection, feed=STATION_URL)
+feed_client = FeedClient()
+feed_client.remember(STATION_URL, etag=stations_last_updated.get('etag'), last_modified=stations_last_updated.get('last_modified'))
+
+### Load station data from Citibikes, it is parsed while it is downloaded
+stations = stream_station_information(url=STATION_URL, last_updated=stations_last_updated, client=feed_client)
+
+### Only new or modified stations are written, the hashes of the last stored versions are kept in the metadata
+station_cache = StationHashCache()
+if not station_cache.load_metadata(metadata_collection):
+    station_cache.load(stations_collection)
 
 ### Device Registration - Initial load and periodic refresh of stations:
-update_station_information(stations=stations, collection=stations_collection, batch_size=100)
+stations_writer = BulkWriter(stations_collection)
+update_station_information(stations=stations, collection=stations_collection, batch_size=100, writer=stations_writer, hash_cache=station_cache)
+stations_writer.close()
+station_cache.save_metadata(metadata_collection)
+
+### Write metadata about the import, if the feed was more current than the last import
+if stations.count > 0:
+    set_station_last_updated(collection=metadata_collection, feed=STATION_URL, last_updated=stations.last_updated,
+                             validators=feed_client.get_validators(STATION_URL))
@@ -0,0 +1,34 @@
+import os
+from pymongo import MongoClient
+
+from iot_citibike import config
+from iot_citibike.mongodb.rollups import RollupEngine
+from iot_citibike.mongodb.partitions import StatusPartitions
+
+### Connect to Database
+MONGO_URI = os.environ["MONGO_URI"]
+
+if MONGO_URI == None:
+	raise ValueError('No MongoDB Cluster provided. Will exit.')
+	exit(-1)
+
+### Seconds the measurements of a minute may arrive late, before the minute is rolled up
+GRACE_SECONDS = float(os.environ.get('ROLLUP_GRACE_SECONDS', 60))
+
+### Setup MongoDB connection
+mongo_client = MongoClient(MONGO_URI)
+db = mongo_client.citibike
+status_collection = db.status
+metadata_collection = db.metadata
+
+### Read the measurements from the time partitions of the status, if it is partitioned
+partitions = None
+if config.STATUS_STORAGE == 'buckets' and config.STATUS_PARTITIONING != 'none':
+    partitions = StatusPartitions(status_collection)
+
+### Roll the closed windows up into status_PT1M, status_PT5M, status_PT1H and status_PT1D
+rollups = RollupEngine(status_collection, metadata_collection, grace=GRACE_SECONDS, partitions=partitions)
+rollups.ensure_indexes()
+rollups.run()
+
+mongo_client.close()
@@ -1,9 +1,22 @@
 import os
+import sys
+import signal
+import threading
+from datetime import datetime
 from pymongo import MongoClient
 
+from iot_citibike import config
 from iot_citibike.mongodb.indexes_views import prepare_mongodb
-from iot_citibike.citibike.load_data import get_station_status
-from iot_citibike.mongodb.operations import update_station_status, get_station_last_updated
+from iot_citibike.citibike.load_data import stream_station_status
+from iot_citibike.citibike.feed_client import FeedClient
+from iot_citibike.citibike.scheduler import next_poll_delay
+from iot_citibike.mongodb.operations import write_station_status, get_station_last_updated, set_station_last_updated
+from iot_citibike.mongodb.bulk_writer import BulkWriter
+from iot_citibike.mongodb.coalescer import OpenBucketCache, BucketPolicy
+from iot_citibike.mongodb.recent_cache import RecentStatusCache
+from iot_citibike.mongodb.partitions import StatusPartitions
+from iot_citibike.mongodb.latest_status import refresh_latest_status
+from iot_citibike.mongodb.utilization import repair_utilization, UtilizationCache
 
 ### Connect to Database
 MONGO_URI = os.environ["MONGO_URI"]
@@ -12,23 +25,110 @@ if MONGO_URI == None:
 	raise ValueError('No MongoDB Cluster provided. Will exit.')
 	exit(-1)
 
+### Run once (e.g. from cron) or keep running and poll the feed according to its ttl
+DAEMON = '--daemon' in sys.argv or os.environ.get('STATUS_DAEMON', 'false').lower() == 'true'
+MIN_POLL_INTERVAL = float(os.environ.get('STATUS_MIN_POLL_INTERVAL', 5))
+MAX_POLL_INTERVAL = float(os.environ.get('STATUS_MAX_POLL_INTERVAL', 60))
+
 ### Setup MongoDB connection
 mongo_client = MongoClient(MONGO_URI)
 db = mongo_client.citibike
 status_collection = db.status
+utilization_collection = db.utilization
 metadata_collection =db.metadata
 
 ### The feed to get the data
 STATUS_URL = "https://gbfs.citibikenyc.com/gbfs/en/station_status.json"
 
-### Ensure proper status of MongoDB
-prepare_mongodb(status_collection=status_collection, metadata_collection=metadata_collection)
+### Optionally write the buckets into one collection per day or week, expired ones are dropped as a whole
+partitions = None
+if config.STATUS_STORAGE == 'buckets' and config.STATUS_PARTITIONING != 'none':
+    partitions = StatusPartitions(status_collection)
+
+### Ensure proper status of MongoDB, only once per process
+prepare_mongodb(status_collection=status_collection, metadata_collection=metadata_collection, partitions=partitions)
+
+### Remember the open bucket per station, so that the status is pushed into the buckets by _id
+### With partitions, each partition has its own cache, it is loaded when the partition is written for the first time
+bucket_cache = OpenBucketCache(policy=BucketPolicy.for_collection(status_collection.name))
+if config.STATUS_STORAGE == 'buckets' and partitions == None:
+    bucket_cache.load(status_collection)
+
+### Remember the recent measurements per station, so that a status that was already written is skipped
+recent_cache = RecentStatusCache()
+if config.STATUS_STORAGE == 'buckets':
+    recent_cache.load(status_collection if partitions == None else partitions.latest())
+
+### Remember the last measurement per station, the first delta of each hour of the running utilization sums needs it
+utilization_cache = UtilizationCache()
+if config.STATUS_STORAGE == 'buckets':
+    utilization_cache.load(utilization_collection)
 
-### Get the last import timestamp
+### Get the last import timestamp, in daemon mode it is kept in memory afterwards
 stations_last_udpated = get_station_last_updated(collection=metadata_collection, feed=STATUS_URL)
 
-### Load current status of stations
-station_status = get_station_status(url=STATUS_URL, last_updated=stations_last_udpated)
+### Only download the feed if it changed since the last import
+feed_client = FeedClient()
+feed_client.remember(STATUS_URL, etag=stations_last_udpated.get('etag'), last_modified=stations_last_udpated.get('last_modified'))
+
+### The batches are written concurrently while the feed is still read
+status_writer = BulkWriter(status_collection)
+
+def import_status():
+    '''
+    Imports the status feed once if it is more current than the last import.
+    '''
+    ### Load current status of stations, it is parsed while it is downloaded
+    station_status = stream_station_status(url=STATUS_URL, last_updated=stations_last_udpated, client=feed_client)
+
+    ### Write the current status to MongoDB
+    write_station_status(stations=station_status, collection=status_collection, batch_size=100, writer=status_writer, max_pending=100, bucket_cache=bucket_cache,
+                         utilization_collection=utilization_collection, recent_cache=recent_cache,
+                         partitions=partitions, utilization_cache=utilization_cache)
+    status_writer.flush()
+
+    if station_status.ttl != None:
+        stations_last_udpated['ttl'] = station_status.ttl
+
+    ### Write metadata about the import, if the feed was more current than the last import
+    if station_status.count > 0:
+        ### Materialize the latest status per station for v_bike_availability
+        refresh_latest_status(status_collection, partitions=partitions)
+
+        ### Recompute the utilization of station-hours that got overlapping measurements, e.g. when an import is repeated
+        repair_utilization(status_collection, utilization_collection, partitions=partitions)
+
+        stations_last_udpated['last_updated'] = station_status.last_updated
+        set_station_last_updated(collection=metadata_collection, feed=STATUS_URL, last_updated=station_status.last_updated,
+                                 validators=feed_client.get_validators(STATUS_URL), ttl=station_status.ttl)
+
+    ### Only send the validators of this download once it is imported, a failed import is downloaded again with the next poll
+    feed_client.commit(STATUS_URL)
+
+### Stop the daemon gracefully, the current import is finished first
+stopped = threading.Event()
+signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+
+while True:
+    try:
+        import_status()
+
+    except Exception as e:
+        if not DAEMON:
+            raise
+        # Keep the daemon alive, e.g. on network errors, and try again with the next poll
+        print(str(datetime.today()) + ' ERROR Importing station status failed: ' + str(e))
+
+    if not DAEMON or stopped.is_set():
+        break
+
+    delay = next_poll_delay(stations_last_udpated.get('last_updated'), stations_last_udpated.get('ttl'),
+                            min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL)
+    print(str(datetime.today()) + ' INFO Next poll of ' + STATUS_URL + ' in ' + str(round(delay, 1)) + 's.')
+    if stopped.wait(delay):
+        break
 
-### Write the current status to MongoDB
-update_station_status(station_status=station_status, collection=status_collection, metadata_collection=metadata_collection, feed=STATUS_URL, batch_size=100)
+status_writer.close()
+feed_client.close()
+mongo_client.close()
@@ -4,5 +4,5 @@ if [ -z "$MONGO_URI" ]
 then
       echo "\$MONGO_URI is empty - process will not run."
 else
-      python3 station_status.py
+      python3 station_status.py "$@"
 fi
@@ -0,0 +1,54 @@
+'''
+Routing of BulkWriter batches, runs without a MongoDB server:
+  python -m pytest tests
+'''
+import unittest
+
+import pymongo
+
+from iot_citibike.mongodb.bulk_writer import BulkWriter
+
+
+class RecordingWriter(BulkWriter):
+    '''
+    Remembers the target collection of each batch instead of writing it.
+    '''
+
+    def __init__(self, collection, **kwargs):
+        super().__init__(collection, **kwargs)
+        self.written = []
+
+    def write(self, batch, collection, tracker):
+        self.written.append((collection.name, len(batch)))
+
+
+class BulkWriterSubmitTest(unittest.TestCase):
+
+    def setUp(self):
+        # No connection is opened, the collections are only routed
+        self.client = pymongo.MongoClient('mongodb://localhost:27017', connect=False)
+        self.db = self.client['test_bulk_writer']
+        self.writer = RecordingWriter(self.db.status, max_workers=1, max_pending=2)
+
+    def tearDown(self):
+        self.writer.executor.shutdown(wait=True)
+        self.client.close()
+
+    def test_submit_to_explicit_collection(self):
+        self.writer.submit([ pymongo.InsertOne({}) ], collection=self.db.status_2026_01_01).result()
+        self.assertEqual(self.writer.written, [ ('status_2026_01_01', 1) ])
+
+    def test_submit_to_own_collection(self):
+        self.writer.submit([ pymongo.InsertOne({}), pymongo.InsertOne({}) ]).result()
+        self.assertEqual(self.writer.written, [ ('status', 2) ])
+
+    def test_slots_are_released(self):
+        # More batches than max_pending, submit() would block if a slot was not released
+        for i in range(5):
+            self.writer.submit([ pymongo.InsertOne({}) ], collection=self.db.status_2026_01_01)
+        self.writer.flush()
+        self.assertEqual(len(self.writer.written), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
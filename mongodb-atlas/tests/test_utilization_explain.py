@@ -0,0 +1,88 @@
+'''
+Checks the plan of v_avg_hourly_utilization against a MongoDB server, skipped without one:
+  MONGO_URI=mongodb://localhost:27017 python -m pytest tests
+'''
+import os
+import unittest
+from datetime import datetime, timedelta
+
+import pymongo
+
+from iot_citibike.mongodb.indexes_views import ensure_indexes, ensure_views
+from iot_citibike.mongodb.utilization import explain_avg_hourly_utilization
+
+MONGO_URI = os.environ.get("MONGO_URI")
+
+STATIONS = 20
+BUCKETS_PER_STATION = 12
+
+
+def connect():
+    if MONGO_URI == None:
+        return None
+    try:
+        client = pymongo.MongoClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+        client.admin.command('ping')
+        return client
+    except pymongo.errors.PyMongoError:
+        return None
+
+
+class AvgHourlyUtilizationExplainTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = connect()
+        if cls.client == None:
+            raise unittest.SkipTest('MONGO_URI is not set or the server is not reachable')
+        cls.db = cls.client['test_utilization_explain']
+        cls.client.drop_database(cls.db.name)
+
+        # The view filters on $$NOW of the server, the buckets end 5 minutes apart from the boundary of the last hour
+        cls.now = datetime.utcnow().replace(microsecond=0)
+        cls.db.stations.insert_many([ { '_id': station_id, 'name': str(station_id), 'capacity': 20 } for station_id in range(STATIONS) ])
+
+        # One bucket per station and 10 minutes over two hours, only the ones of the last hour are in the time range
+        buckets = []
+        for station_id in range(STATIONS):
+            for i in range(BUCKETS_PER_STATION):
+                max_ts = cls.now - timedelta(minutes=10 * i + 5)
+                measurements = [ { 'ts': max_ts - timedelta(minutes=minutes), 'num_bikes_available': (i + minutes) % 7 } for minutes in (8, 4, 0) ]
+                buckets.append({ 'station_id': station_id, 'bucket_size': len(measurements), 'min_ts': measurements[0]['ts'],
+                                 'max_ts': max_ts, 'status': measurements })
+        cls.db.status.insert_many(buckets)
+        ensure_indexes(db=cls.db, stations_collection=cls.db.stations, status_collection=cls.db.status,
+                       metadata_collection=cls.db.metadata, storage='buckets')
+        ensure_views(db=cls.db, stations_collection=cls.db.stations, status_collection=cls.db.status,
+                     metadata_collection=cls.db.metadata, storage='buckets')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.drop_database(cls.db.name)
+        cls.client.close()
+
+    def test_index_scan_on_max_ts(self):
+        summary = explain_avg_hourly_utilization(self.db.status, now=self.now)
+        self.assertIn('IXSCAN', summary['stages'])
+        self.assertTrue(any(list(index.keys()) == [ 'max_ts' ] for index in summary['indexes']), summary['indexes'])
+
+    def test_examines_only_matching_buckets(self):
+        summary = explain_avg_hourly_utilization(self.db.status, now=self.now)
+        self.assertGreater(summary['buckets'], 0)
+        self.assertLess(summary['buckets'], STATIONS * BUCKETS_PER_STATION)
+        self.assertLessEqual(summary['docs_examined'], summary['buckets'] + STATIONS)
+
+    def test_view_index_scan_on_max_ts(self):
+        # The view compares max_ts with $$NOW in $expr, the index is only used for it with MongoDB 5.0 or newer
+        summary = explain_avg_hourly_utilization(self.db.status, now=self.now, view='v_avg_hourly_utilization')
+        self.assertIn('IXSCAN', summary['stages'])
+        self.assertTrue(any(list(index.keys()) == [ 'max_ts' ] for index in summary['indexes']), summary['indexes'])
+
+    def test_view_examines_only_matching_buckets(self):
+        summary = explain_avg_hourly_utilization(self.db.status, now=self.now, view='v_avg_hourly_utilization')
+        self.assertGreater(summary['buckets'], 0)
+        self.assertLessEqual(summary['docs_examined'], summary['buckets'] + STATIONS)
+
+
+if __name__ == '__main__':
+    unittest.main()
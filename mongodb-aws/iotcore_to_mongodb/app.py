@@ -1,16 +1,18 @@
 import json
 import os
 
-from pymongo import MongoClient
-from aws_iot_mgt.device_management import get_all_things, get_status, get_station
-from iot_citibike.mongodb.operations import update_station_information, update_station_status, refresh_stations, refresh_status
+from aws_iot_mgt.device_management import get_status, get_station
+from iot_citibike.mongodb.connection import get_client
+from iot_citibike.mongodb.operations import refresh_stations, refresh_status
 
 
 def lambda_handler(event, context):
     MONGO_URI = os.environ["MONGO_URI"]
-    mongo_client = MongoClient(MONGO_URI)
-
-    db = mongo_client.citibike
+    # The client is shared by all invocations of this instance, see get_client
+    db = get_client(MONGO_URI,
+                    max_pool_size=int(os.environ.get("MONGO_MAX_POOL_SIZE", 10)),
+                    min_pool_size=int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+                    compressors=os.environ.get("MONGO_COMPRESSORS")).citibike
 
     station_data = event["state"]["reported"]
     station_status = get_status(station_data)
@@ -1,4 +1,3 @@
-import boto3
 import json
 
 
@@ -6,6 +5,9 @@ import json
 
 def get_all_things():
     #Return all data from all things
+    #boto3 is only imported when needed, the lambda iotcore_to_mongodb gets the data with the event and would load it on every cold start
+    import boto3
+
     thing = boto3.client('iot')
     shadow = boto3.client('iot-data')
     data = thing.list_things(
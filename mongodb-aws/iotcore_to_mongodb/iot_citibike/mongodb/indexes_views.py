@@ -8,13 +8,18 @@ def prepare_mongodb(db=None, stations_collection=None, status_collection=None, m
                  metadata_collection=metadata_collection)
 
 
+# Collections whose indexes were already created by this instance of the lambda, createIndexes is sent once per instance
+indexed_collections = set()
+
+
 def ensure_indexes(db=None, stations_collection=None, status_collection=None, metadata_collection=None):
-    if status_collection != None:
+    if status_collection != None and status_collection.full_name not in indexed_collections:
         # For large amounts of time series data, we could add a partial expression to only keep the open buckets per device
         status_collection.create_index([('station_id', pymongo.ASCENDING), ('bucket_size', pymongo.ASCENDING)])
         status_collection.create_index(
             [('station_id', pymongo.ASCENDING), ('min_ts', pymongo.ASCENDING), ('max_ts', pymongo.ASCENDING)])
         status_collection.create_index([('expire_on', pymongo.ASCENDING)], expireAfterSeconds=0)
+        indexed_collections.add(status_collection.full_name)
 
 
 def ensure_views(db=None, stations_collection=None, status_collection=None, metadata_collection=None):
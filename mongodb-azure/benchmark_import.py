@@ -0,0 +1,73 @@
+##########################################################################################
+#
+# This script measures how long the import of the iothub_to_mongodb Azure Function takes
+# with python -X importtime. The import is part of every cold start, it runs before the
+# first message is processed. Run it in an environment with the requirements.txt of the
+# function installed. It exits with 1 if the import takes longer than the budget.
+#
+###########################################################################################
+
+import os
+import subprocess
+import sys
+
+# Import time budget of the function in milliseconds
+IMPORT_BUDGET_MS = float(os.environ["IMPORT_BUDGET_MS"]) if "IMPORT_BUDGET_MS" in os.environ else 150
+# The import is repeated in fresh interpreters, the fastest run is reported
+IMPORT_RUNS = int(os.environ["IMPORT_RUNS"]) if "IMPORT_RUNS" in os.environ else 5
+# Number of the slowest top level imports that are listed
+IMPORT_TOP = int(os.environ["IMPORT_TOP"]) if "IMPORT_TOP" in os.environ else 10
+
+FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'iothub_to_mongodb')
+MODULE = 'process'
+
+
+def measure():
+    '''
+    Imports the function in a fresh interpreter. Returns the cumulative import time of the function and
+    the cumulative import times of the modules it imports directly, both in microseconds.
+    '''
+    result = subprocess.run([ sys.executable, '-X', 'importtime', '-c', 'import ' + MODULE ],
+        cwd=FUNCTION_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('Importing ' + MODULE + ' failed: ' + result.stderr.strip().splitlines()[-1])
+
+    # Lines look like 'import time:  self [us] | cumulative | imported package', nested imports are indented
+    # and listed before the module that imports them
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        imports.append((len(name) - len(name.lstrip()), name.strip(), int(cumulative)))
+
+    total = 0
+    direct = []
+    for index, (depth, name, cumulative) in enumerate(imports):
+        if depth == 1 and name == MODULE:
+            total = cumulative
+            # The direct imports are the ones one level deeper, right before the module
+            for child_depth, child_name, child_cumulative in reversed(imports[:index]):
+                if child_depth == 1:
+                    break
+                if child_depth == 3:
+                    direct.append((child_cumulative, child_name))
+    return total, sorted(direct, reverse=True)
+
+
+fastest = None
+for run in range(IMPORT_RUNS):
+    total, direct = measure()
+    if fastest == None or total < fastest[0]:
+        fastest = (total, direct)
+
+total, direct = fastest
+print('Import of ' + MODULE + ': ' + str(round(total / 1000, 1)) + ' ms (fastest of ' + str(IMPORT_RUNS) + ' runs, budget ' + str(IMPORT_BUDGET_MS) + ' ms)')
+for cumulative, name in direct[:IMPORT_TOP]:
+    print('  ' + str(round(cumulative / 1000, 1)).rjust(8) + ' ms  ' + name)
+
+if total / 1000 > IMPORT_BUDGET_MS:
+    print('Import time budget exceeded.')
+    sys.exit(1)
@@ -1,9 +1,8 @@
 from collections import defaultdict
-from pymongo import MongoClient
-import logging
 import json
 import os
 import azure.functions as func
+from . import connection
 from . import db_operations as operations
 from . import helper
 
@@ -27,9 +26,12 @@ def main(event: func.EventHubEvent):
 
     #messages with action == fullRefresh are split into status and station messages
     split_full_refresh_messages(grouped_messages)
-    
-    mongo_client = MongoClient(MONGO_URI)
-    db = mongo_client.citibike
+
+    #the client is shared by all invocations of this instance, see connection.get_client
+    db = connection.get_client(MONGO_URI,
+        max_pool_size=int(os.environ.get("MONGO_MAX_POOL_SIZE", 10)),
+        min_pool_size=int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        compressors=os.environ.get("MONGO_COMPRESSORS")).citibike
 
     #do bulk inserts for both types of messages
     refresh_stations(db, grouped_messages.get('refreshStation', []))
@@ -54,15 +56,16 @@ def refresh_stations(db, messages):
         return
 
     stations_collection = db.stations
+    metadata_collection = db.metadata
     #TODO: do view creation inside init script
     operations.ensure_indexes(
         db=db, stations_collection=stations_collection)
         
     #pre process station information -> convert geo information to valid geo json object
     stations = helper.preprocess_stations(messages)
-    #send bulk updates to database
+    #send bulk updates to database, only new or modified stations are written
     operations.update_station_information(
-        stations=stations, collection=stations_collection, batch_size=100)
+        stations=stations, collection=stations_collection, batch_size=100, metadata_collection=metadata_collection)
 
 
 def refresh_status(db, messages):
@@ -78,12 +81,11 @@ def refresh_status(db, messages):
     operations.ensure_indexes(
         db=db, status_collection=status_collection, metadata_collection=metadata_collection)
 
-    #find stations that should be updated based on last update
-    stations_last_updated = operations.get_station_last_updated(
-        collection=metadata_collection, feed='refreshStatus')
-    stations = helper.get_station_status_to_update(
-        messages, stations_last_updated)
+    #drop the messages that are not newer than the last stored status of their station
+    stations = operations.get_fresh_station_status(messages, metadata_collection)
+    if len(stations) == 0:
+        return
 
     #update remaining stations
     operations.update_station_status(stations=stations, collection=status_collection,
-                             metadata_collection=metadata_collection, feed='STATUS_URL', batch_size=100)
+                             metadata_collection=metadata_collection, batch_size=100)
@@ -1,22 +1,58 @@
 import requests
+import json
 import re
-from datetime import datetime, timedelta
 
 STATUS_API_ENDPOINT = "https://gbfs.citibikenyc.com/gbfs/en/station_status.json"
 STATION_API_ENDPOINT = "https://gbfs.citibikenyc.com/gbfs/en/station_information.json"
 
+# Keep-alive session and the last response per endpoint, both are reused across warm invocations of the function
+session = requests.Session()
+session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+feed_cache = {}
+
+
+def get_feed(url, timeout=20):
+    """
+    Conditional GET of a feed: the ETag and Last-Modified headers of the last response are sent
+    as If-None-Match/If-Modified-Since. If the server answers with 304 Not Modified or the
+    'last_updated' of the feed did not change, the feed is reported as unchanged.
+    Returns the decoded feed and whether it changed since the last call.
+    """
+    cached = feed_cache.get(url)
+    headers = {}
+    if cached != None and cached['etag'] != None:
+        headers['If-None-Match'] = cached['etag']
+    if cached != None and cached['last_modified'] != None:
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    response = session.get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304 and cached != None:
+        return json.loads(cached['content']), False
+
+    data = response.json()
+    changed = cached == None or data.get('last_updated') != cached['last_updated']
+    feed_cache[url] = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'last_updated': data.get('last_updated'),
+        'content': response.content
+    }
+    return data, changed
+
 
 def get_status_info(timeout=20):
     """
     Wraps public NCY citibike API 'station_status' into a function.
+    Returns no stations if the status did not change since the last call.
     Only simple structual preprocessing is included here to ensure
     all messages are independent of each other. The 'action' attribute
     is included to make it easy to distinguish messages when reading
     them from a queue later.
     """
-    response = requests.get(STATUS_API_ENDPOINT, timeout=timeout)
-    data = response.json()
+    data, changed = get_feed(STATUS_API_ENDPOINT, timeout=timeout)
     stations = {}
+    if not changed:
+        return stations
     for station in data['data']['stations']:
         station['last_updated'] = data['last_updated']
         station['action'] = 'refreshStatus' 
@@ -33,8 +69,7 @@ def get_station_info(timeout=20):
     is included to make it easy to distinguish messages when reading
     them from a queue later.
     """
-    response = requests.get(STATION_API_ENDPOINT, timeout=timeout)
-    data = response.json()
+    data, changed = get_feed(STATION_API_ENDPOINT, timeout=timeout)
     stations = {}
     for station in data['data']['stations']:
         station['action'] = 'refreshStation' 
@@ -47,6 +82,7 @@ def get_full_station_info(timeout=20):
     Wraps public NCY citibike API 'station_information' AND 
     'station_status' into a single function. The response of the status endpoint
     is stored in the attribute 'status' inside of the station_information object.
+    Only stations with a new status are returned.
     Only simple structual preprocessing is included here to ensure
     all messages are independent of each other. The 'action' attribute
     is included to make it easy to distinguish messages when reading
@@ -54,8 +90,13 @@ def get_full_station_info(timeout=20):
     """
     stations = get_station_info(timeout=timeout)
     status = get_status_info(timeout=timeout)
-    for key, station in stations.items():
-        st = status[key]
+    for key in list(stations.keys()):
+        station = stations[key]
+        st = status.get(key)
+        if st == None:
+            # No new status for this station
+            del stations[key]
+            continue
         st.pop('status', None)
         station['status'] = st
         station['station_name'] = "{0}_{1}".format(station.get("station_id", ''), re.sub('[^A-Za-z0-9]+', '', station.get('name', '')))   
@@ -1,6 +1,4 @@
-import yaml
 import os
-from flask import Request, Response
 from citibikeapi import bikeapi as api
 from gcp_iot_mgt import device_management as device_mgt
 from gcp_iot_mgt import device_communication as comm
@@ -21,6 +19,9 @@ def refresh(request):
 
 #can be used for local development - call load_env first
 def load_env(path):
+    #yaml is only needed locally, it is not imported on cold starts of the function
+    import yaml
+
     with open(path) as yaml_file:
         values = yaml.load(yaml_file, Loader=yaml.FullLoader)
         for key in values:
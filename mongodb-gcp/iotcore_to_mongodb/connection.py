@@ -0,0 +1,33 @@
+import pymongo
+from datetime import datetime
+
+# One MongoClient per instance of the function. It is created by the first invocation and reused by the warm ones
+# together with its connection pool, so only cold starts pay for the TLS handshake and the server discovery.
+mongo_client = None
+
+
+def get_client(uri, max_pool_size=None, min_pool_size=None, compressors=None):
+    '''
+    Returns the MongoClient of this instance, it is created on the first call.
+
+    Parameters:
+      - uri: python driver compatible connection string
+      - max_pool_size: max. connections per instance, an instance handles one invocation at a time, so few are enough
+      - min_pool_size: connections that are kept open while the instance is warm
+      - compressors: wire compression of the messages, e.g. 'zstd,snappy,zlib'. zlib needs no additional package
+    '''
+    global mongo_client
+
+    if mongo_client == None:
+        options = {}
+        if max_pool_size != None:
+            options['maxPoolSize'] = max_pool_size
+        if min_pool_size != None:
+            options['minPoolSize'] = min_pool_size
+        if compressors:
+            options['compressors'] = compressors
+
+        mongo_client = pymongo.MongoClient(uri, **options)
+        print(str(datetime.today()) + ' INFO Created MongoClient ' + str(options) + '.')
+
+    return mongo_client
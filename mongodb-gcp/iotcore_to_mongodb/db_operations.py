@@ -1,58 +1,212 @@
 from pymongo import InsertOne, DeleteOne, ReplaceOne
 import pymongo
 from datetime import datetime, timedelta
+import hashlib
+import time
+import json
+
+# Collections whose indexes were already created by this instance, createIndexes is sent once per instance
+indexed_collections = set()
 
 def ensure_indexes(db=None, stations_collection=None, status_collection=None, metadata_collection=None):
-    if status_collection != None:
+    if status_collection != None and status_collection.full_name not in indexed_collections:
         status_collection.create_index([ ('station_id', pymongo.ASCENDING), ('bucket_size', pymongo.ASCENDING) ])
         status_collection.create_index([ ('station_id', pymongo.ASCENDING), ('min_ts', pymongo.ASCENDING), ('max_ts', pymongo.ASCENDING)])
         status_collection.create_index([ ('expire_on', pymongo.ASCENDING) ], expireAfterSeconds=0 )
+        indexed_collections.add(status_collection.full_name)
+
+
+def station_hash(station):
+    '''
+    Content hash of a station document, independent of the order of its attributes.
+    '''
+    content = json.dumps(station, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+# Hashes of the last stored version per station, kept across warm invocations of the function
+station_hashes = None
+
+def get_changed_stations(stations, metadata_collection, key='station_hashes'):
+    '''
+    Returns only the stations that are new or differ from the last stored version, and their new hashes.
+    The hashes are cached in memory and persisted in the metadata collection, so that cold starts do not rewrite all stations.
+    The new hashes are not stored here, see set_station_hashes: only the stations that were written are remembered.
+    '''
+    global station_hashes
+
+    try:
+        if station_hashes == None:
+            result = metadata_collection.find_one({'_id': key})
+            station_hashes = result.get('hashes', {}) if result != None else {}
+
+        changed_stations = []
+        changed_hashes = {}
+        for station in stations:
+            content_hash = station_hash(station)
+            if station_hashes.get(station['_id']) != content_hash:
+                changed_stations.append(station)
+                changed_hashes[station['_id']] = content_hash
+
+        print(str(datetime.today()) + ' INFO ' + str(len(changed_stations)) + ' of ' + str(len(stations)) + ' stations changed.')
+        return changed_stations, changed_hashes
+
+    except pymongo.errors.PyMongoError as e:
+        # Better write too much than nothing
+        print(str(datetime.today()) + ' ERROR Detecting changed stations failed: ' + str(e))
+        return stations, {}
+
+def set_station_hashes(hashes, metadata_collection, key='station_hashes'):
+    '''
+    Remembers the hashes of the written stations, in memory and with a single update of the metadata collection.
+    '''
+    if len(hashes) == 0:
+        return
+
+    try:
+        metadata_collection.update_one({'_id': key}, { '$set': { 'hashes.' + str(station_id): content_hash for station_id, content_hash in hashes.items() } }, upsert=True)
+        station_hashes.update(hashes)
+        print(str(datetime.today()) + ' INFO Saved ' + str(len(hashes)) + ' station hashes.')
+
+    except pymongo.errors.PyMongoError as e:
+        print(str(datetime.today()) + ' ERROR Saving station hashes failed: ' + str(e))
+
+# Newest last_updated per station that is already stored, kept across warm invocations of the function
+station_watermarks = None
+
+def get_station_watermarks(metadata_collection, key='station_watermarks'):
+    '''
+    Returns the watermarks per station, they are loaded from the metadata collection on cold starts.
+    '''
+    global station_watermarks
+
+    if station_watermarks == None:
+        try:
+            result = metadata_collection.find_one({'_id': key})
+            station_watermarks = result.get('watermarks', {}) if result != None else {}
 
+        except pymongo.errors.PyMongoError as e:
+            # Better write too much than nothing, the next invocation tries again
+            print(str(datetime.today()) + ' ERROR Loading station watermarks failed: ' + str(e))
+            return {}
 
-def get_station_last_updated(collection, feed):
+    return station_watermarks
+
+
+def get_fresh_station_status(stations, metadata_collection, key='station_watermarks'):
     '''
-    Gets the last updated timestamp and ttl for the provided feed.
+    Returns only the status messages that are newer than the last stored status of their station.
+    Stale messages, e.g. replayed or redelivered ones, are dropped before any write. As every station has its own
+    watermark, the fresh stations of a mixed batch get through.
+    '''
+    watermarks = get_station_watermarks(metadata_collection, key=key)
+
+    fresh_stations = []
+    seen = set()
+    for station in stations:
+        if 'station_id' not in station or 'last_updated' not in station:
+            print(str(datetime.today()) + ' ERROR Station Status is not provided in the correct format. "station_id" or "last_updated" is missing.')
+            continue
+
+        # Several messages of a station in one batch are fine, as long as they are not the same
+        station_key = (str(station['station_id']), station['last_updated'])
+        if station['last_updated'] <= watermarks.get(station_key[0], 0) or station_key in seen:
+            continue
+
+        seen.add(station_key)
+        fresh_stations.append(station)
+
+    print(str(datetime.today()) + ' INFO ' + str(len(fresh_stations)) + ' of ' + str(len(stations)) + ' station status are new.')
+    return fresh_stations
 
-    Returns: 
-      - If feed found: { _id: "FEED", last_updated: SECONDS_SINCE_1970, ttl: TTL_IN_SECONDS }
-      - If feed not found yet: { _id: "FEED", last_updated: 0, ttl: 0 }
-      - None in case of errors.
+
+def set_station_watermarks(watermarks, metadata_collection, key='station_watermarks'):
+    '''
+    Moves the watermarks of the written stations forward, in memory and with a single update of the metadata collection.
+    $max keeps the newest watermark when several instances of the function write at the same time.
+    The in-memory watermarks are only moved once the metadata collection is updated, otherwise the next invocation
+    would reject the redelivered status of a station as stale, although it was never stored.
     '''
+    if len(watermarks) == 0:
+        return
 
     try:
-        result = collection.find_one({'_id': feed})
-        if result != None:
-            return result
-        else: 
-            return { '_id': feed, 'last_updated': 0, 'ttl': 0 }
+        metadata_collection.update_one({'_id': key}, { '$max': { 'watermarks.' + station_id: last_updated for station_id, last_updated in watermarks.items() } }, upsert=True)
+        watermarks_in_memory = get_station_watermarks(metadata_collection, key=key)
+        for station_id, last_updated in watermarks.items():
+            watermarks_in_memory[station_id] = max(watermarks_in_memory.get(station_id, 0), last_updated)
+        print(str(datetime.today()) + ' INFO Updated the watermarks of ' + str(len(watermarks)) + ' stations.')
 
     except pymongo.errors.PyMongoError as e:
-        print(str(datetime.today()) + ' ERROR Fetching last updated for feed ' + feed + ' failed: ' + e)
-        return None
+        print(str(datetime.today()) + ' ERROR Setting station watermarks failed: ' + str(e))
 
-def update_station_information(stations, collection, batch_size=100):
+
+def update_station_information(stations, collection, batch_size=100, metadata_collection=None):
     '''
     Bulk replace citi bike stations in MongoDB. New stations will be added automatically, changes in stations will be replaced.
+    If a metadata collection is provided, stations that did not change since the last stored version are skipped.
+    Their hashes are only stored once they are written, a dropped station is written again with the next invocation.
     '''
 
+    hashes = {}
+    if metadata_collection != None:
+        stations, hashes = get_changed_stations(stations, metadata_collection)
+
     batched_operations = []
+    station_ids = {}
+    dropped = []
     for station in stations:
-        batched_operations.append(pymongo.ReplaceOne(
+        operation = pymongo.ReplaceOne(
             { '_id': station['_id'] },
             station,
-            upsert=True))
-        write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True)
+            upsert=True)
+        station_ids[id(operation)] = station['_id']
+        batched_operations.append(operation)
+        dropped.extend(write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True))
 
     # Don't forget the last batch that might not fill up the whole batch_size ;)
-    write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=False)
+    dropped.extend(write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=False))
 
+    if metadata_collection != None:
+        for operation in dropped:
+            hashes.pop(station_ids[id(operation)], None)
+        set_station_hashes(hashes, metadata_collection)
 
-def update_station_status(stations, collection, metadata_collection, feed, batch_size=100):
+
+def ordered_insert(measurement):
+    '''
+    Aggregation expression for a pipeline update that adds the measurement to the status array of a bucket.
+    It is appended if it is not older than the max_ts of the bucket, only a late measurement is inserted at the
+    position of its ts. Unlike $push with $sort, a measurement in order does not sort the whole array.
+    '''
+    status = { '$ifNull': [ '$status', [] ] }
+    return {
+        '$cond': [
+            { '$lte': [ { '$ifNull': [ '$max_ts', measurement['ts'] ] }, measurement['ts'] ] },
+            { '$concatArrays': [ status, [ { '$literal': measurement } ] ] },
+            { '$let': {
+                # The number of measurements up to the ts of this one, i.e. its position in the ordered array
+                'vars': { 'position': { '$size': { '$filter': { 'input': status, 'as': 'status', 'cond': { '$lte': [ '$$status.ts', measurement['ts'] ] } } } } },
+                'in': { '$concatArrays': [
+                    { '$cond': [ { '$gt': [ '$$position', 0 ] }, { '$slice': [ status, '$$position' ] }, [] ] },
+                    [ { '$literal': measurement } ],
+                    { '$slice': [ status, '$$position', { '$max': [ { '$size': status }, 1 ] } ] }
+                ] }
+            } }
+        ]
+    }
+
+
+def update_station_status(stations, collection, metadata_collection, batch_size=100):
     '''
     Iterate over the stations and push the values into buckets.
+    The watermarks of the stations are moved forward afterwards, see get_fresh_station_status. Only the written status
+    count, a station is not moved past a dropped status, so its next delivery is written instead of rejected as stale.
     '''
 
     batched_operations = []
+    updates = []
+    dropped = []
 
     for station in stations:
 
@@ -65,7 +219,7 @@ def update_station_status(stations, collection, metadata_collection, feed, batch
         station['last_reported'] = datetime.fromtimestamp(station['last_reported'])
 
         # Add to the batch
-        batched_operations.append(pymongo.UpdateOne(
+        operation = pymongo.UpdateOne(
             {
                 # The station for which we add data
                 'station_id': station_id,
@@ -73,65 +227,104 @@ def update_station_status(stations, collection, metadata_collection, feed, batch
                 # We expect to execute the loader every 30 seconds, so roughly one hour will be stored in one bucket
                 'bucket_size': { '$lt': 120 }
             },
-            {
-                # Add the new measurement to the bucket
-                '$push': { 
-                    'status': station
-                },
+            [ { '$set': {
+                # Add the new measurement to the bucket, ordered by ts. Replayed or redelivered messages arrive late,
+                # the status array stays ordered anyway, e.g. its last element is always the latest measurement.
+                'status': ordered_insert(station),
 
                 # Set the max value for the max timestamp of the document
                 # Set the max value for the TTL index
-                '$max': { 
-                    'max_ts': station['ts'], 
-                    'expire_on': station['ts'] + timedelta(days=3) 
-                },
+                'max_ts': { '$max': [ '$max_ts', station['ts'] ] },
+                'expire_on': { '$max': [ '$expire_on', station['ts'] + timedelta(days=3) ] },
 
                 # Set the min value for the min timestamp of the docuemnt
-                '$min': { 'min_ts': station['ts'] },
+                'min_ts': { '$min': [ '$min_ts', station['ts'] ] },
 
                 # Increase the bucket size counter by one
-                '$inc': { 'bucket_size': 1 }
-            },
-            upsert=True))
+                'bucket_size': { '$add': [ { '$ifNull': [ '$bucket_size', 0 ] }, 1 ] }
+            } } ],
+            upsert=True)
+        # The operations are kept until the watermarks are set, so their ids stay unique
+        updates.append((operation, str(station_id), station['last_updated']))
+        batched_operations.append(operation)
 
-        write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True)
+        dropped.extend(write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=True))
 
     # Don't forget the last batch that might not fill up the whole batch_size ;)
-    write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=False)
+    dropped.extend(write_batch(batch=batched_operations, collection=collection, batch_size=batch_size, full_batch_required=False))
     
-    # Write metadata about the import
-    set_station_last_updated(collection=metadata_collection, feed=feed, last_updated=stations[0]['last_updated'])
+    # Write the watermarks of all stations at once
+    set_station_watermarks(written_watermarks(updates, dropped), metadata_collection)
 
 
-def write_batch(batch, collection, batch_size=100, full_batch_required=False):
+def written_watermarks(updates, dropped):
     '''
-    Writes batch of pymongo Bulk operations into the provided collection.
-    Full_batch_required can be used to write smaller amounts of data, e.g. the last batch that does not fill the batch_size
+    Newest last_updated per station of the written status updates, given the (operation, station_id, last_updated) of
+    all updates and the operations that could not be written. A station is only moved up to its oldest dropped status.
     '''
+    dropped_ids = set(id(operation) for operation in dropped)
+    oldest_dropped = {}
+    for operation, station_id, last_updated in updates:
+        if id(operation) in dropped_ids:
+            oldest_dropped[station_id] = min(oldest_dropped.get(station_id, last_updated), last_updated)
 
-    if len(batch) > 0 and ((full_batch_required and len(batch) >= batch_size) or not full_batch_required):
-        try:
-            result = collection.bulk_write(batch)
-            print(str(datetime.today()) + ' Wrote ' + str(len(batch)) + ' to MongoDB (' + str(collection.name) + ').')
-            batch.clear()
-        except pymongo.errors.BulkWriteError as err:
-            print(str(datetime.today()) + ' ERROR Writing to MongoDB: ' + str(err.details))
+    watermarks = {}
+    for operation, station_id, last_updated in updates:
+        if id(operation) in dropped_ids or (station_id in oldest_dropped and last_updated >= oldest_dropped[station_id]):
+            continue
+        watermarks[station_id] = max(watermarks.get(station_id, 0), last_updated)
+    return watermarks
 
 
-def set_station_last_updated(collection, feed, last_updated):
+def write_batch(batch, collection, batch_size=100, full_batch_required=False, max_retries=3):
     '''
-    Sets the last_updated value for the feed in the metadata collection
-
-    Parameters:
-      - collection: Should be the metadata collection
-      - feed: Feed name to be updated
-      - last_updated: Last updated value in seconds since 1970
+    Writes batch of pymongo Bulk operations into the provided collection.
+    Full_batch_required can be used to write smaller amounts of data, e.g. the last batch that does not fill the batch_size
+    The writes are unordered, only the failed operations are retried with a linear backoff. Operations that fail with
+    a duplicate key error, e.g. conflicting upserts of concurrent invocations, are retried once. Operations that still
+    fail afterwards are dropped, so they are not re-sent with the next batch. Returns the operations that were not written.
     '''
 
-    try:
-        result = collection.update_one({'_id': feed}, { '$set': { 'last_updated': last_updated } }, upsert=True )
-        print(str(datetime.today()) + ' INFO Updated last_updated for feed ' + feed + '.')
+    if len(batch) > 0 and ((full_batch_required and len(batch) >= batch_size) or not full_batch_required):
+        pending = list(batch)
+        written = 0
+        dropped = []
+        retried = set()
+        attempt = 0
+        while len(pending) > 0:
+            failed = []
+            try:
+                collection.bulk_write(pending, ordered=False)
+                written += len(pending)
+            except pymongo.errors.BulkWriteError as err:
+                print(str(datetime.today()) + ' ERROR Writing to MongoDB: ' + str(err.details['writeErrors'][:3]))
+                # The indices refer to the list we have sent, all other operations succeeded
+                errors = { error['index']: error for error in err.details['writeErrors'] }
+                written += len(pending) - len(errors)
+                for index in sorted(errors):
+                    operation = pending[index]
+                    if errors[index].get('code') == 11000:
+                        if id(operation) in retried:
+                            dropped.append(operation)
+                            continue
+                        retried.add(id(operation))
+                    failed.append(operation)
+            except pymongo.errors.PyMongoError as err:
+                # No details about single operations available, e.g. network errors. Retry everything.
+                print(str(datetime.today()) + ' ERROR Writing to MongoDB: ' + str(err))
+                failed = pending
 
-    except pymongo.errors.PyMongoError as e:
-        print(str(datetime.today()) + ' ERROR Setting last updated for feed ' + feed + ' failed: ' + e)
+            if attempt >= max_retries:
+                dropped.extend(failed)
+                break
+            pending = failed
+            if len(pending) > 0:
+                attempt += 1
+                time.sleep(0.1 * attempt)
 
+        print(str(datetime.today()) + ' Wrote ' + str(written) + ' to MongoDB (' + str(collection.name) + ').')
+        if len(dropped) > 0:
+            print(str(datetime.today()) + ' ERROR Dropped ' + str(len(dropped)) + ' operations for ' + str(collection.name) + '.')
+        batch.clear()
+        return dropped
+    return []
@@ -1,10 +1,9 @@
 import base64
 import os
-import yaml
 import json
 from collections import defaultdict
-from pymongo import MongoClient
 import helper
+import connection
 import db_operations as operations
 
 def process(event, context):
@@ -14,9 +13,12 @@ def process(event, context):
     MONGO_URI = os.environ["MONGO_URI"]
     if MONGO_URI == None:
         raise ValueError('No MongoDB Cluster provided. Will exit.')
-    
-    mongo_client = MongoClient(MONGO_URI)
-    db = mongo_client.citibike
+
+    #the client is shared by all invocations of this instance, see connection.get_client
+    db = connection.get_client(MONGO_URI,
+        max_pool_size=int(os.environ.get("MONGO_MAX_POOL_SIZE", 10)),
+        min_pool_size=int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        compressors=os.environ.get("MONGO_COMPRESSORS")).citibike
 
     #read messages from event and group them by action
     message_str = base64.b64decode(event['data']).decode('utf-8')
@@ -54,15 +56,16 @@ def refresh_stations(db, messages):
         return
 
     stations_collection = db.stations
+    metadata_collection = db.metadata
 
     operations.ensure_indexes(
         db=db, stations_collection=stations_collection)
 
     #pre process station information -> convert geo information to valid geo json object
     stations = helper.preprocess_stations(messages)
-    #send bulk updates to database
+    #send bulk updates to database, only new or modified stations are written
     operations.update_station_information(
-        stations=stations, collection=stations_collection, batch_size=100)
+        stations=stations, collection=stations_collection, batch_size=100, metadata_collection=metadata_collection)
 
 
 def refresh_status(db, messages):
@@ -77,17 +80,20 @@ def refresh_status(db, messages):
     operations.ensure_indexes(
         db=db, status_collection=status_collection, metadata_collection=metadata_collection)
     
-    #find stations that should be updated based on last update
-    stations_last_updated = operations.get_station_last_updated(
-        collection=metadata_collection, feed='refreshStatus')
-    stations = helper.get_station_status_to_update(
-        messages, stations_last_updated)
-    
+    #drop the messages that are not newer than the last stored status of their station
+    stations = operations.get_fresh_station_status(messages, metadata_collection)
+    if len(stations) == 0:
+        return
+
     #update remaining stations
     operations.update_station_status(stations=stations, collection=status_collection,
-                             metadata_collection=metadata_collection, feed='STATUS_URL', batch_size=100)
+                             metadata_collection=metadata_collection, batch_size=100)
 
+#can be used for local development - call load_env first
 def load_env(path):
+    #yaml is only needed locally, it is not imported on cold starts of the function
+    import yaml
+
     with open(path) as yaml_file:
         values = yaml.load(yaml_file, Loader=yaml.FullLoader)
         for key in values:
@@ -1,15 +1,28 @@
 import requests
 
-def get_station_information(url, timeout = 20):
+# Optional: ijson parses the feeds incrementally while they are downloaded.
+# Without it, the feeds are parsed as a whole.
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+def get_station_information(url, timeout = 20, client=None):
     '''
     Function to access the Station Endpoint of citibike api
     replaces station_id with _id in each station object, provides a GeoJSON representation of lon/lat
     
     :param url: url to the citibike station endpoint
     :param timeout: when does the call time out?
-    :return: object with stations (array)
+    :param client: optional FeedClient for conditional requests on a keep-alive session
+    :return: object with stations (array), empty if the feed was not modified since the last request of the client
     '''
-    response = requests.get(url, timeout=timeout)
+    if client != None:
+        response = client.get(url, timeout=timeout)
+        if response == None:
+            return []
+    else:
+        response = requests.get(url, timeout=timeout)
     data = response.json()
 
     if not 'data' in data:
@@ -21,21 +34,34 @@ def get_station_information(url, timeout = 20):
 
     stations = data['data']['stations']
     for station in stations:
-        station['_id'] = station.pop('station_id')
-        station['geometry'] = {'type': 'Point',
-                               'coordinates': [ station.pop('lon'), station.pop('lat') ] }
+        transform_station(station)
 
     return data['data']['stations']
 
-def get_station_status(url, last_updated=None):
+def transform_station(station):
+    '''
+    Replaces station_id with _id and provides a GeoJSON representation of lon/lat
+    '''
+    station['_id'] = station.pop('station_id')
+    station['geometry'] = {'type': 'Point',
+                           'coordinates': [ station.pop('lon'), station.pop('lat') ] }
+    return station
+
+def get_station_status(url, last_updated=None, client=None):
     '''
     Function to return the station status
 
     :param url: url to station status endpoint
+    :param client: optional FeedClient for conditional requests on a keep-alive session
     :return: array of status for all stations if feed provides more current data than the last import, None otherwise
     '''
     try:
-        response = requests.get(url, timeout=20)
+        if client != None:
+            response = client.get(url, timeout=20)
+            if response == None:
+                return None
+        else:
+            response = requests.get(url, timeout=20)
         feed_data = response.json()
         
         if 'data' not in feed_data:
@@ -54,4 +80,141 @@ def get_station_status(url, last_updated=None):
         
     except ValueError as e:
         print(e)
-        
\ No newline at end of file
+
+
+class FeedStream:
+    '''
+    Iterates over the stations (data.stations[]) of a GBFS feed while the feed is still downloaded.
+    Neither the raw feed nor the decoded feed are kept in memory as a whole, so the stations can be
+    written to MongoDB before the download finished.
+    The feed level attributes last_updated and ttl are available as soon as they have been parsed.
+
+    If last_updated is provided and the feed is not more current, the iteration stops and the rest of the feed is not downloaded.
+    Each station gets the last_updated of the feed. As the feed does not guarantee that last_updated is sent before the stations,
+    stations are buffered until it is known.
+    '''
+
+    def __init__(self, url, timeout=20, last_updated=None, transform=None, add_last_updated=True, client=None):
+        '''
+        :param url: url to the GBFS feed
+        :param timeout: when does the call time out?
+        :param client: optional FeedClient for conditional requests on a keep-alive session
+        :param last_updated: result of get_station_last_updated, only more current feeds are returned
+        :param transform: function that is applied to each station
+        :param add_last_updated: add the last_updated of the feed to each station?
+        '''
+        self.url = url
+        self.timeout = timeout
+        self.min_last_updated = last_updated['last_updated'] if last_updated != None else None
+        self.transform = transform
+        self.add_last_updated = add_last_updated
+        self.client = client
+        self.not_modified = False
+        self.last_updated = None
+        self.ttl = None
+        self.count = 0
+
+    def __iter__(self):
+        if self.client != None:
+            response = self.client.get(self.url, stream=True, timeout=self.timeout)
+            # 304 Not Modified, nothing to do
+            if response == None:
+                self.not_modified = True
+                return
+        else:
+            response = requests.get(self.url, timeout=self.timeout, stream=True)
+
+        try:
+            buffered = []
+            for kind, value in self.parse(response):
+                if kind == 'last_updated':
+                    self.last_updated = value
+                    if not self.is_current():
+                        return
+                    for station in buffered:
+                        yield self.prepare(station)
+                    buffered = []
+                elif kind == 'ttl':
+                    self.ttl = value
+                elif self.last_updated == None:
+                    buffered.append(value)
+                else:
+                    yield self.prepare(value)
+
+            if self.last_updated == None and len(buffered) > 0:
+                raise ValueError('Incorrect Format of feed ' + self.url + ': Missing "last_updated".')
+
+        finally:
+            response.close()
+
+    def is_current(self):
+        return self.min_last_updated == None or self.last_updated > self.min_last_updated
+
+    def prepare(self, station):
+        self.count += 1
+        if self.add_last_updated:
+            station['last_updated'] = self.last_updated
+        if self.transform != None:
+            station = self.transform(station)
+        return station
+
+    def parse(self, response):
+        '''
+        Yields ('last_updated', value), ('ttl', value) and ('station', station) in the order they appear in the feed.
+        '''
+        if ijson == None:
+            yield from self.parse_data(response.json())
+            return
+
+        # Let urllib3 decompress gzip encoded responses for us
+        response.raw.decode_content = True
+
+        builder = None
+        for prefix, event, value in ijson.parse(response.raw, use_float=True):
+            if prefix == 'last_updated' or prefix == 'ttl':
+                yield prefix, value
+            elif prefix.startswith('data.stations.item'):
+                if builder == None:
+                    builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                # The station object is complete
+                if prefix == 'data.stations.item' and event == 'end_map':
+                    yield 'station', builder.value
+                    builder = None
+
+    def parse_data(self, data):
+        '''
+        Same as parse(), but for a feed that has been decoded as a whole.
+        '''
+        if 'last_updated' in data:
+            yield 'last_updated', data['last_updated']
+        if 'ttl' in data:
+            yield 'ttl', data['ttl']
+        if not 'data' in data or not 'stations' in data['data']:
+            raise ValueError('Incorrect Format of feed ' + self.url + ': Missing "data.stations".')
+        for station in data['data']['stations']:
+            yield 'station', station
+
+
+def stream_station_information(url, last_updated=None, timeout=20, client=None):
+    '''
+    Streaming variant of get_station_information.
+
+    :param url: url to the citibike station endpoint
+    :param last_updated: result of get_station_last_updated, only more current feeds are returned
+    :param timeout: when does the call time out?
+    :param client: optional FeedClient for conditional requests on a keep-alive session
+    :return: FeedStream that yields the stations in the format of get_station_information
+    '''
+    return FeedStream(url, timeout=timeout, last_updated=last_updated, transform=transform_station, add_last_updated=False, client=client)
+
+def stream_station_status(url, last_updated=None, timeout=20, client=None):
+    '''
+    Streaming variant of get_station_status.
+
+    :param url: url to station status endpoint
+    :param last_updated: result of get_station_last_updated, only more current feeds are returned
+    :param client: optional FeedClient for conditional requests on a keep-alive session
+    :return: FeedStream that yields the status of all stations incl. the last_updated of the feed, nothing if the feed is not more current
+    '''
+    return FeedStream(url, timeout=timeout, last_updated=last_updated, client=client)
@@ -0,0 +1,178 @@
+from iot_citibike import config
+
+# Layouts of the measurements within a bucket:
+#   rows:    status is an array of measurements, every measurement repeats all attribute names
+#            { status: [ { ts: ..., num_bikes_available: 3, ... }, { ts: ..., num_bikes_available: 4, ... } ] }
+#   columns: one array per attribute, the attribute names are stored only once per bucket
+#            { columns: { ts: [ ..., ... ], num_bikes_available: [ 3, 4 ], ..., other: [ null, { ... } ] } }
+#            All columns of a bucket have the same length, missing attributes are stored as null.
+
+# Attributes of a station status (GBFS) that get their own column in the columnar layout.
+# All other attributes of a measurement are kept in the column 'other'.
+COLUMNS = [
+    'ts',
+    'last_reported',
+    'num_bikes_available',
+    'num_ebikes_available',
+    'num_bikes_disabled',
+    'num_docks_available',
+    'num_docks_disabled',
+    'is_installed',
+    'is_renting',
+    'is_returning',
+    'station_status',
+    'eightd_has_available_keys'
+]
+
+def is_columnar(layout=None):
+    return (layout or config.STATUS_LAYOUT) == 'columns'
+
+
+def columns_push(chunk):
+    '''
+    The $push part of a bucket update that appends the chunk of measurements to the columns.
+    '''
+    push = {}
+    for column in COLUMNS:
+        push['columns.' + column] = { '$each': [ measurement.get(column) for measurement in chunk ] }
+
+    others = []
+    for measurement in chunk:
+        other = { key: value for key, value in measurement.items() if key not in COLUMNS }
+        others.append(other if len(other) > 0 else None)
+    push['columns.other'] = { '$each': others }
+    return push
+
+
+def columns_insert(chunk):
+    '''
+    Aggregation expression for a pipeline update that inserts the chunk of measurements (ordered by ts) into the
+    columns of a bucket, each one at the position of its ts. Unlike columns_push, the columns stay ordered by ts
+    if the chunk contains late measurements. The parallel columns can't be sorted with the modifiers of $push.
+    '''
+    rows = []
+    for measurement in chunk:
+        row = { column: measurement.get(column) for column in COLUMNS }
+        other = { key: value for key, value in measurement.items() if key not in COLUMNS }
+        row['other'] = other if len(other) > 0 else None
+        rows.append(row)
+
+    columns = COLUMNS + [ 'other' ]
+    return {
+        '$reduce': {
+            'input': { '$literal': rows },
+            'initialValue': { column: { '$ifNull': [ '$columns.' + column, [] ] } for column in columns },
+            'in': {
+                '$let': {
+                    # The number of measurements up to the ts of this one, i.e. its position in the ordered columns
+                    'vars': { 'position': { '$size': { '$filter': { 'input': '$$value.ts', 'as': 'ts', 'cond': { '$lte': [ '$$ts', '$$this.ts' ] } } } } },
+                    'in': { column: { '$concatArrays': [
+                        { '$cond': [ { '$gt': [ '$$position', 0 ] }, { '$slice': [ '$$value.' + column, '$$position' ] }, [] ] },
+                        [ '$$this.' + column ],
+                        { '$slice': [ '$$value.' + column, '$$position', { '$max': [ { '$size': '$$value.' + column }, 1 ] } ] }
+                    ] } for column in columns }
+                }
+            }
+        }
+    }
+
+
+def rows_insert(chunk):
+    '''
+    Aggregation expression for a pipeline update that adds the chunk of measurements (ordered by ts) to the status
+    array of a bucket. The chunk is appended if it starts at or after the max_ts of the bucket, only late measurements
+    are inserted at the position of their ts. Unlike $push with $sort, a chunk in order does not sort the whole array.
+    '''
+    min_ts = chunk[0]['ts']
+    status = { '$ifNull': [ '$status', [] ] }
+    return {
+        '$cond': [
+            { '$lte': [ { '$ifNull': [ '$max_ts', min_ts ] }, min_ts ] },
+            { '$concatArrays': [ status, { '$literal': chunk } ] },
+            { '$reduce': {
+                'input': { '$literal': chunk },
+                'initialValue': status,
+                'in': {
+                    '$let': {
+                        # The number of measurements up to the ts of this one, i.e. its position in the ordered array
+                        'vars': { 'position': { '$size': { '$filter': { 'input': '$$value', 'as': 'status', 'cond': { '$lte': [ '$$status.ts', '$$this.ts' ] } } } } },
+                        'in': { '$concatArrays': [
+                            { '$cond': [ { '$gt': [ '$$position', 0 ] }, { '$slice': [ '$$value', '$$position' ] }, [] ] },
+                            [ '$$this' ],
+                            { '$slice': [ '$$value', '$$position', { '$max': [ { '$size': '$$value' }, 1 ] } ] }
+                        ] }
+                    }
+                }
+            } }
+        ]
+    }
+
+
+def decode_bucket(bucket):
+    '''
+    Returns the measurements of a bucket in either layout as list of documents, e.g. for reading buckets in python.
+    '''
+    if not 'columns' in bucket:
+        return bucket.get('status', [])
+
+    columns = bucket['columns']
+    measurements = []
+    for i in range(len(columns.get('ts', []))):
+        measurement = { column: columns[column][i] for column in COLUMNS if column in columns and columns[column][i] != None }
+        other = columns.get('other', [])
+        if i < len(other) and other[i] != None:
+            measurement.update(other[i])
+        measurements.append(measurement)
+    return measurements
+
+
+def status_expression():
+    '''
+    Aggregation expression that returns the measurements of a bucket in either layout as array of documents,
+    i.e. what the status attribute contains in the rows layout.
+    '''
+    return {
+        '$cond': [
+            { '$isArray': '$columns.ts' },
+            { '$map': {
+                'input': { '$range': [ 0, { '$size': '$columns.ts' } ] },
+                'as': 'i',
+                'in': { '$mergeObjects': [
+                    { column: { '$arrayElemAt': [ '$columns.' + column, '$$i' ] } for column in COLUMNS },
+                    { '$ifNull': [ { '$arrayElemAt': [ '$columns.other', '$$i' ] }, {} ] }
+                ] }
+            } },
+            '$status'
+        ]
+    }
+
+
+def decode_stage():
+    '''
+    Pipeline stage that decodes columnar buckets into the status array of the rows layout.
+    '''
+    return { '$addFields': { 'status': status_expression() } }
+
+
+def column_expression(column):
+    '''
+    Aggregation expression with the values of one attribute of a bucket in either layout,
+    e.g. for reading a single attribute without decoding the whole bucket.
+    '''
+    return { '$ifNull': [ '$columns.' + column, '$status.' + column ] }
+
+
+def last_status_expression():
+    '''
+    Aggregation expression with the last measurement of a bucket in either layout, without decoding the whole bucket.
+    '''
+    return {
+        '$cond': [
+            { '$isArray': '$columns.ts' },
+            { '$mergeObjects': [
+                { column: { '$arrayElemAt': [ '$columns.' + column, -1 ] } for column in COLUMNS },
+                { '$ifNull': [ { '$arrayElemAt': [ '$columns.other', -1 ] }, {} ] }
+            ] },
+            { '$arrayElemAt': [ '$status', -1 ] }
+        ]
+    }
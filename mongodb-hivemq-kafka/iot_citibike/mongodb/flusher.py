@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+from datetime import datetime
+
+class BatchFlusher:
+    '''
+    Collects items on a dedicated thread and hands them over in batches to a flush function.
+    A batch is flushed as soon as one of the limits is reached:
+      - max_batch: number of items
+      - max_latency: seconds since the first item of the batch arrived
+      - max_bytes: accumulated size of the items
+    The queue in front of the thread is bounded, put() blocks if the flush function cannot keep up (backpressure).
+    '''
+
+    def __init__(self, flush, max_batch=500, max_latency=0.5, max_bytes=1024*1024, max_queue=10000, name='flusher'):
+        '''
+        :param flush: function that gets a list of items, e.g. to write them to MongoDB
+        :param max_batch: maximum number of items per batch
+        :param max_latency: maximum time in seconds an item waits for its batch to be flushed
+        :param max_bytes: maximum accumulated size of the items per batch
+        :param max_queue: maximum number of items waiting for the flusher thread
+        '''
+        self.flush = flush
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, item, size=0):
+        '''
+        Adds an item, blocks while the queue is full.
+
+        :param item: the item to flush later on
+        :param size: the size of the item in bytes, e.g. the length of the message payload
+        '''
+        if self.stopped.is_set():
+            raise RuntimeError('BatchFlusher is already closed.')
+        self.queue.put((item, size))
+
+    def run(self):
+        batch = []
+        batch_bytes = 0
+        deadline = None
+
+        while True:
+            timeout = None if deadline == None else max(0, deadline - time.monotonic())
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = ()
+
+            # None is the signal to stop, write what we have and leave
+            if entry == None:
+                self.write(batch)
+                return
+
+            if len(entry) > 0:
+                item, size = entry
+                if len(batch) == 0:
+                    deadline = time.monotonic() + self.max_latency
+                batch.append(item)
+                batch_bytes += size
+
+            if len(batch) > 0 and (len(batch) >= self.max_batch or batch_bytes >= self.max_bytes or time.monotonic() >= deadline):
+                self.write(batch)
+                batch = []
+                batch_bytes = 0
+                deadline = None
+
+    def write(self, batch):
+        if len(batch) == 0:
+            return
+        try:
+            self.flush(batch)
+        except Exception as e:
+            print(str(datetime.today()) + ' ERROR Flushing ' + str(len(batch)) + ' items failed: ' + str(e))
+
+    def close(self, timeout=None):
+        '''
+        Flushes all remaining items and stops the thread.
+        '''
+        if not self.stopped.is_set():
+            self.stopped.set()
+            self.queue.put(None)
+        self.thread.join(timeout)
@@ -1,133 +1,191 @@
 import pymongo
+from datetime import datetime
 
-def prepare_mongodb(db=None, stations_collection=None, status_collection=None, metadata_collection=None):
-    ensure_indexes(db=db, stations_collection=stations_collection, status_collection=status_collection, metadata_collection=metadata_collection)
-    ensure_views(db=db, stations_collection=stations_collection, status_collection=status_collection, metadata_collection=metadata_collection)
+from iot_citibike import config
+from iot_citibike.mongodb.coalescer import BucketPolicy
+from iot_citibike.mongodb.utilization import UTILIZATION_COLLECTION, utilization_pipeline, hourly_utilization_pipeline
+from iot_citibike.mongodb.latest_status import LATEST_STATUS_COLLECTION
+
+def prepare_mongodb(db=None, stations_collection=None, status_collection=None, metadata_collection=None, storage=None, partitions=None):
+    if partitions != None and status_collection != None:
+        # The status is written into time partitions (see partitions.py), new ones are prepared by the router
+        status_collection = partitions.latest()
+    ensure_indexes(db=db, stations_collection=stations_collection, status_collection=status_collection, metadata_collection=metadata_collection, storage=storage,
+                   partitions=partitions)
+    ensure_views(db=db, stations_collection=stations_collection, status_collection=status_collection, metadata_collection=metadata_collection, storage=storage,
+                 partitions=partitions)
+
+def ensure_indexes(db=None, stations_collection=None, status_collection=None, metadata_collection=None, storage=None, partitions=None):
+    '''
+    :param partitions: StatusPartitions if status_collection is one of its time partitions. A partition is dropped as a whole
+                       once it is expired, so it has no TTL index, and it has the bucket policy of the partitioned collection.
+    '''
+    if status_collection != None:
+        # The watermark of the incremental refresh of latest_status
+        status_collection.database[LATEST_STATUS_COLLECTION].create_index([ ('ts', pymongo.DESCENDING) ])
+
+    if (storage or config.STATUS_STORAGE) == 'timeseries':
+        ensure_timeseries(status_collection)
+        return
 
-def ensure_indexes(db=None, stations_collection=None, status_collection=None, metadata_collection=None):
     if status_collection != None:
-        # For large amounts of time series data, we could add a partial expression to only keep the open buckets per device
         status_collection.create_index([ ('station_id', pymongo.ASCENDING), ('bucket_size', pymongo.ASCENDING) ])
+        # For large amounts of time series data, we could add a partial expression to only keep the open buckets per device
         status_collection.create_index([ ('station_id', pymongo.ASCENDING), ('min_ts', pymongo.ASCENDING), ('max_ts', pymongo.ASCENDING)])
-        status_collection.create_index([ ('expire_on', pymongo.ASCENDING) ], expireAfterSeconds=0 )
+        if partitions == None:
+            status_collection.create_index([ ('expire_on', pymongo.ASCENDING) ], expireAfterSeconds=0 )
+        # The buckets written since a point in time, e.g. for the refresh of latest_status and v_avg_hourly_utilization
+        status_collection.create_index([ ('max_ts', pymongo.ASCENDING) ])
+
+        # Running utilization sums per station-hour: the writers upsert by station and hour, the latest hour per station comes first
+        utilization_collection = status_collection.database[UTILIZATION_COLLECTION]
+        utilization_collection.create_index([ ('station_id', pymongo.ASCENDING), ('hour', pymongo.DESCENDING) ], unique=True)
+        utilization_collection.create_index([ ('expire_on', pymongo.ASCENDING) ], expireAfterSeconds=0 )
+        utilization_collection.create_index([ ('stale', pymongo.ASCENDING) ], partialFilterExpression={ 'stale': True })
+
+        # Additional lookups of the bucket policy of the collection
+        policy = BucketPolicy.for_collection(status_collection.name if partitions == None else partitions.status_collection.name)
+        if policy.kind == 'time':
+            # Exactly one bucket per station and time window, buckets of other policies don't have a bucket_start
+            status_collection.create_index([ ('station_id', pymongo.ASCENDING), ('bucket_start', pymongo.ASCENDING) ], unique=True,
+                                           partialFilterExpression={ 'bucket_start': { '$exists': True } })
+        elif policy.kind == 'bytes':
+            status_collection.create_index([ ('station_id', pymongo.ASCENDING), ('bucket_bytes', pymongo.ASCENDING) ])
     
-def ensure_views(db=None, stations_collection=None, status_collection=None, metadata_collection=None):
-    if db != None:
-        # This is a bit harsh and should only be executed if there is a change!
-        db['v_bike_availability'].drop()
+def ensure_timeseries(status_collection, expire_after=None):
+    '''
+    Creates the status collection as time series collection, the server groups the measurements
+    of each station into compressed buckets on its own.
+    '''
+    if status_collection == None:
+        return
 
-        db.create_collection(
-            'v_bike_availability',
-            viewOn='status',
-            pipeline=[ 
-                # force index usage
-                { '$sort': { 'station_id': 1, 'min_ts': 1, 'max_ts': 1 } }, 
-                # get the latest entry per station
-                { '$group': { 
-                    '_id': { 'station_id': '$station_id' }, 
-                    'latest_status': { '$last': '$status.num_bikes_available' }
-                } }, 
-                # only keep the last, i.e. most current entry of the bucket
-                { '$addFields': { 'latest_status': { '$arrayElemAt': [ '$latest_status', -1 ] } } }, 
-                # get the station metadata, we need capacity and geolocation
-                { '$lookup': {
-                    'from': 'stations', 
-                    'localField': '_id.station_id', 
-                    'foreignField': '_id', 
-                    'as': 'station'
-                } }, 
-                # there is at max one station per id
-                { '$unwind': '$station' }, 
-                # get a beautiful output format and calculate availability ratio
-                { '$project': {
-                    '_id': 0, 
-                    'station_id': '$_id.station_id', 
-                    'station_capacity': '$station.capacity', 
-                    'station_bikes_available': '$latest_status', 
-                    'station_availability': {
-                        '$cond': [
-                            # Some stations have a capcity of 0, avoid divide by zero
-                            { '$gt': [ '$station.capacity', 0 ] },
-                            { '$round': [ { '$multiply': [ { '$divide': [ '$latest_status', '$station.capacity' ] }, 100 ] }, 2 ] },
-                            0
-                        ]
-                    }, 
-                    'geometry': '$station.geometry'
-                } }
-            ])
+    database = status_collection.database
+    existing = list(database.list_collections(filter={ 'name': status_collection.name }))
+    if len(existing) == 0:
+        database.create_collection(
+            status_collection.name,
+            timeseries={ 'timeField': 'ts', 'metaField': 'station_id', 'granularity': 'seconds' },
+            expireAfterSeconds=int((expire_after or config.STATUS_EXPIRE_AFTER).total_seconds()))
+    elif existing[0].get('type') != 'timeseries':
+        print(str(datetime.today()) + ' ERROR Collection ' + status_collection.full_name + ' already exists and is no time series collection.')
 
+    # Latest status per station and time ranges per station
+    status_collection.create_index([ ('station_id', pymongo.ASCENDING), ('ts', pymongo.ASCENDING) ])
+
+def ensure_views(db=None, stations_collection=None, status_collection=None, metadata_collection=None, storage=None, partitions=None):
+    if db != None and (storage or config.STATUS_STORAGE) == 'timeseries':
+        ensure_timeseries_views(db)
+
+    elif db != None:
+        # This is a bit harsh and should only be executed if there is a change!
+        ensure_latest_status_view(db)
+
+        # Index-driven: a range on max_ts, the buckets are filtered before they are unwound and the stations are joined in one batch
+        view_on, pipeline = 'status', utilization_pipeline()
+        if partitions != None:
+            # The last hour is in the newest partition or the one before
+            view_on, pipeline = partitions.view(pipeline)
         db['v_avg_hourly_utilization'].drop()
         db.create_collection(
             'v_avg_hourly_utilization',
-            viewOn='status',
-            pipeline=[
-                { '$match': {
-                    '$expr': { 
-                        '$and': [
-                            # for index scan instead of collection scan, we add the station_id here
-                            { 'gt': [ '$station_id', '0'] },
-                            # we only want the last hour, i.e. 1000*60*60 = 3,600,000ms     
-                            { '$lte': [ '$min_ts', '$$NOW' ] },
-                            { '$gte': [ '$max_ts', { '$add': [ '$$NOW', -3600000 ] } ]}
-                        ]
-                    } 
-                } },
-                # We need all status information across the last hour, which could be across multiple buckets
-                { '$unwind': { 'path': '$status' } }, 
-                # Filter out those status objects that we don't need
-                { '$match': {
-                    '$expr': { 
-                        '$and': [
-                            # we only want the last hour, i.e. 1000*60*60 = 3,600,000ms     
-                            { '$lte': [ '$status.ts', '$$NOW' ] },
-                            { '$gte': [ '$status.ts', { '$add': [ '$$NOW', -3600000 ] } ]}
-                        ]
-                    } 
-                } },
-                { '$group': {
-                    '_id': '$station_id', 
-                    'status': { '$push': { 'num_bikes_available': '$status.num_bikes_available' } }
-                } }, 
-                { '$addFields': {
-                    # Calculate the delta by abs(value - previous value)
-                    'delta': {
-                        '$map': {
-                            'input': { '$range': [ 1, { '$size': '$status' } ] }, 
-                            'as': 'i', 
-                            'in': {
-                                '$abs': {
-                                    '$subtract': [
-                                        { '$arrayElemAt': [ '$status.num_bikes_available', '$$i' ] }, 
-                                        { '$arrayElemAt': [ '$status.num_bikes_available', { '$subtract': [ '$$i', 1 ] } ] }
-                                    ]
-                                }
+            viewOn=view_on,
+            pipeline=pipeline)
+
+        # Utilization of the latest station-hour per station from the running sums of the writers
+        db['v_hourly_utilization'].drop()
+        db.create_collection(
+            'v_hourly_utilization',
+            viewOn=UTILIZATION_COLLECTION,
+            pipeline=hourly_utilization_pipeline())
+
+def ensure_timeseries_views(db):
+    '''
+    Same views as ensure_views, based on a time series collection with one document per measurement.
+    '''
+    ensure_latest_status_view(db)
+
+    db['v_avg_hourly_utilization'].drop()
+    db.create_collection(
+        'v_avg_hourly_utilization',
+        viewOn='status',
+        pipeline=[
+            # we only want the last hour, i.e. 1000*60*60 = 3,600,000ms, the time series buckets are filtered by their time range
+            { '$match': {
+                '$expr': {
+                    '$and': [
+                        { '$lte': [ '$ts', '$$NOW' ] },
+                        { '$gte': [ '$ts', { '$add': [ '$$NOW', -3600000 ] } ] }
+                    ]
+                }
+            } },
+            # the deltas need the measurements in order
+            { '$sort': { 'station_id': 1, 'ts': 1 } },
+            { '$group': {
+                '_id': '$station_id',
+                'status': { '$push': { 'num_bikes_available': '$num_bikes_available' } }
+            } },
+            { '$addFields': {
+                # Calculate the delta by abs(value - previous value)
+                'delta': {
+                    '$map': {
+                        'input': { '$range': [ 1, { '$size': '$status' } ] },
+                        'as': 'i',
+                        'in': {
+                            '$abs': {
+                                '$subtract': [
+                                    { '$arrayElemAt': [ '$status.num_bikes_available', '$$i' ] },
+                                    { '$arrayElemAt': [ '$status.num_bikes_available', { '$subtract': [ '$$i', 1 ] } ] }
+                                ]
                             }
                         }
                     }
-                } }, 
-                # The average of deltas
-                { '$addFields': { 'avg_delta': { '$avg': '$delta' } } }, 
-                # Get station information
-                { '$lookup': {
-                    'from': 'stations', 
-                    'localField': '_id', 
-                    'foreignField': '_id', 
-                    'as': 'station'
-                } }, 
-                # We only have one station, so we can easily do a $unwind to the the station object
-                { '$unwind': { 'path': '$station' } }, 
-                # Format the output
-                { '$project': {
-                    '_id': 0,
-                    'station_id': '$station._id',
-                    'name': '$station.name',
-                    'geometry': '$station.geometry',
-                    'utilization': {
-                        '$cond': [
-                            # Some stations have a capcity of 0, avoid divide by zero
-                            { '$gt': [ '$station.capacity', 0 ] }, 
-                            { '$round': [ { '$multiply': [ { '$divide': [ '$avg_delta', '$station.capacity' ] }, 100 ] }, 2 ] }, 
-                            0
-                        ]
-                    } } }
-            ])
\ No newline at end of file
+                }
+            } },
+            # The average of deltas
+            { '$addFields': { 'avg_delta': { '$avg': '$delta' } } },
+            # Get station information
+            { '$lookup': {
+                'from': 'stations',
+                'localField': '_id',
+                'foreignField': '_id',
+                'as': 'station'
+            } },
+            # We only have one station, so we can easily do a $unwind to the the station object
+            { '$unwind': { 'path': '$station' } },
+            # Format the output
+            { '$project': {
+                '_id': 0,
+                'station_id': '$station._id',
+                'name': '$station.name',
+                'geometry': '$station.geometry',
+                'utilization': {
+                    '$cond': [
+                        # Some stations have a capcity of 0, avoid divide by zero
+                        { '$gt': [ '$station.capacity', 0 ] },
+                        { '$round': [ { '$multiply': [ { '$divide': [ '$avg_delta', '$station.capacity' ] }, 100 ] }, 2 ] },
+                        0
+                    ]
+                } } }
+        ])
+
+
+def ensure_latest_status_view(db):
+    '''
+    The availability of all stations, read from the materialized latest status per station (see latest_status.py).
+    '''
+    db['v_bike_availability'].drop()
+    db.create_collection(
+        'v_bike_availability',
+        viewOn=LATEST_STATUS_COLLECTION,
+        pipeline=[
+            # latest_status already has the output format, one document per station
+            { '$project': {
+                '_id': 0,
+                'station_id': '$_id',
+                'station_capacity': 1,
+                'station_bikes_available': 1,
+                'station_availability': 1,
+                'geometry': 1
+            } }
+        ])
@@ -0,0 +1,78 @@
+import pymongo
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+class RecentStatusCache:
+    '''
+    Remembers the last_reported timestamps of the most recent measurements per station, so that a measurement
+    that was already written is dropped before it is pushed into a bucket, e.g. redelivered MQTT messages (QoS 1),
+    replayed events or overlapping imports of the same feed.
+    Only the latest size keys per station are kept, older duplicates are caught by the guard of the bucket updates
+    (see StationStatusCoalescer). The keys are remembered once the measurements are written (see StatusWrites),
+    a measurement that was rejected or dropped is not skipped when it arrives again.
+    '''
+
+    def __init__(self, size=16):
+        '''
+        :param size: number of keys per station
+        '''
+        self.size = size
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def pipeline(self):
+        '''
+        Aggregation that returns the last_reported timestamps of the latest bucket per station, in either layout.
+        '''
+        return [
+            { '$sort': { 'station_id': 1, 'max_ts': 1 } },
+            { '$group': {
+                '_id': '$station_id',
+                'keys': { '$last': { '$ifNull': [ '$columns.last_reported', '$status.last_reported' ] } }
+            } },
+            { '$project': { 'keys': { '$slice': [ '$keys', -self.size ] } } }
+        ]
+
+    def load(self, collection):
+        '''
+        Initializes the cache from the status buckets, e.g. at startup. Messages that are redelivered after a restart
+        are dropped right away, instead of being rejected by MongoDB.
+        '''
+        try:
+            self.load_results(collection.aggregate(self.pipeline(), allowDiskUse=True), collection)
+
+        except pymongo.errors.PyMongoError as e:
+            print(str(datetime.today()) + ' ERROR Loading recent measurements failed: ' + str(e))
+
+    def load_results(self, results, collection):
+        for result in results:
+            for key in result.get('keys') or []:
+                self.remember(result['_id'], key)
+        print(str(datetime.today()) + ' INFO Loaded recent measurements of ' + str(len(self.keys)) + ' stations from ' + str(collection.name) + '.')
+
+    def seen(self, station_id, key):
+        '''
+        True if the key (last_reported) of the station is one of its recent keys.
+        '''
+        with self.lock:
+            keys = self.keys.get(station_id)
+            return keys != None and key in keys
+
+    def remember(self, station_id, key):
+        '''
+        Adds the key (last_reported) of a written measurement to the recent keys of the station.
+        '''
+        with self.lock:
+            keys = self.keys.get(station_id)
+            if keys == None:
+                keys = OrderedDict()
+                self.keys[station_id] = keys
+
+            keys[key] = True
+            keys.move_to_end(key)
+            if len(keys) > self.size:
+                keys.popitem(last=False)
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import pymongo
+import threading
+from datetime import datetime
+
+from iot_citibike.mongodb.bulk_writer import WriteTracker
+
+def station_hash(station):
+    '''
+    Content hash of a station document, independent of the order of its attributes.
+    '''
+    content = json.dumps(station, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class StationHashCache:
+    '''
+    Remembers the content hash of the last stored version per station _id,
+    so that replacements without any change can be skipped.
+    The hashes can be kept in memory only or be persisted in the metadata collection, e.g. for cron jobs and functions.
+    A hash is only remembered once its station is stored (see StationWrites), a failed write is repeated with the next import.
+    '''
+
+    def __init__(self, id_field='_id'):
+        '''
+        :param id_field: attribute that identifies the station, e.g. station_id for station status
+        '''
+        self.id_field = id_field
+        self.hashes = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def load(self, collection):
+        '''
+        Initializes the cache from the stations that are already stored in MongoDB.
+        The hashes are marked as changed, so that the next save_metadata() persists all of them.
+        '''
+        try:
+            for station in collection.find():
+                self.hashes[station[self.id_field]] = station_hash(station)
+                self.dirty.add(station[self.id_field])
+            print(str(datetime.today()) + ' INFO Loaded ' + str(len(self.hashes)) + ' station hashes from ' + str(collection.name) + '.')
+
+        except pymongo.errors.PyMongoError as e:
+            print(str(datetime.today()) + ' ERROR Loading station hashes failed: ' + str(e))
+
+    def load_metadata(self, collection, key='station_hashes'):
+        '''
+        Initializes the cache from the metadata collection.
+        Returns False if no hashes have been persisted yet.
+        '''
+        try:
+            return self.load_result(collection.find_one({'_id': key}))
+
+        except pymongo.errors.PyMongoError as e:
+            print(str(datetime.today()) + ' ERROR Loading station hashes failed: ' + str(e))
+            return False
+
+    def load_result(self, result):
+        '''
+        Takes over the hashes of the metadata document, returns False if there is none.
+        '''
+        if result == None:
+            return False
+
+        self.hashes.update(result.get('hashes', {}))
+        return True
+
+    def save_metadata(self, collection, key='station_hashes'):
+        '''
+        Persists the hashes that changed since the last save in the metadata collection.
+        '''
+        with self.lock:
+            dirty = list(self.dirty)
+        if len(dirty) == 0:
+            return
+
+        try:
+            collection.update_one({'_id': key}, self.metadata_update(dirty), upsert=True)
+            self.saved(dirty)
+
+        except pymongo.errors.PyMongoError as e:
+            print(str(datetime.today()) + ' ERROR Saving station hashes failed: ' + str(e))
+
+    def metadata_update(self, station_ids):
+        with self.lock:
+            return { '$set': { 'hashes.' + str(station_id): self.hashes[station_id] for station_id in station_ids } }
+
+    def saved(self, station_ids):
+        # Other threads or tasks may have changed the cache while we waited for the write
+        with self.lock:
+            self.dirty.difference_update(station_ids)
+        print(str(datetime.today()) + ' INFO Saved ' + str(len(station_ids)) + ' station hashes.')
+
+    def changed(self, station):
+        '''
+        The content hash of the station if it is new or differs from the last stored version, otherwise None.
+        The new version is not remembered yet, call remember() once it is stored.
+        '''
+        content_hash = station_hash(station)
+        if self.hashes.get(station[self.id_field]) == content_hash:
+            return None
+        return content_hash
+
+    def remember(self, station_id, content_hash):
+        '''
+        Remembers the hash of the stored version of a station, it is persisted with the next save_metadata().
+        '''
+        with self.lock:
+            self.hashes[station_id] = content_hash
+            self.dirty.add(station_id)
+
+
+class StationWrites(WriteTracker):
+    '''
+    Remembers the hashes of the stations in the StationHashCache once their replacements are written.
+    The context of each operation is the station id and the content hash.
+    '''
+
+    def __init__(self, hash_cache):
+        super().__init__()
+        self.hash_cache = hash_cache
+
+    def written(self, contexts):
+        for station_id, content_hash in contexts:
+            self.hash_cache.remember(station_id, content_hash)
@@ -1,13 +1,20 @@
 package com.mongodb.iot.demo.kafka;
 
+import java.util.Arrays;
 import java.util.Calendar;
+import java.util.Collections;
 import java.util.Date;
 
 import org.apache.kafka.connect.errors.DataException;
+import org.bson.BsonArray;
 import org.bson.BsonDateTime;
 import org.bson.BsonDocument;
 import org.bson.BsonInt32;
+import org.bson.BsonInt64;
 import org.bson.BsonString;
+import org.bson.BsonValue;
+import org.bson.RawBsonDocument;
+import org.bson.codecs.BsonDocumentCodec;
 import org.slf4j.Logger;
 import org.slf4j.LoggerFactory;
 
@@ -22,6 +29,30 @@ public class StationStatusWriteStrategy implements WriteModelStrategy {
 	private static final Logger LOGGER = LoggerFactory.getLogger(StationStatusWriteStrategy.class);
     private static final UpdateOptions UPDATE_OPTIONS = new UpdateOptions().upsert(true);
 
+    // Bucket policy of the status collection, same format as STATUS_BUCKETING of the python scripts, e.g. "status=time:3600"
+    //   count:N - up to N measurements per bucket (default count:120)
+    //   time:S  - one bucket per station and time window of S seconds
+    //   bytes:B - up to B bytes of measurements per bucket
+    private static final String[] BUCKET_POLICY = bucketPolicy(
+            System.getenv().getOrDefault("STATUS_BUCKETING", ""),
+            System.getenv().getOrDefault("STATUS_COLLECTION", "status"));
+    private static final String BUCKET_KIND = BUCKET_POLICY[0];
+    private static final long BUCKET_LIMIT = Long.parseLong(BUCKET_POLICY[1]);
+
+    static String[] bucketPolicy(String bucketing, String collection) {
+        for (String entry : bucketing.split(",")) {
+            String[] nameAndPolicy = entry.split("=", 2);
+            if (nameAndPolicy.length == 2 && nameAndPolicy[0].trim().equals(collection)) {
+                String[] policy = nameAndPolicy[1].trim().split(":", 2);
+                if (policy.length == 2 && (policy[0].equals("count") || policy[0].equals("time") || policy[0].equals("bytes"))) {
+                    return new String[] { policy[0], policy[1].trim() };
+                }
+                LOGGER.warn("Unknown bucket policy " + nameAndPolicy[1] + " for collection " + collection + ", using count:120.");
+            }
+        }
+        return new String[] { "count", "120" };
+    }
+
     // Incoming JSON should be a proper citibike station status like { "station_id":"1234", "last_udpated": "...", "last_reported": "...", ... } 
     @Override
     public WriteModel<BsonDocument> createWriteModel(final SinkDocument document) {
@@ -48,36 +79,87 @@ public class StationStatusWriteStrategy implements WriteModelStrategy {
         
         // Define the filter part of the update statement, i.e.
         // the station we want to update
-        // the maximum bucket size
+        // the bucket according to the bucket policy
         BsonDocument filters = new BsonDocument();
         filters.append("station_id", stationId);
-        filters.append("bucket_size", new BsonDocument("$lt", new BsonInt32(120)));
-        
-        // Define the modifications we want to make to the data
-        BsonDocument updates = new BsonDocument();
-        // Push the well-formatted value document - needs more error handling and checking in production
-        updates.append("$push", new BsonDocument("status", valueDocument));
+
         // Increment the bucket size by one
-        updates.append("$inc", new BsonDocument("bucket_size", new BsonInt32(1)));
+        BsonDocument increments = new BsonDocument("bucket_size", new BsonInt32(1));
+
+        if (BUCKET_KIND.equals("time")) {
+            // One bucket per station and time window
+            long windowMillis = BUCKET_LIMIT * 1000;
+            filters.append("bucket_start", new BsonDateTime(lastUpdated.getTime() - Math.floorMod(lastUpdated.getTime(), windowMillis)));
+        } else if (BUCKET_KIND.equals("bytes")) {
+            // The bucket must have enough space left for the measurement
+            long bytes = new RawBsonDocument(valueDocument, new BsonDocumentCodec()).getByteBuffer().remaining();
+            filters.append("bucket_bytes", new BsonDocument("$lte", new BsonInt64(Math.max(BUCKET_LIMIT - bytes, 0))));
+            increments.append("bucket_bytes", new BsonInt64(bytes));
+        } else {
+            // The maximum bucket size
+            filters.append("bucket_size", new BsonDocument("$lt", new BsonInt64(BUCKET_LIMIT)));
+        }
+
+        // Define the modifications we want to make to the data, as pipeline update
+        BsonDateTime ts = new BsonDateTime(lastUpdated.getTime());
+        BsonDocument updates = new BsonDocument();
+        // Add the well-formatted value document - needs more error handling and checking in production
+        // Keep the status ordered by ts, messages may be redelivered or arrive late from several publishers
+        updates.append("status", orderedInsert(valueDocument, ts));
         // Set the max value for the max timestamp of the document
         // Set the max value for the TTL index
         Calendar calendar = Calendar.getInstance();
         calendar.setTime(lastUpdated);
         calendar.add(Calendar.HOUR_OF_DAY, 12);
         Date ttlDate = calendar.getTime();
-        BsonDocument maxDoc = new BsonDocument();
-        maxDoc.append("max_ts", new BsonDateTime(lastUpdated.getTime()));
-        maxDoc.append("expire_on", new BsonDateTime(ttlDate.getTime()));
-        updates.append("$max", maxDoc);
+        updates.append("max_ts", new BsonDocument("$max", array(new BsonString("$max_ts"), ts)));
+        updates.append("expire_on", new BsonDocument("$max", array(new BsonString("$expire_on"), new BsonDateTime(ttlDate.getTime()))));
         
         // Set the min value for the min timestamp of the document
-        updates.append("$min", new BsonDocument("min_ts", new BsonDateTime(lastUpdated.getTime())));
+        updates.append("min_ts", new BsonDocument("$min", array(new BsonString("$min_ts"), ts)));
+
+        // Increment the bucket counters
+        for (String field : increments.keySet()) {
+            updates.append(field, new BsonDocument("$add", array(
+                    new BsonDocument("$ifNull", array(new BsonString("$" + field), new BsonInt32(0))), increments.get(field))));
+        }
         
         // Return the full update
         return new UpdateOneModel<BsonDocument>(
                 filters,
-                updates,
+                Collections.singletonList(new BsonDocument("$set", updates)),
                 UPDATE_OPTIONS
         );
     }
+
+    // Aggregation expression that adds the measurement to the status array of the bucket. It is appended if it is not
+    // older than the max_ts of the bucket, only a late measurement is inserted at the position of its ts.
+    // Unlike $push with $sort, a measurement in order does not sort the whole array.
+    static BsonDocument orderedInsert(BsonDocument measurement, BsonDateTime ts) {
+        BsonDocument status = new BsonDocument("$ifNull", array(new BsonString("$status"), new BsonArray()));
+        BsonArray inserted = array(new BsonDocument("$literal", measurement));
+
+        BsonDocument inOrder = new BsonDocument("$lte", array(new BsonDocument("$ifNull", array(new BsonString("$max_ts"), ts)), ts));
+        BsonDocument append = new BsonDocument("$concatArrays", array(status, inserted));
+
+        // The number of measurements up to the ts of this one, i.e. its position in the ordered array
+        BsonDocument position = new BsonDocument("$size", new BsonDocument("$filter", new BsonDocument("input", status)
+                .append("as", new BsonString("status"))
+                .append("cond", new BsonDocument("$lte", array(new BsonString("$$status.ts"), ts)))));
+        BsonDocument insert = new BsonDocument("$let", new BsonDocument("vars", new BsonDocument("position", position))
+                .append("in", new BsonDocument("$concatArrays", array(
+                        new BsonDocument("$cond", array(
+                                new BsonDocument("$gt", array(new BsonString("$$position"), new BsonInt32(0))),
+                                new BsonDocument("$slice", array(status, new BsonString("$$position"))),
+                                new BsonArray())),
+                        inserted,
+                        new BsonDocument("$slice", array(status, new BsonString("$$position"),
+                                new BsonDocument("$max", array(new BsonDocument("$size", status), new BsonInt32(1)))))))));
+
+        return new BsonDocument("$cond", array(inOrder, append, insert));
+    }
+
+    private static BsonArray array(BsonValue... values) {
+        return new BsonArray(Arrays.asList(values));
+    }
 }
@@ -0,0 +1,34 @@
+##########################################################################################
+#
+# This script keeps the materialized latest status per station (collection latest_status)
+# up to date, the view v_bike_availability reads from it. The status is written by the
+# Kafka Connect sink, so the refresh runs on its own in a fixed interval.
+#
+###########################################################################################
+
+import os
+import time
+import pymongo
+from iot_citibike.mongodb.latest_status import refresh_latest_status
+
+MONGO_URI = os.environ["MONGO_URI"] if "MONGO_URI" in os.environ else None
+if MONGO_URI == None:
+	raise ValueError('No MongoDB Cluster provided. Will exit.')
+	exit(-1)
+
+# Seconds between two refreshes, only the buckets written since the last refresh are read
+LATEST_STATUS_INTERVAL = float(os.environ.get("LATEST_STATUS_INTERVAL", 10))
+
+### Setup MongoDB connection
+mongo_client = pymongo.MongoClient(MONGO_URI)
+db = mongo_client.citibike
+status_collection = db.status
+
+try:
+	while True:
+		refresh_latest_status(status_collection)
+		time.sleep(LATEST_STATUS_INTERVAL)
+except KeyboardInterrupt:
+	pass
+finally:
+	mongo_client.close()
@@ -20,7 +20,9 @@ from pymongo import MongoClient
 import paho.mqtt.publish as publish
 
 from iot_citibike.citibike.load_data import get_station_status
+from iot_citibike.citibike.feed_client import FeedClient
 from iot_citibike.mongodb.operations import get_station_last_updated, set_station_last_updated
+from iot_citibike.mongodb.station_cache import StationHashCache
 
 MQTT_HOST = os.environ["MQTT_HOST"] if "MQTT_HOST" in os.environ else None
 if MQTT_HOST == None:
@@ -39,18 +41,42 @@ metadata_collection = mongo_client.citibike.metadata
 # The feed to get the data
 STATUS_URL = "https://gbfs.citibikenyc.com/gbfs/en/station_status.json"
 
+# Only stations with a changed status are published. Every KEYFRAME_INTERVAL seconds, all stations are published (0 = never).
+KEYFRAME_INTERVAL = int(os.environ.get("KEYFRAME_INTERVAL", 600))
+FINGERPRINTS_KEY = STATUS_URL + '#published'
+
 # Get the last import timestamp
 stations_last_udpated = get_station_last_updated(collection=metadata_collection, feed=STATUS_URL)
 
+# Only download the feed if it changed since the last import
+feed_client = FeedClient()
+feed_client.remember(STATUS_URL, etag=stations_last_udpated.get('etag'), last_modified=stations_last_udpated.get('last_modified'))
+
 # Load current status of stations
-station_status = get_station_status(url=STATUS_URL, last_updated=stations_last_udpated)
+station_status = get_station_status(url=STATUS_URL, last_updated=stations_last_udpated, client=feed_client)
 
 # Publish every status to HiveMQ MQTT Broker
 # Prepare MQTT messages from status payload of the form 
 # { 'topic':'status/<STATION_ID>', 'payload': station, 'qos':1, 'retain':True }
 if station_status != None:
+	# Fingerprints of the last published status per station
+	fingerprints = StationHashCache(id_field='station_id')
+	fingerprints.load_metadata(metadata_collection, key=FINGERPRINTS_KEY)
+
+	# A keyframe is published whenever the feed crossed a KEYFRAME_INTERVAL boundary since the last run
+	keyframe = KEYFRAME_INTERVAL > 0 and \
+		station_status['last_updated'] // KEYFRAME_INTERVAL != stations_last_udpated['last_updated'] // KEYFRAME_INTERVAL
+
 	messages = []
+	published = []
 	for station in station_status['data']['stations']:
+		# The fingerprint must not include the feed timestamp, it changes with every run
+		fingerprint = fingerprints.changed(station)
+		if fingerprint == None and not keyframe:
+			continue
+		if fingerprint != None:
+			published.append((station['station_id'], fingerprint))
+
 		station['last_updated'] = station_status['last_updated']
 		msg = {
 			'topic': 'status/' + station['station_id'],
@@ -61,6 +87,15 @@ if station_status != None:
 		messages.append(msg)
 
 	# Publish station information to MQTT Broker
-	publish.multiple(messages, hostname=MQTT_HOST, port=1883, client_id='citibike_status_publisher')
+	print('Publishing ' + str(len(messages)) + ' of ' + str(len(station_status['data']['stations'])) + ' stations' + (' (keyframe).' if keyframe else '.'))
+	if len(messages) > 0:
+		publish.multiple(messages, hostname=MQTT_HOST, port=1883, client_id='citibike_status_publisher')
+
+	# Only the published status is remembered, publish.multiple raises if the broker is not reachable
+	for station_id, fingerprint in published:
+		fingerprints.remember(station_id, fingerprint)
+
+	fingerprints.save_metadata(metadata_collection, key=FINGERPRINTS_KEY)
 
-	set_station_last_updated(collection=metadata_collection, feed=STATUS_URL, last_updated=station_status['last_updated'])
+	set_station_last_updated(collection=metadata_collection, feed=STATUS_URL, last_updated=station_status['last_updated'],
+		validators=feed_client.get_validators(STATUS_URL))
@@ -0,0 +1,85 @@
+import requests
+from requests.adapters import HTTPAdapter
+from datetime import datetime
+
+class FeedClient:
+    '''
+    HTTP client for GBFS feeds with a pooled keep-alive session and conditional requests.
+    The ETag and Last-Modified headers of the last response are remembered per url and, once the caller committed
+    the import of the feed, sent as If-None-Match/If-Modified-Since with the next request. If the feed did not change,
+    the server answers with 304 Not Modified and we neither download nor parse the feed again.
+    '''
+
+    def __init__(self, timeout=20, pool_size=10):
+        '''
+        :param timeout: when does a call time out?
+        :param pool_size: number of keep-alive connections per host
+        '''
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({ 'Accept-Encoding': 'gzip, deflate' })
+        self.validators = {}
+        # Validators of the last responses, they are sent once the import of the feed is committed
+        self.received = {}
+
+    def remember(self, url, etag=None, last_modified=None):
+        '''
+        Sets the validators for the url, e.g. from the metadata collection of a previous run.
+        '''
+        if etag != None or last_modified != None:
+            self.validators[url] = { 'etag': etag, 'last_modified': last_modified }
+
+    def get_validators(self, url):
+        '''
+        Returns the validators of the last response for the url: { etag: ..., last_modified: ... }, e.g. to store them
+        with the import. If the feed was not downloaded again, the ones that are sent with the requests.
+        '''
+        if url in self.received:
+            return self.received[url]
+        return self.validators.get(url, { 'etag': None, 'last_modified': None })
+
+    def commit(self, url):
+        '''
+        Sends the validators of the last response with the next requests, once the caller imported its feed. Until then
+        the previous validators are sent, so the feed of a failed import is downloaded again instead of answered with 304.
+        If the last response had no validators, none are sent anymore.
+        '''
+        validators = self.received.pop(url, None)
+        if validators == None:
+            return
+        if validators['etag'] == None and validators['last_modified'] == None:
+            self.validators.pop(url, None)
+        else:
+            self.validators[url] = validators
+
+    def get(self, url, stream=False, timeout=None):
+        '''
+        Conditional GET of the feed.
+
+        :param url: url to the feed
+        :param stream: do not download the body right away, e.g. for FeedStream
+        :return: the response, None if the feed was not modified since the last request
+        '''
+        headers = {}
+        validators = self.validators.get(url, { 'etag': None, 'last_modified': None })
+        if validators['etag'] != None:
+            headers['If-None-Match'] = validators['etag']
+        if validators['last_modified'] != None:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        response = self.session.get(url, headers=headers, stream=stream, timeout=timeout or self.timeout)
+
+        if response.status_code == 304:
+            response.close()
+            print(str(datetime.today()) + ' INFO Feed ' + url + ' not modified.')
+            return None
+
+        response.raise_for_status()
+        self.received[url] = { 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified') }
+        return response
+
+    def close(self):
+        self.session.close()
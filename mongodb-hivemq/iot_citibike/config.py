@@ -0,0 +1,40 @@
+import os
+from datetime import timedelta
+
+# How the station status is stored:
+#   buckets    - one document per station with up to 120 measurements (bucket pattern), works with MongoDB 4.2 or newer
+#   timeseries - one insert per measurement into a native time series collection, requires MongoDB 5.0 or newer
+STATUS_STORAGE = os.environ.get('STATUS_STORAGE', 'buckets')
+
+# Measurements are removed by MongoDB after this time
+STATUS_EXPIRE_AFTER = timedelta(hours=float(os.environ.get('STATUS_EXPIRE_AFTER_HOURS', 12)))
+
+# How the measurements are grouped into buckets, per status collection as comma separated NAME=POLICY pairs,
+# e.g. "status=time:3600". Collections without an entry use DEFAULT_BUCKETING.
+#   count:N  - up to N measurements per bucket
+#   time:S   - one bucket per station and time window of S seconds, e.g. time:3600 for one bucket per station-hour
+#   bytes:B  - up to B bytes (BSON) of measurements per bucket
+STATUS_BUCKETING = os.environ.get('STATUS_BUCKETING', '')
+DEFAULT_BUCKETING = 'count:120'
+
+def bucketing(collection_name):
+    '''
+    Returns the bucketing policy of the collection, e.g. 'count:120'.
+    '''
+    for entry in STATUS_BUCKETING.split(','):
+        if '=' in entry:
+            name, policy = entry.split('=', 1)
+            if name.strip() == collection_name:
+                return policy.strip()
+    return DEFAULT_BUCKETING
+
+# Layout of the measurements within a bucket, see iot_citibike/mongodb/bucket_layout.py:
+#   rows    - status array with one document per measurement (default)
+#   columns - one array per attribute, the attribute names are not repeated per measurement
+STATUS_LAYOUT = os.environ.get('STATUS_LAYOUT', 'rows')
+
+# Time partitions of the status buckets, see iot_citibike/mongodb/partitions.py (bucket storage only):
+#   none - all buckets in the status collection, expired buckets are removed by the TTL index (default)
+#   day  - one collection per day, e.g. status_2026_10_18, dropped as a whole once all measurements are expired
+#   week - one collection per week, named after its monday
+STATUS_PARTITIONING = os.environ.get('STATUS_PARTITIONING', 'none')
@@ -0,0 +1,300 @@
+import functools
+import threading
+import time
+import pymongo
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+
+class BulkWriteStats:
+    '''
+    Thread safe counters about the bulk writes, i.e. written operations, retries, skipped duplicates and dropped operations.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.batches = 0
+        self.ops = 0
+        self.retries = 0
+        self.skipped = 0
+        self.dropped = 0
+
+    def record(self, batches=0, ops=0, retries=0, skipped=0, dropped=0):
+        with self.lock:
+            self.batches += batches
+            self.ops += ops
+            self.retries += retries
+            self.skipped += skipped
+            self.dropped += dropped
+
+    def ops_per_second(self):
+        elapsed = time.monotonic() - self.started
+        return self.ops / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'ops': self.ops,
+                'ops_per_second': round(self.ops_per_second(), 2),
+                'retries': self.retries,
+                'skipped': self.skipped,
+                'dropped': self.dropped
+            }
+
+
+class WriteTracker:
+    '''
+    Follows operations through the bulk writes, so that the caller learns which of them were actually written,
+    e.g. to update its caches only once the write succeeded. The operations are registered with a context (track),
+    at the end of each batch the contexts are handed to written(), skipped() and dropped().
+    With a BulkWriter, these are called from its threads.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contexts = {}
+
+    def track(self, operation, context):
+        '''
+        Registers the operation with its context and returns the operation.
+        '''
+        with self.lock:
+            # The operation is kept as well, its id must not be reused while it is tracked
+            self.contexts[id(operation)] = (operation, context)
+        return operation
+
+    def pop(self, operations):
+        '''
+        The contexts of the operations, they are not tracked anymore.
+        '''
+        contexts = []
+        with self.lock:
+            for operation in operations:
+                entry = self.contexts.pop(id(operation), None)
+                if entry != None:
+                    contexts.append(entry[1])
+        return contexts
+
+    def split(self, operation):
+        '''
+        Operations that replace an operation which was rejected with a duplicate key error, e.g. one per measurement
+        of a chunk, so that only the parts that are duplicates fail. None if the operation is retried as it is.
+        '''
+        return None
+
+    def finish(self, written, skipped, dropped):
+        self.written(self.pop(written))
+        self.skipped(self.pop(skipped))
+        self.dropped(self.pop(dropped))
+
+    def written(self, contexts):
+        pass
+
+    def skipped(self, contexts):
+        pass
+
+    def dropped(self, contexts):
+        pass
+
+
+class UnorderedWrite:
+    '''
+    The decisions of an unordered bulk write with retries, without the I/O. write_unordered and its asynchronous variant
+    in iot_citibike.aio.operations only send the pending operations and report the outcome:
+      - succeeded(): all pending operations were written
+      - error(err): some or all of them failed. Only the failed operations (indices in writeErrors) are pending afterwards,
+        up to max_retries times. Returns the seconds to wait before they are sent again.
+      - finish(): logs and counts the result, returns the operations that could not be written
+    Operations that fail with a duplicate key error are retried once, e.g. conflicting upserts of concurrent writers,
+    or replaced by the parts from the WriteTracker. If they fail again, they are skipped: the documents already exist.
+    '''
+
+    def __init__(self, collection, batch, max_retries=3, stats=None, tracker=None):
+        '''
+        :param collection: target collection, for the log messages
+        :param batch: list of pymongo bulk operations
+        :param max_retries: how often failed operations are retried before they are dropped
+        :param stats: optional BulkWriteStats to record the results
+        :param tracker: optional WriteTracker that learns which operations were written
+        '''
+        self.collection = collection
+        self.pending = list(batch)
+        self.written = []
+        self.skipped = []
+        self.dropped = []
+        self.retried = set()
+        self.attempt = 0
+        self.max_retries = max_retries
+        self.stats = stats
+        self.tracker = tracker
+
+    def succeeded(self):
+        self.record(self.pending)
+        self.pending = []
+
+    def error(self, err):
+        retry = []
+        failed = []
+        if isinstance(err, pymongo.errors.BulkWriteError):
+            print(str(datetime.today()) + ' ERROR Writing to MongoDB (' + str(self.collection.name) + '): ' + str(err.details['writeErrors'][:3]))
+            # The indices refer to the list we have sent, all other operations succeeded
+            errors = { error['index']: error for error in err.details['writeErrors'] }
+            self.record([ operation for index, operation in enumerate(self.pending) if index not in errors ])
+
+            for index in sorted(errors):
+                operation = self.pending[index]
+                if errors[index].get('code') != 11000:
+                    failed.append(operation)
+                    continue
+
+                parts = self.tracker.split(operation) if self.tracker != None else None
+                if parts != None:
+                    retry.extend(parts)
+                elif id(operation) in self.retried:
+                    self.skipped.append(operation)
+                else:
+                    # Duplicate keys are also caused by concurrent upserts, those succeed with the first retry
+                    self.retried.add(id(operation))
+                    retry.append(operation)
+        else:
+            # No details about single operations available, e.g. network errors. Retry everything.
+            print(str(datetime.today()) + ' ERROR Writing to MongoDB (' + str(self.collection.name) + '): ' + str(err))
+            failed = self.pending
+
+        if self.attempt >= self.max_retries:
+            self.dropped.extend(failed + retry)
+            self.pending = []
+            return 0
+
+        self.attempt += 1
+        self.pending = retry + failed
+        if self.stats != None:
+            self.stats.record(retries=len(self.pending))
+        # Simple linear backoff, e.g. for conflicting upserts of concurrent writers
+        return 0.1 * self.attempt if len(self.pending) > 0 else 0
+
+    def record(self, written):
+        self.written.extend(written)
+        if self.stats != None:
+            self.stats.record(batches=1 if self.attempt == 0 else 0, ops=len(written))
+
+    def finish(self):
+        if len(self.skipped) > 0:
+            # e.g. measurements that are already stored, rejected by the duplicate guard of the status buckets
+            print(str(datetime.today()) + ' INFO Skipped ' + str(len(self.skipped)) + ' operations for ' + str(self.collection.name) + ', the documents already exist.')
+        if len(self.dropped) > 0:
+            print(str(datetime.today()) + ' ERROR Dropped ' + str(len(self.dropped)) + ' operations for ' + str(self.collection.name) + ' after ' + str(self.attempt) + ' retries.')
+        if self.stats != None:
+            self.stats.record(skipped=len(self.skipped), dropped=len(self.dropped))
+        if self.tracker != None:
+            self.tracker.finish(self.written, self.skipped, self.dropped)
+
+        print(str(datetime.today()) + ' Wrote ' + str(len(self.written)) + ' to MongoDB (' + str(self.collection.name) + ').')
+        return self.skipped + self.dropped
+
+
+def write_unordered(collection, batch, max_retries=3, stats=None, tracker=None):
+    '''
+    Writes the batch as unordered bulk write, i.e. the server continues after a failed operation.
+    Only the failed operations are retried, see UnorderedWrite.
+
+    :param collection: target collection
+    :param batch: list of pymongo bulk operations
+    :param max_retries: how often failed operations are retried before they are dropped
+    :param stats: optional BulkWriteStats to record the results
+    :param tracker: optional WriteTracker that learns which operations were written
+    :return: list of operations that could not be written
+    '''
+    write = UnorderedWrite(collection, batch, max_retries=max_retries, stats=stats, tracker=tracker)
+    while len(write.pending) > 0:
+        try:
+            collection.bulk_write(write.pending, ordered=False)
+            write.succeeded()
+        except pymongo.errors.PyMongoError as err:
+            time.sleep(write.error(err))
+    return write.finish()
+
+
+def batch_due(batch, batch_size=100, full_batch_required=False):
+    '''
+    True if the batch is written now, i.e. it is full or full_batch_required is not set (e.g. the last batch).
+    '''
+    return len(batch) > 0 and ((full_batch_required and len(batch) >= batch_size) or not full_batch_required)
+
+
+def log_failure(collection, exception):
+    print(str(datetime.today()) + ' ERROR Bulk write for ' + str(collection.name) + ' failed: ' + str(exception))
+
+
+def log_stats(collection, stats):
+    print(str(datetime.today()) + ' INFO Bulk writes for ' + str(collection.name) + ': ' + str(stats.as_dict()))
+
+
+class BulkWriter:
+    '''
+    Issues unordered bulk writes from a bounded thread pool, so that the round-trips to MongoDB overlap.
+    submit() blocks once max_pending batches are waiting, which protects the memory of the caller.
+    '''
+
+    def __init__(self, collection, max_workers=4, max_pending=8, max_retries=3):
+        '''
+        :param collection: target collection
+        :param max_workers: number of concurrent bulk writes
+        :param max_pending: number of batches that are queued or in flight before submit() blocks
+        :param max_retries: how often failed operations are retried before they are dropped
+        '''
+        self.collection = collection
+        self.max_retries = max_retries
+        self.stats = BulkWriteStats()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bulk_writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.futures = set()
+
+    def submit(self, batch, collection=None, tracker=None):
+        '''
+        Schedules the batch for writing. The batch is copied, so the caller can reuse the list.
+
+        :param collection: target collection of the batch, if it is not the collection of the writer, e.g. a time partition
+        :param tracker: optional WriteTracker of the batch's operations, it is called from the thread of the write
+        '''
+        if collection == None:
+            collection = self.collection
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.write, list(batch), collection, tracker)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(functools.partial(self.done, collection))
+        return future
+
+    def write(self, batch, collection, tracker):
+        write_unordered(collection, batch, max_retries=self.max_retries, stats=self.stats, tracker=tracker)
+
+    def done(self, collection, future):
+        with self.lock:
+            self.futures.discard(future)
+        self.slots.release()
+
+        if future.exception() != None:
+            log_failure(collection, future.exception())
+
+    def flush(self):
+        '''
+        Waits until all submitted batches are written.
+        '''
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+
+    def close(self):
+        '''
+        Writes all outstanding batches and stops the thread pool.
+        '''
+        self.flush()
+        self.executor.shutdown(wait=True)
+        log_stats(self.collection, self.stats)
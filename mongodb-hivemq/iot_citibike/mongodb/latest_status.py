@@ -0,0 +1,130 @@
+import pymongo
+from datetime import datetime, timedelta
+
+from iot_citibike import config
+from iot_citibike.mongodb.bucket_layout import last_status_expression
+
+# Materialized latest status per station (_id: station_id), the view v_bike_availability reads from it.
+# It is refreshed with a $merge after each import, so reading the availability of all stations is a plain scan
+# of one small document per station instead of grouping all buckets and looking up the stations on every read.
+LATEST_STATUS_COLLECTION = 'latest_status'
+
+# Each refresh reads the buckets again that ended this long before the watermark of the previous refresh, so that
+# measurements which arrived late, e.g. of a station that reports behind the others, are merged as well
+REFRESH_OVERLAP = timedelta(minutes=15)
+
+def latest_status_pipeline(since=None, storage=None, into=LATEST_STATUS_COLLECTION):
+    '''
+    Aggregation on the status collection that merges the latest measurement per station, together with capacity
+    and geometry of the station, into the latest_status collection.
+
+    :param since: only buckets (or measurements of a time series collection) from this timestamp on are read
+    :param storage: 'buckets' or 'timeseries', defaults to config.STATUS_STORAGE
+    '''
+    pipeline = []
+    if (storage or config.STATUS_STORAGE) == 'timeseries':
+        if since != None:
+            pipeline.append({ '$match': { 'ts': { '$gte': since } } })
+        pipeline += [
+            { '$sort': { 'station_id': 1, 'ts': 1 } },
+            { '$group': { '_id': '$station_id', 'status': { '$last': '$$ROOT' } } }
+        ]
+    else:
+        # Uses the index on max_ts, only the buckets written since the last refresh are read
+        if since != None:
+            pipeline.append({ '$match': { 'max_ts': { '$gte': since } } })
+        pipeline += [
+            { '$sort': { 'station_id': 1, 'max_ts': 1 } },
+            { '$group': { '_id': '$station_id', 'status': { '$last': last_status_expression() } } }
+        ]
+
+    pipeline += [
+        # get the station metadata once per refresh instead of once per read
+        { '$lookup': {
+            'from': 'stations',
+            'localField': '_id',
+            'foreignField': '_id',
+            'as': 'station'
+        } },
+        # there is at max one station per id
+        { '$unwind': '$station' },
+        # the output format of v_bike_availability, including the availability ratio
+        { '$project': {
+            'ts': '$status.ts',
+            'station_capacity': '$station.capacity',
+            'station_bikes_available': '$status.num_bikes_available',
+            'station_availability': {
+                '$cond': [
+                    # Some stations have a capcity of 0, avoid divide by zero
+                    { '$gt': [ '$station.capacity', 0 ] },
+                    { '$round': [ { '$multiply': [ { '$divide': [ '$status.num_bikes_available', '$station.capacity' ] }, 100 ] }, 2 ] },
+                    0
+                ]
+            },
+            'geometry': '$station.geometry'
+        } },
+        # never replace a station's status by an older one, e.g. when a late bucket is read again
+        { '$merge': {
+            'into': into,
+            'on': '_id',
+            'whenMatched': [ { '$replaceWith': { '$cond': [ { '$gte': [ '$$new.ts', '$ts' ] }, '$$new', '$$ROOT' ] } } ],
+            'whenNotMatched': 'insert'
+        } }
+    ]
+    return pipeline
+
+
+def watermark_field(storage=None):
+    '''
+    The attribute with the newest timestamp of a status document, max_ts of a bucket or ts of a measurement.
+    '''
+    return 'ts' if (storage or config.STATUS_STORAGE) == 'timeseries' else 'max_ts'
+
+
+def refresh_key(latest_collection):
+    '''
+    _id of the document in the metadata collection with the watermark of the refreshes, like the watermarks of the rollups.
+    '''
+    return 'refresh_' + latest_collection.name
+
+
+def refresh_since(result, overlap=REFRESH_OVERLAP):
+    '''
+    Start of the buckets to read, given the metadata document of the previous refresh. None reads all buckets.
+    '''
+    if result == None or result.get('watermark') == None:
+        return None
+    return result['watermark'] - overlap
+
+
+def refresh_latest_status(status_collection, latest_collection=None, storage=None, partitions=None, metadata_collection=None, overlap=REFRESH_OVERLAP):
+    '''
+    Incrementally refreshes latest_status from the buckets written since the last refresh, e.g. after each import.
+    The watermark is the newest max_ts of the status collection when the previous refresh started, it is kept in the
+    metadata collection. The buckets are read from overlap before it on, the $merge keeps the newest status per station.
+    With StatusPartitions, only the partitions since the last refresh are read.
+    '''
+    if latest_collection == None:
+        latest_collection = status_collection.database[LATEST_STATUS_COLLECTION]
+    if metadata_collection == None:
+        metadata_collection = status_collection.database['metadata']
+    field = watermark_field(storage)
+
+    try:
+        since = refresh_since(metadata_collection.find_one({ '_id': refresh_key(latest_collection) }), overlap=overlap)
+
+        # Taken before reading, buckets that are written in the meantime are read again with the next refresh
+        newest = (partitions.latest() if partitions != None else status_collection).find_one({}, projection={ field: 1 }, sort=[ (field, pymongo.DESCENDING) ])
+
+        pipeline = latest_status_pipeline(since=since, storage=storage, into=latest_collection.name)
+        if partitions != None:
+            partitions.aggregate(pipeline, start=since, allowDiskUse=True)
+        else:
+            status_collection.aggregate(pipeline, allowDiskUse=True)
+
+        if newest != None:
+            metadata_collection.update_one({ '_id': refresh_key(latest_collection) }, { '$set': { 'watermark': newest[field] } }, upsert=True)
+        print(str(datetime.today()) + ' INFO Refreshed ' + str(latest_collection.name) + ' since ' + str(since) + '.')
+
+    except pymongo.errors.PyMongoError as e:
+        print(str(datetime.today()) + ' ERROR Refreshing ' + str(latest_collection.name) + ' failed: ' + str(e))
@@ -0,0 +1,433 @@
+import pymongo
+import threading
+from datetime import datetime, timedelta
+
+from iot_citibike import config
+from iot_citibike.mongodb.bucket_layout import status_expression, decode_stage
+
+# Running sums of the utilization per station-hour, maintained by the status writers:
+#   { station_id, hour, count, delta_sum, delta_count, first_ts, first_value, last_ts, last_value, carried, stale, expire_on }
+# delta_sum is the sum of abs(num_bikes_available - previous value) within the hour, the average is delta_sum / delta_count.
+# The first measurement of an hour is compared to the last one of the previous hour, if it is known (carried).
+UTILIZATION_COLLECTION = 'utilization'
+
+def utilization_pipeline(since=None, stations='stations'):
+    '''
+    Aggregation on the status buckets with the average change of available bikes per station since a point in time,
+    relative to the capacity of the station.
+
+    :param since: start of the time range, by default one hour before $$NOW (for the view v_avg_hourly_utilization).
+                  A literal timestamp gives the planner a plain range on the max_ts index, with $$NOW
+                  this relies on the server using indexes for $expr comparisons (MongoDB 5.0 or newer).
+    '''
+    if since != None:
+        buckets = { 'max_ts': { '$gte': since } }
+        in_range = { '$gte': [ '$$status.ts', since ] }
+    else:
+        # we only want the last hour, i.e. 1000*60*60 = 3,600,000ms
+        hour_ago = { '$subtract': [ '$$NOW', 3600000 ] }
+        buckets = { '$expr': { '$gte': [ '$max_ts', hour_ago ] } }
+        in_range = { '$gte': [ '$$status.ts', hour_ago ] }
+
+    return [
+        # Only the buckets that end within the time range, an index range scan on max_ts
+        { '$match': buckets },
+        # Drop the measurements before the time range within the bucket, before unwinding it.
+        # Columnar buckets are decoded, only the attributes we need are kept.
+        { '$project': {
+            'station_id': 1,
+            'status': {
+                '$map': {
+                    'input': { '$filter': { 'input': status_expression(), 'as': 'status', 'cond': in_range } },
+                    'as': 'status',
+                    'in': { 'ts': '$$status.ts', 'num_bikes_available': '$$status.num_bikes_available' }
+                }
+            }
+        } },
+        { '$unwind': { 'path': '$status' } },
+        # The deltas need the measurements in order, also across buckets
+        { '$sort': { 'station_id': 1, 'status.ts': 1 } },
+        { '$group': {
+            '_id': '$station_id',
+            'status': { '$push': '$status.num_bikes_available' }
+        } },
+        { '$project': {
+            # The average of abs(value - previous value)
+            'avg_delta': {
+                '$avg': {
+                    '$map': {
+                        'input': { '$range': [ 1, { '$size': '$status' } ] },
+                        'as': 'i',
+                        'in': {
+                            '$abs': {
+                                '$subtract': [
+                                    { '$arrayElemAt': [ '$status', '$$i' ] },
+                                    { '$arrayElemAt': [ '$status', { '$subtract': [ '$$i', 1 ] } ] }
+                                ]
+                            }
+                        }
+                    }
+                }
+            }
+        } }
+    ] + join_stations(stations)
+
+
+def join_stations(stations='stations', fields={}):
+    '''
+    Stages that join documents { _id: station_id, avg_delta: ... } with their stations and format the output.
+    The stations are joined in one batch instead of one $lookup per station: they are read once
+    and grouped together with the utilization by their _id.
+
+    :param fields: additional output fields, e.g. { 'hour': '$station.hour' }
+    '''
+    output = {
+        '_id': 0,
+        'station_id': '$_id',
+        'name': '$station.name',
+        'geometry': '$station.geometry',
+        'utilization': {
+            '$cond': [
+                # Some stations have a capcity of 0, avoid divide by zero
+                { '$gt': [ '$station.capacity', 0 ] },
+                { '$round': [ { '$multiply': [ { '$divide': [ '$station.avg_delta', '$station.capacity' ] }, 100 ] }, 2 ] },
+                0
+            ]
+        }
+    }
+    output.update(fields)
+
+    return [
+        { '$unionWith': { 'coll': stations, 'pipeline': [ { '$project': { 'name': 1, 'geometry': 1, 'capacity': 1 } } ] } },
+        { '$group': { '_id': '$_id', 'station': { '$mergeObjects': '$$ROOT' } } },
+        # Only stations with measurements, and measurements of known stations
+        { '$match': { 'station.avg_delta': { '$exists': True }, 'station.name': { '$exists': True } } },
+        # Format the output
+        { '$project': output }
+    ]
+
+
+def hourly_utilization_pipeline(stations='stations'):
+    '''
+    Aggregation on the utilization collection with the utilization of the latest station-hour of each station,
+    one index entry per station instead of all measurements of the hour.
+    '''
+    return [
+        # Uses the index on station_id and hour (descending), i.e. the first entry per station is its latest hour
+        { '$sort': { 'station_id': 1, 'hour': -1 } },
+        { '$group': {
+            '_id': '$station_id',
+            'hour': { '$first': '$hour' },
+            'delta_sum': { '$first': '$delta_sum' },
+            'delta_count': { '$first': '$delta_count' }
+        } },
+        { '$match': { 'delta_count': { '$gt': 0 } } },
+        { '$project': { 'hour': 1, 'avg_delta': { '$divide': [ '$delta_sum', '$delta_count' ] } } }
+    ] + join_stations(stations, fields={ 'hour': '$station.hour' })
+
+
+def avg_hourly_utilization(status_collection, now=None, partitions=None):
+    '''
+    Same result as the view v_avg_hourly_utilization, with a literal time range that always uses the max_ts index.
+    With StatusPartitions, only the partitions of the last hour are read.
+    '''
+    since = (now or datetime.now()) - timedelta(hours=1)
+    if partitions != None:
+        return list(partitions.aggregate(utilization_pipeline(since=since), start=since, allowDiskUse=True))
+    return list(status_collection.aggregate(utilization_pipeline(since=since), allowDiskUse=True))
+
+
+def explain_avg_hourly_utilization(status_collection, now=None, view=None):
+    '''
+    Summary of the execution statistics of avg_hourly_utilization, e.g. to check that the buckets are found by an
+    index scan and that only the buckets of the last hour are examined:
+      { 'stages': [ 'IXSCAN', 'FETCH', ... ], 'indexes': [ { 'max_ts': 1 }, ... ], 'keys_examined': ..., 'docs_examined': ..., 'buckets': ... }
+    indexes are the key patterns of the index scans.
+    buckets is the number of buckets in the time range, docs_examined should not exceed it by much more than
+    the number of stations, which are read once by $unionWith.
+
+    :param view: name of the view to explain instead, e.g. v_avg_hourly_utilization. Its time range is relative to
+                 $$NOW of the server, so the buckets are counted from one hour before the current UTC time by default.
+    '''
+    if view != None:
+        since = (now or datetime.utcnow()) - timedelta(hours=1)
+        command = { 'aggregate': view, 'pipeline': [], 'cursor': {} }
+    else:
+        since = (now or datetime.now()) - timedelta(hours=1)
+        command = { 'aggregate': status_collection.name, 'pipeline': utilization_pipeline(since=since), 'cursor': {} }
+    explain = status_collection.database.command('explain', command, verbosity='executionStats')
+
+    # The statistics are nested differently depending on the server version and query engine
+    summary = { 'stages': [], 'indexes': [], 'keys_examined': 0, 'docs_examined': 0 }
+    pending = [ explain ]
+    while len(pending) > 0:
+        value = pending.pop()
+        if isinstance(value, list):
+            pending.extend(value)
+        elif isinstance(value, dict):
+            if 'stage' in value and not value['stage'] in summary['stages']:
+                summary['stages'].append(value['stage'])
+            if value.get('stage') == 'IXSCAN' and not dict(value.get('keyPattern', {})) in summary['indexes']:
+                summary['indexes'].append(dict(value.get('keyPattern', {})))
+            summary['keys_examined'] += value.get('totalKeysExamined', 0)
+            summary['docs_examined'] += value.get('totalDocsExamined', 0)
+            pending.extend(value.values())
+
+    summary['buckets'] = status_collection.count_documents({ 'max_ts': { '$gte': since } })
+    return summary
+
+
+def hour_start(ts):
+    return ts - timedelta(minutes=ts.minute, seconds=ts.second, microseconds=ts.microsecond)
+
+
+def utilization_operations(station_id, measurements, expire_after=None, previous=None):
+    '''
+    Updates of the running sums of a station, one per hour of the measurements.
+    The deltas between the measurements of an hour are summed up here, the delta to the values that are already
+    stored is added by the server, so the state survives restarts of the writer:
+      - measurements after the last stored one, or before the first stored one, are folded in exactly
+      - measurements that overlap the stored range, e.g. late or replayed ones, only mark the hour as stale.
+        repair_utilization recomputes stale hours from the buckets.
+
+    :param previous: optional (ts, num_bikes_available) of the last measurement of the station before these, e.g. from
+                     the UtilizationCache. The first delta of an hour is taken against the last value of the previous hour.
+    '''
+    measurements = sorted(measurements, key=lambda measurement: measurement['ts'])
+
+    hours = {}
+    for measurement in measurements:
+        hours.setdefault(hour_start(measurement['ts']), []).append(measurement)
+
+    operations = []
+    for hour, chunk in hours.items():
+        values = [ measurement.get('num_bikes_available', 0) for measurement in chunk ]
+        delta_sum = sum(abs(values[i] - values[i - 1]) for i in range(1, len(values)))
+
+        # Only the last value of the hour right before is carried over, not the one of an older hour
+        previous_value = None
+        if previous != None and hour - timedelta(hours=1) <= previous[0] < hour:
+            previous_value = previous[1]
+
+        operations.append(utilization_operation(station_id, hour, chunk[0]['ts'], values[0], chunk[-1]['ts'], values[-1],
+                                                len(chunk), delta_sum, expire_after or config.STATUS_EXPIRE_AFTER, previous_value=previous_value))
+        previous = (chunk[-1]['ts'], values[-1])
+    return operations
+
+
+def utilization_operation(station_id, hour, first_ts, first_value, last_ts, last_value, count, delta_sum, expire_after, previous_value=None):
+    '''
+    Pipeline update that folds a chunk of in-order measurements of one hour into the stored running sums.
+
+    :param previous_value: the last value of the previous hour, the delta to the first value is added if the chunk
+                           starts the hour. A chunk before the first stored measurement of a carried hour marks it stale.
+    '''
+    first_value = { '$literal': first_value }
+    last_value = { '$literal': last_value }
+    carried = { '$or': [ { '$ifNull': [ '$carried', False ] }, previous_value != None ] }
+
+    # Where the chunk goes relative to the stored measurements of the hour
+    position = {
+        '$switch': {
+            'branches': [
+                { 'case': { '$not': [ { '$gt': [ '$count', 0 ] } ] }, 'then': 'new' },
+                { 'case': { '$gt': [ first_ts, '$last_ts' ] }, 'then': 'after' },
+                # The delta to the previous hour belongs to the chunk now, this is left to the repair
+                { 'case': { '$lt': [ last_ts, '$first_ts' ] }, 'then': { '$cond': [ carried, 'overlap', 'before' ] } }
+            ],
+            'default': 'overlap'
+        }
+    }
+    new_or_before = { '$in': [ '$position', [ 'new', 'before' ] ] }
+    new_or_after = { '$in': [ '$position', [ 'new', 'after' ] ] }
+    overlap = { '$eq': [ '$position', 'overlap' ] }
+
+    # The delta between the chunk and the stored measurements next to it, or the last value of the previous hour
+    branches = [
+        { 'case': { '$eq': [ '$position', 'after' ] }, 'then': { '$abs': { '$subtract': [ first_value, '$last_value' ] } } },
+        { 'case': { '$eq': [ '$position', 'before' ] }, 'then': { '$abs': { '$subtract': [ '$first_value', last_value ] } } }
+    ]
+    if previous_value != None:
+        branches.append({ 'case': { '$eq': [ '$position', 'new' ] }, 'then': { '$abs': { '$subtract': [ first_value, { '$literal': previous_value } ] } } })
+    boundary = { '$switch': { 'branches': branches, 'default': None } }
+
+    return pymongo.UpdateOne(
+        { 'station_id': station_id, 'hour': hour },
+        [
+            { '$set': { 'position': position } },
+            { '$set': {
+                'boundary': boundary,
+                'count': { '$cond': [ overlap, '$count', { '$add': [ { '$ifNull': [ '$count', 0 ] }, count ] } ] },
+                'first_ts': { '$cond': [ new_or_before, first_ts, '$first_ts' ] },
+                'first_value': { '$cond': [ new_or_before, first_value, '$first_value' ] },
+                'last_ts': { '$cond': [ new_or_after, last_ts, '$last_ts' ] },
+                'last_value': { '$cond': [ new_or_after, last_value, '$last_value' ] },
+                'carried': { '$cond': [ { '$eq': [ '$position', 'new' ] }, previous_value != None, { '$ifNull': [ '$carried', False ] } ] },
+                'stale': { '$or': [ { '$ifNull': [ '$stale', False ] }, overlap ] },
+                'expire_on': { '$max': [ '$expire_on', hour + timedelta(hours=1) + expire_after ] }
+            } },
+            { '$set': {
+                'delta_sum': { '$cond': [ overlap, '$delta_sum',
+                    { '$add': [ { '$ifNull': [ '$delta_sum', 0 ] }, delta_sum, { '$ifNull': [ '$boundary', 0 ] } ] } ] },
+                'delta_count': { '$cond': [ overlap, '$delta_count',
+                    { '$add': [ { '$ifNull': [ '$delta_count', 0 ] }, count - 1, { '$cond': [ { '$eq': [ '$boundary', None ] }, 0, 1 ] } ] } ] }
+            } },
+            { '$unset': [ 'position', 'boundary' ] }
+        ],
+        upsert=True)
+
+
+def repair_pipeline(stale, into=UTILIZATION_COLLECTION):
+    '''
+    Aggregation on the status buckets that recomputes the running sums of the given station-hours and replaces them.
+    The last measurement of the hour before is carried into the first delta, like the writers do.
+
+    :param stale: list of { station_id, hour }
+    '''
+    hours = [ { 'station_id': item['station_id'], 'hour': item['hour'] } for item in stale ]
+    return [
+        # The buckets that overlap one of the hours or the hour before
+        { '$match': { '$or': [ {
+            'station_id': hour['station_id'],
+            'max_ts': { '$gte': hour['hour'] - timedelta(hours=1) },
+            'min_ts': { '$lt': hour['hour'] + timedelta(hours=1) }
+        } for hour in hours ] } },
+        # Columnar buckets are decoded into the status array
+        decode_stage(),
+        { '$unwind': '$status' },
+        { '$addFields': { 'hour': { '$subtract': [ '$status.ts', { '$mod': [ { '$toLong': '$status.ts' }, 3600000 ] } ] } } },
+        # Each measurement belongs to its hour, and is carried into the next hour
+        { '$addFields': { 'copies': [
+            { 'hour': '$hour', 'carry': False },
+            { 'hour': { '$add': [ '$hour', 3600000 ] }, 'carry': True }
+        ] } },
+        { '$unwind': '$copies' },
+        { '$addFields': { 'hour': '$copies.hour' } },
+        { '$match': { '$or': hours } },
+        { '$sort': { 'station_id': 1, 'status.ts': 1 } },
+        { '$group': {
+            '_id': { 'station_id': '$station_id', 'hour': '$hour' },
+            'values': { '$push': { '$cond': [ '$copies.carry', '$$REMOVE', '$status.num_bikes_available' ] } },
+            'carried': { '$push': { '$cond': [ '$copies.carry', '$status.num_bikes_available', '$$REMOVE' ] } },
+            'first_ts': { '$min': { '$cond': [ '$copies.carry', None, '$status.ts' ] } },
+            'last_ts': { '$max': { '$cond': [ '$copies.carry', None, '$status.ts' ] } },
+            'expire_on': { '$max': '$expire_on' }
+        } },
+        # Only the carried measurement, the hour has no measurements of its own
+        { '$match': { 'values.0': { '$exists': True } } },
+        { '$project': {
+            '_id': 0,
+            'station_id': '$_id.station_id',
+            'hour': '$_id.hour',
+            'count': { '$size': '$values' },
+            'delta_sum': { '$add': [
+                { '$sum': {
+                    '$map': {
+                        'input': { '$range': [ 1, { '$size': '$values' } ] },
+                        'as': 'i',
+                        'in': { '$abs': { '$subtract': [ { '$arrayElemAt': [ '$values', '$$i' ] }, { '$arrayElemAt': [ '$values', { '$subtract': [ '$$i', 1 ] } ] } ] } }
+                    }
+                } },
+                { '$cond': [ { '$gt': [ { '$size': '$carried' }, 0 ] },
+                    { '$abs': { '$subtract': [ { '$arrayElemAt': [ '$values', 0 ] }, { '$arrayElemAt': [ '$carried', -1 ] } ] } }, 0 ] }
+            ] },
+            'delta_count': { '$add': [ { '$subtract': [ { '$size': '$values' }, 1 ] }, { '$cond': [ { '$gt': [ { '$size': '$carried' }, 0 ] }, 1, 0 ] } ] },
+            'first_ts': 1,
+            'first_value': { '$arrayElemAt': [ '$values', 0 ] },
+            'last_ts': 1,
+            'last_value': { '$arrayElemAt': [ '$values', -1 ] },
+            'carried': { '$gt': [ { '$size': '$carried' }, 0 ] },
+            'stale': { '$literal': False },
+            'expire_on': 1
+        } },
+        { '$merge': { 'into': into, 'on': [ 'station_id', 'hour' ], 'whenMatched': 'replace', 'whenNotMatched': 'insert' } }
+    ]
+
+
+def repair_utilization(status_collection, utilization_collection=None, limit=1000, partitions=None):
+    '''
+    Recomputes the station-hours that got overlapping measurements from the buckets, e.g. after each import.
+    The buckets have all measurements in any case, the running sums only need a repair in this rare case.
+    With StatusPartitions, only the partitions of the stale hours are read.
+    '''
+    if utilization_collection == None:
+        utilization_collection = status_collection.database[UTILIZATION_COLLECTION]
+
+    try:
+        stale = list(utilization_collection.find({ 'stale': True }, projection={ 'station_id': 1, 'hour': 1 }, limit=limit))
+        if len(stale) == 0:
+            return
+
+        pipeline = repair_pipeline(stale, into=utilization_collection.name)
+        if partitions != None:
+            hours = [ item['hour'] for item in stale ]
+            partitions.aggregate(pipeline, start=min(hours) - timedelta(hours=1), end=max(hours) + timedelta(hours=1), allowDiskUse=True)
+        else:
+            status_collection.aggregate(pipeline, allowDiskUse=True)
+        print(str(datetime.today()) + ' INFO Repaired ' + str(len(stale)) + ' station-hours of ' + str(utilization_collection.name) + '.')
+
+    except pymongo.errors.PyMongoError as e:
+        print(str(datetime.today()) + ' ERROR Repairing ' + str(utilization_collection.name) + ' failed: ' + str(e))
+
+
+class UtilizationCache:
+    '''
+    Remembers the last measurement (ts and num_bikes_available) per station, so that the first delta of an hour is
+    taken against the last value of the previous hour, also across imports. It is updated with the measurements
+    that were written (see StatusWrites), from the threads of a BulkWriter, and loaded from the latest station-hours.
+    '''
+
+    def __init__(self):
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.last)
+
+    def pipeline(self):
+        '''
+        Aggregation on the utilization collection with the last measurement of the latest station-hour per station.
+        '''
+        return [
+            # Uses the index on station_id and hour (descending), like hourly_utilization_pipeline
+            { '$sort': { 'station_id': 1, 'hour': -1 } },
+            { '$group': {
+                '_id': '$station_id',
+                'last_ts': { '$first': '$last_ts' },
+                'last_value': { '$first': '$last_value' }
+            } }
+        ]
+
+    def load(self, collection):
+        '''
+        Initializes the cache from the utilization collection, e.g. at startup.
+        '''
+        try:
+            self.load_results(collection.aggregate(self.pipeline(), allowDiskUse=True), collection)
+
+        except pymongo.errors.PyMongoError as e:
+            print(str(datetime.today()) + ' ERROR Loading the last measurements failed: ' + str(e))
+
+    def load_results(self, results, collection):
+        with self.lock:
+            for result in results:
+                if result.get('last_ts') != None:
+                    self.last[result['_id']] = (result['last_ts'], result.get('last_value', 0))
+        print(str(datetime.today()) + ' INFO Loaded the last measurements of ' + str(len(self.last)) + ' stations from ' + str(collection.name) + '.')
+
+    def operations(self, station_id, measurements, expire_after=None):
+        '''
+        The updates of the running sums for written measurements of the station, see utilization_operations.
+        The last measurement is only carried into measurements that are newer.
+        '''
+        measurements = sorted(measurements, key=lambda measurement: measurement['ts'])
+        last = (measurements[-1]['ts'], measurements[-1].get('num_bikes_available', 0))
+
+        with self.lock:
+            previous = self.last.get(station_id)
+            if previous == None or previous[0] < last[0]:
+                self.last[station_id] = last
+        if previous != None and previous[0] >= measurements[0]['ts']:
+            previous = None
+
+        return utilization_operations(station_id, measurements, expire_after=expire_after, previous=previous)
@@ -16,11 +16,16 @@
 
 import os
 import json
+import signal
 import paho.mqtt.client as mqtt 
 from pymongo import MongoClient
 
+from iot_citibike import config
 from iot_citibike.mongodb.indexes_views import prepare_mongodb
+from iot_citibike.mongodb.partitions import StatusPartitions
 from iot_citibike.mongodb.operations import update_station_information
+from iot_citibike.mongodb.flusher import BatchFlusher
+from iot_citibike.mongodb.station_cache import StationHashCache
 
 MONGO_URI = os.environ["MONGO_URI"] if "MONGO_URI" in os.environ else None
 if MONGO_URI == None:
@@ -32,6 +37,12 @@ if MQTT_HOST == None:
 	raise ValueError('No MQTT Broker provided. Will exit.')
 	exit(-1)
 
+# Limits for batching the station registrations, a batch is written as soon as one of them is reached
+FLUSH_MAX_BATCH = int(os.environ.get("FLUSH_MAX_BATCH", 500))
+FLUSH_MAX_LATENCY_MS = int(os.environ.get("FLUSH_MAX_LATENCY_MS", 500))
+FLUSH_MAX_BYTES = int(os.environ.get("FLUSH_MAX_BYTES", 1024*1024))
+FLUSH_MAX_QUEUE = int(os.environ.get("FLUSH_MAX_QUEUE", 10000))
+
 # The callback for when the client receives a CONNACK response from the MQTT server.
 def on_connect(client, userdata, flags, rc):
 	print('Connected to MQTT broker with result code ' + str(rc))
@@ -41,14 +52,26 @@ def on_connect(client, userdata, flags, rc):
 	client.subscribe('stations')
 
 # The callback for when a PUBLISH message is received from the MQTT server.
-# Optimization: As we receive many messages in one shot, the results should be processed in a batched manner.
+# As we receive many (retained) messages in one shot after connecting, they are registered in batches by the flusher.
 def on_message(client, userdata, message):
 	# print('Received message ' + str(message.payload) + ' on topic ' + message.topic + ' with QoS ' + str(message.qos))
 
 	station = json.loads(message.payload)
 	
-	# Register the station in MongoDB
-	update_station_information(stations=[ station ], collection=stations_collection, batch_size=1)
+	# Blocks if the queue is full, i.e. we stop reading from the broker until MongoDB caught up
+	flusher.put(station, size=len(message.payload))
+
+# Register a batch of stations in MongoDB
+def write_stations(buffered_stations):
+	# Only the latest message per station matters, the writes are unordered
+	stations = { station['_id']: station for station in buffered_stations }
+
+	# Stations that did not change since the last stored version are skipped
+	update_station_information(stations=stations.values(), collection=stations_collection, batch_size=100, hash_cache=station_cache)
+
+# Stop listening on SIGTERM, the remaining messages are flushed afterwards
+def on_shutdown(signum, frame):
+	client.disconnect()
 
 # Setup MQTT broker connection
 client = mqtt.Client(client_id='citibike_station_subsriber')
@@ -61,8 +84,25 @@ mongo_client = MongoClient(MONGO_URI)
 db = mongo_client.citibike
 stations_collection = db.stations
 
-# Ensure proper status of MongoDB, i.e. indexes and views
-prepare_mongodb(db=db, stations_collection=stations_collection)
+# Ensure proper status of MongoDB, i.e. indexes and views. The views read the newest time partitions of the status if it is partitioned.
+partitions = None
+if config.STATUS_STORAGE == 'buckets' and config.STATUS_PARTITIONING != 'none':
+	partitions = StatusPartitions(db.status)
+prepare_mongodb(db=db, stations_collection=stations_collection, partitions=partitions)
+
+# Remember what is already stored, so that reconnects do not replace all stations again
+station_cache = StationHashCache()
+station_cache.load(stations_collection)
+
+# Batch the messages off the network thread
+flusher = BatchFlusher(write_stations, max_batch=FLUSH_MAX_BATCH, max_latency=FLUSH_MAX_LATENCY_MS / 1000,
+	max_bytes=FLUSH_MAX_BYTES, max_queue=FLUSH_MAX_QUEUE, name='station_information_flusher')
+signal.signal(signal.SIGTERM, on_shutdown)
 
 # Start to listen to the HiveMQ Broker
-client.loop_forever()
+try:
+	client.loop_forever()
+except KeyboardInterrupt:
+	client.disconnect()
+finally:
+	flusher.close()
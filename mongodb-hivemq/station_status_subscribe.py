@@ -16,11 +16,21 @@
 
 import os
 import json
+import signal
+import threading
 import paho.mqtt.client as mqtt 
 from pymongo import MongoClient
 
+from iot_citibike import config
 from iot_citibike.mongodb.indexes_views import prepare_mongodb
 from iot_citibike.mongodb.operations import update_station_status
+from iot_citibike.mongodb.bulk_writer import BulkWriter
+from iot_citibike.mongodb.flusher import BatchFlusher
+from iot_citibike.mongodb.coalescer import OpenBucketCache, BucketPolicy
+from iot_citibike.mongodb.recent_cache import RecentStatusCache
+from iot_citibike.mongodb.partitions import StatusPartitions
+from iot_citibike.mongodb.latest_status import refresh_latest_status
+from iot_citibike.mongodb.utilization import repair_utilization, UtilizationCache
 
 
 MQTT_HOST = os.environ["MQTT_HOST"] if "MQTT_HOST" in os.environ else None
@@ -33,8 +43,14 @@ if MONGO_URI == None:
 	raise ValueError('No MongoDB Cluster provided. Will exit.')
 	exit(-1)
 
-# A buffer so that we can batch the inserts into MongoDB
-buffered_station_status = []
+# Limits for batching the inserts into MongoDB, a batch is written as soon as one of them is reached
+FLUSH_MAX_BATCH = int(os.environ.get("FLUSH_MAX_BATCH", 500))
+FLUSH_MAX_LATENCY_MS = int(os.environ.get("FLUSH_MAX_LATENCY_MS", 500))
+FLUSH_MAX_BYTES = int(os.environ.get("FLUSH_MAX_BYTES", 1024*1024))
+FLUSH_MAX_QUEUE = int(os.environ.get("FLUSH_MAX_QUEUE", 10000))
+
+# Seconds between two refreshes of latest_status and repairs of the utilization, they run on their own thread
+LATEST_STATUS_INTERVAL = float(os.environ.get("LATEST_STATUS_INTERVAL", 60))
 
 # The callback for when the client receives a CONNACK response from the MQTT server.
 def on_connect(client, userdata, flags, rc):
@@ -46,25 +62,33 @@ def on_connect(client, userdata, flags, rc):
 	client.subscribe('status/#')
 
 # The callback for when a PUBLISH message is received from the MQTT server.
-# Optimization: As we receive many messages in one shot, the results should be processed in a batched manner.
+# The messages are only queued here, the flusher writes them in batches on its own thread,
+# so that the network thread of paho is not blocked by MongoDB.
 def on_message(client, userdata, message):
-	global buffered_station_status
-
 	#print('Received message ' + str(message.payload) + ' on topic ' + message.topic + ' with QoS ' + str(message.qos))
 	station_status = json.loads(message.payload)
-	buffered_station_status.append(station_status)
 
-	if len(buffered_station_status) >= 50:
-		# Make a copy to not modify concurrently
-		cp_buffer = list(buffered_station_status)
-		buffered_station_status.clear()
-		
-		#Write the current status to MongoDB
-		update_station_status(station_status=cp_buffer, collection=status_collection, batch_size=100)
+	# Blocks if the queue is full, i.e. we stop reading from the broker until MongoDB caught up
+	flusher.put(station_status, size=len(message.payload))
+
+# Write a batch of buffered status messages to MongoDB
+def write_station_status(buffered_station_status):
+	update_station_status(station_status=buffered_station_status, collection=status_collection, batch_size=100, writer=status_writer, bucket_cache=bucket_cache,
+		utilization_collection=utilization_collection, recent_cache=recent_cache, partitions=partitions, utilization_cache=utilization_cache)
 
-	# Usually, the clients send their data at a random time, so this is all we need for batching. 
-	# In the case of the bike stations, we should frequently flush the buffer to not "forget" to write the last entries.
+# Materialize the latest status per station for v_bike_availability and recompute the utilization of station-hours
+# that got late or replayed messages, in a fixed interval instead of after each batch, so that the flusher is not blocked
+def refresh_status():
+	refresh_latest_status(status_collection, partitions=partitions)
+	repair_utilization(status_collection, utilization_collection, partitions=partitions)
 
+def refresh_loop():
+	while not refresh_stopped.wait(LATEST_STATUS_INTERVAL):
+		refresh_status()
+
+# Stop listening on SIGTERM, the remaining messages are flushed afterwards
+def on_shutdown(signum, frame):
+	client.disconnect()
 
 # Setup MQTT broker connection
 client = mqtt.Client(client_id='citibike_status_subsriber')
@@ -76,9 +100,53 @@ client.connect(MQTT_HOST, 1883, 60)
 mongo_client = MongoClient(MONGO_URI)
 db = mongo_client.citibike
 status_collection = db.status
+utilization_collection = db.utilization
+
+# Optionally write the buckets into one collection per day or week, expired ones are dropped as a whole
+partitions = None
+if config.STATUS_STORAGE == 'buckets' and config.STATUS_PARTITIONING != 'none':
+	partitions = StatusPartitions(status_collection)
 
 # Ensure proper status of MongoDB, i.e. indexes and views
-prepare_mongodb(db=db, status_collection=status_collection)
+prepare_mongodb(db=db, status_collection=status_collection, partitions=partitions)
+
+# Remember the open bucket per station, so that the status is pushed into the buckets by _id
+# With partitions, each partition has its own cache, it is loaded when the partition is written for the first time
+bucket_cache = OpenBucketCache(policy=BucketPolicy.for_collection(status_collection.name))
+if config.STATUS_STORAGE == 'buckets' and partitions == None:
+	bucket_cache.load(status_collection)
+
+# Remember the recent measurements per station, messages delivered more than once (QoS 1) are skipped
+recent_cache = RecentStatusCache()
+if config.STATUS_STORAGE == 'buckets':
+	recent_cache.load(status_collection if partitions == None else partitions.latest())
+
+# Remember the last measurement per station, the first delta of each hour of the running utilization sums needs it
+utilization_cache = UtilizationCache()
+if config.STATUS_STORAGE == 'buckets':
+	utilization_cache.load(utilization_collection)
+
+# Batch the messages off the network thread and write them concurrently
+status_writer = BulkWriter(status_collection)
+flusher = BatchFlusher(write_station_status, max_batch=FLUSH_MAX_BATCH, max_latency=FLUSH_MAX_LATENCY_MS / 1000,
+	max_bytes=FLUSH_MAX_BYTES, max_queue=FLUSH_MAX_QUEUE, name='station_status_flusher')
+signal.signal(signal.SIGTERM, on_shutdown)
+
+refresh_stopped = threading.Event()
+refresher = threading.Thread(target=refresh_loop, name='latest_status_refresher', daemon=True)
+refresher.start()
 
 # Start to listen to the HiveMQ Broker
-client.loop_forever()
+try:
+	client.loop_forever()
+except KeyboardInterrupt:
+	client.disconnect()
+finally:
+	# Do not lose the tail of the last poll
+	flusher.close()
+	status_writer.close()
+
+	# One last refresh with the tail of the written status
+	refresh_stopped.set()
+	refresher.join()
+	refresh_status()